@@ -0,0 +1,215 @@
+"""
+Compact aggregate companions of the L4 products - time mean, monthly and seasonal climatology and zonal mean
+"""
+
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+from nodata import NODATA, masked_block
+
+
+# Seasons as indices into the calendar months, December to February first
+SEASONS = {'DJF': [11, 0, 1], 'MAM': [2, 3, 4], 'JJA': [5, 6, 7], 'SON': [8, 9, 10]}
+
+
+def aggregate_path(output_dir, granule, suffix):
+    """ Path of the aggregate companion of a product """
+    return f'{output_dir}/{granule}_{suffix}_AGG.nc'
+
+
+def drop_axis(items, axis):
+    return tuple(item for _d, item in enumerate(items) if _d != axis)
+
+
+class AggregateObserver:
+    """Accumulates the aggregates of every product variable from the slabs written during conversion, and writes
+    them to the companion file as soon as the last slab of the variable has been seen, so only the sums of the
+    variable being converted are held in memory.
+
+    Time steps are summed per calendar month, assuming monthly output starting in January, so the time mean, the
+    monthly and the seasonal climatology all come out of the same sums.  Climatologies are only made when the time
+    axis covers whole years.  The zonal mean is kept for every time step.  Fill values and NaNs are ignored.
+    """
+
+    def __init__(self, output_file, variable_kargs=None):
+        """
+        Args:
+            output_file: path of the companion netCDF file, written under a temporary name until finish()
+            variable_kargs: optional callable returning the createVariable chunking and compression keyword
+                            arguments of an aggregate from its dimension names and shape, e.g. from the product's
+                            output profile
+        """
+        self.output_file = output_file
+        self.variable_kargs = variable_kargs
+        self.variables = {}
+        self.nc_ds = None
+
+    def _start(self, nc_var):
+        dimensions = list(nc_var.dimensions)
+        shape = list(nc_var.shape)
+        acc = {'dimensions': dimensions, 'long_name': getattr(nc_var, 'long_name', nc_var.name),
+               'units': getattr(nc_var, 'units', None), 'size': int(np.prod(shape)), 'seen': 0}
+
+        if 'time' in dimensions:
+            t_ax = dimensions.index('time')
+            ntime = shape[t_ax]
+            acc['periods'] = 12 if ntime >= 12 and ntime % 12 == 0 else 1
+            period_shape = [acc['periods']] + list(drop_axis(shape, t_ax))
+            acc['sum'] = np.zeros(period_shape, dtype=np.float64)
+            acc['count'] = np.zeros(period_shape, dtype=np.int32)
+
+        zonal_shape = drop_axis(shape, dimensions.index('lon'))
+        acc['zonal_sum'] = np.zeros(zonal_shape, dtype=np.float64)
+        acc['zonal_count'] = np.zeros(zonal_shape, dtype=np.int32)
+        return acc
+
+    def __call__(self, nc_var, out_slices, out_dat):
+        dimensions = list(nc_var.dimensions)
+        if 'lat' not in dimensions or 'lon' not in dimensions:
+            return
+        acc = self.variables.get(nc_var.name)
+        if acc is None:
+            acc = self.variables[nc_var.name] = self._start(nc_var)
+
+        data = masked_block(out_dat)
+        values = np.ma.filled(data, 0)
+        valid = ~np.ma.getmaskarray(data)
+
+        lon_ax = dimensions.index('lon')
+        zonal_slices = drop_axis(out_slices, lon_ax)
+        acc['zonal_sum'][zonal_slices] += values.sum(axis=lon_ax)
+        acc['zonal_count'][zonal_slices] += valid.sum(axis=lon_ax)
+
+        if 'time' in dimensions:
+            t_ax = dimensions.index('time')
+            rest = drop_axis(out_slices, t_ax)
+            start = out_slices[t_ax].indices(nc_var.shape[t_ax])[0]
+            periods = (start + np.arange(values.shape[t_ax])) % acc['periods']
+            for period in np.unique(periods):
+                steps = np.flatnonzero(periods == period)
+                acc['sum'][(period,) + rest] += np.take(values, steps, axis=t_ax).sum(axis=t_ax)
+                acc['count'][(period,) + rest] += np.take(valid, steps, axis=t_ax).sum(axis=t_ax)
+
+        # Slabs never overlap, so the variable is complete once every value has been seen
+        acc['seen'] += data.size
+        if acc['seen'] >= acc['size']:
+            self._open(nc_var.group())
+            self._write_variable(nc_var.name, acc)
+            del self.variables[nc_var.name]
+
+    @staticmethod
+    def _mean(total, count, axis=None):
+        if axis is not None:
+            total = total.sum(axis=axis)
+            count = count.sum(axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.ma.array(total / np.maximum(count, 1), mask=count == 0).astype(np.float32)
+
+    def _open(self, product_ds):
+        """ Start the companion file, with the dimensions and coordinates of the product dataset """
+        if self.nc_ds is not None:
+            return
+        print(f'Creating aggregate file {self.output_file}')
+        # Written under a temporary name, so a missing companion is never mistaken for a complete one
+        self.nc_ds = Dataset(self.output_file + '.partial', 'w', clobber=True, format='NETCDF4')
+        # Time is kept for the zonal means
+        for name, dimension in product_ds.dimensions.items():
+            self.nc_ds.createDimension(name, len(dimension))
+        for name in ['lat', 'lon', 'time', 'mineral']:
+            self._copy_variable(product_ds, name)
+
+    def _copy_variable(self, product_ds, name):
+        if name not in product_ds.variables or name in self.nc_ds.variables:
+            return
+        source_var = product_ds.variables[name]
+        # String coordinates, such as the mineral names, are object arrays in zarr stores and netCDF string variables
+        is_string = source_var.dtype is str or np.dtype(source_var.dtype).kind in 'OSU'
+        nc_var = self.nc_ds.createVariable(name, str if is_string else source_var.dtype, source_var.dimensions)
+        nc_var.setncatts({attr: source_var.getncattr(attr) for attr in source_var.ncattrs()})
+        if not source_var.dimensions:
+            return
+        if is_string:
+            # netCDF string variables are written one element at a time
+            for _i, value in enumerate(source_var[:]):
+                nc_var[_i] = str(value)
+        else:
+            nc_var[:] = source_var[:]
+
+    def _add_aggregate(self, name, dimensions, long_name, units, cell_methods):
+        shape = [len(self.nc_ds.dimensions[dimension]) for dimension in dimensions]
+        kargs = {} if self.variable_kargs is None else self.variable_kargs(list(dimensions), shape)
+        nc_var = self.nc_ds.createVariable(name, 'f4', dimensions, fill_value=NODATA, **kargs)
+        if 'chunksizes' in kargs:
+            # Aggregates are written in whole chunks, which HDF5 would otherwise keep cached until the file is closed.
+            # A size of 0 leaves the default cache in place, so a single chunk is cached
+            nc_var.set_var_chunk_cache(size=4 * int(np.prod(kargs['chunksizes'])))
+        nc_var.long_name = long_name
+        if units is not None:
+            nc_var.units = units
+        nc_var.cell_methods = cell_methods
+        if 'lat' in dimensions and 'lon' in dimensions:
+            nc_var.grid_mapping = 'latitude_longitude'
+        return nc_var
+
+    def _climatology_dimensions(self):
+        if 'month' in self.nc_ds.dimensions:
+            return
+        self.nc_ds.createDimension('month', 12)
+        self.nc_ds.createDimension('season', len(SEASONS))
+        nc_var = self.nc_ds.createVariable('month', 'i4', ('month',))
+        nc_var.long_name = 'Calendar month'
+        nc_var[:] = np.arange(1, 13)
+        nc_var = self.nc_ds.createVariable('season', 'i4', ('season',))
+        nc_var.long_name = 'Season'
+        nc_var.flag_values = np.arange(1, len(SEASONS) + 1, dtype=np.int32)
+        nc_var.flag_meanings = ' '.join(SEASONS)
+        nc_var[:] = np.arange(1, len(SEASONS) + 1)
+
+    def _write_variable(self, name, acc):
+        """ Write the aggregates of a variable whose slabs have all been seen.  Climatologies are written a month or
+        season at a time, so the means never need more memory than a single one """
+        dimensions = acc['dimensions']
+        long_name = acc['long_name']
+        units = acc['units']
+        if 'time' in dimensions:
+            rest = drop_axis(dimensions, dimensions.index('time'))
+            nc_var = self._add_aggregate(f'{name}_time_mean', rest, f'{long_name} time mean', units, 'time: mean')
+            nc_var[...] = self._mean(acc['sum'], acc['count'], axis=0)
+            if acc['periods'] == 12:
+                self._climatology_dimensions()
+                nc_var = self._add_aggregate(f'{name}_monthly_climatology', ('month',) + rest,
+                                             f'{long_name} monthly climatology', units, 'time: mean within months')
+                for month in range(12):
+                    nc_var[month] = self._mean(acc['sum'][month], acc['count'][month])
+                nc_var = self._add_aggregate(f'{name}_seasonal_climatology', ('season',) + rest,
+                                             f'{long_name} seasonal climatology', units, 'time: mean within seasons')
+                for _s, months in enumerate(SEASONS.values()):
+                    nc_var[_s] = self._mean(acc['sum'][months], acc['count'][months], axis=0)
+
+        zonal_dimensions = drop_axis(dimensions, dimensions.index('lon'))
+        nc_var = self._add_aggregate(f'{name}_zonal_mean', zonal_dimensions, f'{long_name} zonal mean', units,
+                                     'lon: mean')
+        nc_var[...] = self._mean(acc['zonal_sum'], acc['zonal_count'])
+        self.nc_ds.sync()
+
+    def finish(self, product_ds):
+        """ Complete the companion file with the metadata and grid mapping of the product dataset, and move it into
+        place
+        Args:
+            product_ds: the open product dataset the aggregates were collected from
+        """
+        self._open(product_ds)
+        # Variables cut short are written with the slabs that were seen
+        for name, acc in self.variables.items():
+            self._write_variable(name, acc)
+        self.variables = {}
+        self._copy_variable(product_ds, 'latitude_longitude')
+        for attr in product_ds.ncattrs():
+            self.nc_ds.setncattr(attr, product_ds.getncattr(attr))
+        self.nc_ds.title += ' Aggregates'
+        self.nc_ds.summary += ' Time mean, monthly and seasonal climatology and zonal mean of the product variables.'
+        self.nc_ds.close()
+        self.nc_ds = None
+        os.replace(self.output_file + '.partial', self.output_file)
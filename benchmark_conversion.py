@@ -0,0 +1,191 @@
+"""
+Benchmarks the L4 netcdf conversion on synthetic CESM- and GISS-shaped inputs
+
+Example:
+    python benchmark_conversion.py --runs cesm32 giss40 --preset small --slab_mb 256
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset
+
+import netcdf_conversion_template as conversion
+
+
+# Synthetic model runs, shaped like the rows of models.csv with the matching resolution
+BENCHMARK_RUNS = {
+    'cesm32': {'resolution': '1.0 x 1.25 x 32', 'lat': 192, 'lon': 288, 'lev': 32, 'bins': 4,
+               'minerals': conversion.ACCEPTED_MINERAL_NAMES[:8]},
+    'cesm56': {'resolution': '1.0 x 1.25 x 56', 'lat': 192, 'lon': 288, 'lev': 56, 'bins': 4,
+               'minerals': conversion.ACCEPTED_MINERAL_NAMES[:8]},
+    'giss40': {'resolution': '2.0 x 2.5 x 40', 'lat': 90, 'lon': 144, 'lev': 40, 'bins': 4,
+               'minerals': conversion.ACCEPTED_MINERAL_NAMES[8:]},
+}
+
+# Size presets - spatial and level dimensions are divided by scale, time is monthly
+BENCHMARK_PRESETS = {
+    'tiny': {'scale': 8, 'time': 2, 'minerals': 2},
+    'small': {'scale': 2, 'time': 12, 'minerals': None},
+    'full': {'scale': 1, 'time': 60, 'minerals': None},
+}
+
+
+def make_synthetic_input(path, run, preset, l4_naming, seed=0):
+    """ Write a synthetic ESM output file with every variable in the L4 naming table
+    Args:
+        path: output netCDF path
+        run: entry of BENCHMARK_RUNS
+        preset: entry of BENCHMARK_PRESETS
+        l4_naming: L4 naming table
+        seed: random seed for the variable values
+
+    Returns:
+        total bytes of variable data written
+    """
+    scale = preset['scale']
+    sizes = {'bins': run['bins'],
+             'lon': max(run['lon'] // scale, 4),
+             'lat': max(run['lat'] // scale, 4),
+             'lev': max(run['lev'] // scale, 1),
+             'time': preset['time']}
+    minerals = run['minerals'] if preset['minerals'] is None else run['minerals'][:preset['minerals']]
+    rng = np.random.default_rng(seed)
+
+    ds = Dataset(path, 'w', format='NETCDF4')
+    for name in ['bins', 'lon', 'lat', 'lev', 'time']:
+        ds.createDimension(name, sizes[name])
+    # Source grids are south to north with 0-360 longitudes, as in the model output
+    ds.createVariable('lat', 'f8', ('lat',))[:] = np.linspace(-90, 90, sizes['lat'])
+    ds.createVariable('lon', 'f8', ('lon',))[:] = np.arange(sizes['lon']) * 360. / sizes['lon']
+    ds.createVariable('time', 'f8', ('time',))[:] = np.arange(sizes['time'])
+
+    nbytes = 0
+    for _v, short_name in enumerate(l4_naming['Short Name']):
+        dimensions = tuple(l4_naming['Dimensions'][_v].split(','))
+        names = [short_name]
+        if l4_naming['Mineral Repeat'][_v]:
+            names = [f'{short_name}_{mineral}' for mineral in minerals]
+        for name in names:
+            nc_var = ds.createVariable(name, 'f4', dimensions)
+            shape = [sizes[d] for d in dimensions]
+            # Write one time step at a time, so full size inputs can be generated on small nodes
+            if 'time' in dimensions:
+                t_ax = dimensions.index('time')
+                for _t in range(sizes['time']):
+                    slices = [slice(None)] * len(dimensions)
+                    slices[t_ax] = slice(_t, _t + 1)
+                    shape[t_ax] = 1
+                    nc_var[tuple(slices)] = rng.random(shape, dtype=np.float32)
+            else:
+                nc_var[...] = rng.random(shape, dtype=np.float32)
+            nbytes += 4 * int(np.prod([sizes[d] for d in dimensions]))
+    ds.close()
+    return nbytes
+
+
+def benchmark_product(input_file, output_file, product, esm, options):
+    """ Convert one product in a fresh process and measure it
+    Returns:
+        dictionary of product timing, size and memory figures
+    """
+    # ru_maxrss is a high-water mark, reported in KiB on Linux.  The spawned process has imported numpy, netCDF4 and
+    # the conversion before this runs, so the peak is reported whole, with the footprint of those imports alongside
+    rss_imports = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    source_dataset = Dataset(input_file, 'r')
+    input_bytes = sum(source_dataset.variables[name].size * source_dataset.variables[name].dtype.itemsize
+                      for name in product['l4_names'])
+    start_time = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        conversion.convert_product(source_dataset, output_file, product, esm, **options)
+    elapsed = time.time() - start_time
+    source_dataset.close()
+
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'suffix': product['suffix'],
+            'variables': len(product['l4_names']),
+            'input_mb': input_bytes / 1024**2,
+            'output_mb': os.path.getsize(output_file) / 1024**2,
+            'seconds': elapsed,
+            'mb_per_s': input_bytes / 1024**2 / max(elapsed, 1e-9),
+            'peak_rss_mb': rss_peak / 1024.,
+            'imports_rss_mb': rss_imports / 1024.}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the L4 netcdf conversion on synthetic inputs')
+    parser.add_argument('--runs', nargs='*', choices=list(BENCHMARK_RUNS), default=list(BENCHMARK_RUNS))
+    parser.add_argument('--preset', choices=list(BENCHMARK_PRESETS), default='tiny')
+    parser.add_argument('--work_dir', default=None, help='Directory for synthetic inputs and outputs')
+    parser.add_argument('--keep', action='store_true', help='Keep the synthetic inputs and outputs')
+    parser.add_argument('--report', default=None, help='Write the results as json to this path')
+    parser.add_argument('--l4_naming_file', default='data/L4_varnames.csv')
+    parser.add_argument('--model_lookup', default='data/models.csv')
+    parser.add_argument('--slab_mb', type=float, default=None)
+    parser.add_argument('--pipeline_depth', type=int, default=0)
+    parser.add_argument('--output_profile', choices=list(conversion.OUTPUT_PROFILES), default=None,
+                        help='Output profile for all products, the Output Profile column of the naming table by '
+                             'default as in the conversion itself, e.g. contiguous to measure uncompressed writes')
+    args = parser.parse_args()
+
+    lk = pd.read_csv(args.model_lookup)
+    l4_naming = pd.read_csv(args.l4_naming_file)
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='l4_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    options = {'max_slab_bytes': None if args.slab_mb is None else int(args.slab_mb * 1024**2),
+               'pipeline_depth': args.pipeline_depth}
+
+    results = []
+    try:
+        for run_name in args.runs:
+            run = BENCHMARK_RUNS[run_name]
+            model = lk.loc[lk['Resolution'] == run['resolution']].iloc[0]
+            input_file = os.path.join(work_dir, model['Input Filename'])
+
+            start_time = time.time()
+            input_bytes = make_synthetic_input(input_file, run, BENCHMARK_PRESETS[args.preset], l4_naming)
+            print(f'{run_name}: generated {input_bytes / 1024**2:.1f} MB synthetic input in '
+                  f'{time.time() - start_time:.1f} s')
+
+            source_dataset = Dataset(input_file, 'r')
+            products, _ = conversion.resolve_products(source_dataset, l4_naming)
+            source_dataset.close()
+
+            output_dir = os.path.join(work_dir, model['Granule Name'])
+            os.makedirs(output_dir, exist_ok=True)
+            for product in products:
+                output_file = os.path.join(output_dir, f'{model["Granule Name"]}_{product["suffix"]}.nc')
+                profile = conversion.OUTPUT_PROFILES[args.output_profile or product['profile']]
+                # A fresh process per product, so peak RSS is not carried over between products
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    result = pool.submit(benchmark_product, input_file, output_file, product, model['ESM'],
+                                         dict(options, profile=profile)).result()
+                result['run'] = run_name
+                result['profile'] = args.output_profile or product['profile']
+                results.append(result)
+                print(f'{run_name:>8} {result["suffix"]:>9}: {result["seconds"]:8.2f} s '
+                      f'{result["mb_per_s"]:9.1f} MB/s  in {result["input_mb"]:9.1f} MB  '
+                      f'out {result["output_mb"]:9.1f} MB  peak RSS {result["peak_rss_mb"]:8.1f} MB '
+                      f'(imports {result["imports_rss_mb"]:.1f} MB)')
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            f.write(json.dumps({'preset': args.preset, 'options': vars(args), 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
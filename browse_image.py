@@ -2,38 +2,190 @@
 
 
 import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from netCDF4 import Dataset
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
+from nodata import masked_block
+
+
+class TimeMeanAccumulator:
+    """Bin-summed time mean of a variable, accumulated block by block in float64.
+
+    Blocks carry their dimension names; a 'bins' axis is summed over and a 'time' axis averaged over.  Fill values
+    and masked or NaN entries are ignored; a time step counts towards the mean wherever at least one bin is valid.
+    """
+
+    def __init__(self):
+        self.total = None
+        self.count = None
+
+    def add(self, block, dimensions):
+        dimensions = list(dimensions)
+        data = masked_block(block)
+
+        if 'bins' in dimensions:
+            data = data.sum(axis=dimensions.index('bins'))
+            dimensions.remove('bins')
+        valid = ~np.ma.getmaskarray(data)
+        values = np.ma.filled(data, 0)
+        if 'time' in dimensions:
+            values = values.sum(axis=dimensions.index('time'))
+            valid = valid.sum(axis=dimensions.index('time'))
+
+        if self.total is None:
+            self.total = np.zeros(values.shape, dtype=np.float64)
+            self.count = np.zeros(values.shape, dtype=np.int64)
+        self.total += values
+        self.count += valid
+
+    def mean(self):
+        """ Time mean, NaN where no valid time step was seen """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.total / np.maximum(self.count, 1), np.nan)
+
+
+class BrowseObserver:
+    """Collects the bin-summed time mean of the browse variable from the slabs written during conversion.
+
+    Called with the output variable, the output slices and the data of every slab, which may be split along time,
+    bins or lat.  Slabs are reduced over bins and time as they arrive.  A time step counts towards the mean wherever
+    at least one of its bins is valid, so the validity of a time step whose bins are split over several slabs is kept
+    until all of them have been seen.
+    """
+
+    def __init__(self, variable='dust_sw_rf_toa'):
+        self.variable = variable
+        self.total = None
+        self.count = None
+        # Validity, and number of values seen, of the time steps whose bins are still arriving
+        self.pending = {}
+
+    def __call__(self, nc_var, out_slices, out_dat):
+        if nc_var.name != self.variable:
+            return
+        dimensions = list(nc_var.dimensions)
+        shape = list(nc_var.shape)
+        out_slices = list(out_slices)
+        if 'time' not in dimensions:
+            # A single time step
+            dimensions, shape, out_slices = ['time'] + dimensions, [1] + shape, [slice(None)] + out_slices
+            out_dat = out_dat[np.newaxis]
+        rest = [_d for _d, name in enumerate(dimensions) if name not in ('time', 'bins')]
+        if self.total is None:
+            self.total = np.zeros([shape[_d] for _d in rest], dtype=np.float64)
+            self.count = np.zeros(self.total.shape, dtype=np.int32)
+        rest_slices = tuple(out_slices[_d] for _d in rest)
+        t_start = out_slices[dimensions.index('time')].indices(shape[dimensions.index('time')])[0]
+
+        data = masked_block(out_dat)
+        valid = ~np.ma.getmaskarray(data)
+        values = np.ma.filled(data, 0)
+        nbins, slab_bins = 1, 1
+        if 'bins' in dimensions:
+            b_ax = dimensions.index('bins')
+            nbins, slab_bins = shape[b_ax], data.shape[b_ax]
+            valid = valid.any(axis=b_ax)
+            values = values.sum(axis=b_ax)
+            dimensions.pop(b_ax)
+        t_ax = dimensions.index('time')
+        self.total[rest_slices] += values.sum(axis=t_ax)
+        if slab_bins == nbins:
+            self.count[rest_slices] += valid.sum(axis=t_ax)
+            return
+
+        # The slab holds some of the bins of its time steps, which are counted once all their bins are seen
+        for _t in range(valid.shape[t_ax]):
+            step_valid = np.take(valid, _t, axis=t_ax)
+            pending = self.pending.setdefault(t_start + _t, {'valid': np.zeros(self.total.shape, dtype=bool),
+                                                               'seen': 0})
+            pending['valid'][rest_slices] |= step_valid
+            pending['seen'] += slab_bins * step_valid.size
+            if pending['seen'] == nbins * self.total.size:
+                self.count += self.pending.pop(t_start + _t)['valid']
+
+    def mean(self):
+        """ Time mean, NaN where no valid time step was seen """
+        for pending in self.pending.values():
+            self.count += pending['valid']
+        self.pending = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.total / np.maximum(self.count, 1), np.nan)
+
+
+def time_mean(nc_var, time_block=12):
+    """ Bin-summed time mean of a netCDF variable, read a block of time steps at a time """
+    dimensions = list(nc_var.dimensions)
+    accumulator = TimeMeanAccumulator()
+    if 'time' not in dimensions:
+        accumulator.add(nc_var[...], dimensions)
+        return accumulator.mean()
+
+    t_ax = dimensions.index('time')
+    for start in range(0, nc_var.shape[t_ax], time_block):
+        slices = [slice(None)] * len(dimensions)
+        slices[t_ax] = slice(start, start + time_block)
+        accumulator.add(nc_var[tuple(slices)], dimensions)
+    return accumulator.mean()
+
+
+def render_browse(mean_sw_rf, output_file):
+    fig = plt.figure(figsize=(8, 4))
+    plt.imshow(mean_sw_rf)
+    plt.axis('off')
+    print('Mean :',np.nanmean(mean_sw_rf))
+    plt.title('Time Averaged Dust Shortwave\nRadiative Forcing TOA (W m$^{-2}$)')
+    plt.colorbar()
 
-def main():
-    parser = argparse.ArgumentParser(description='netcdf conversion')
-    parser.add_argument('input_rf_file', type=str)
-    parser.add_argument('output_file', type=str)
-    args = parser.parse_args()
 
+    plt.savefig(output_file, dpi=300, bbox_inches='tight')
+    plt.close(fig)
 
-    ds = Dataset(args.input_rf_file, 'r')
 
-    if len(ds.variables['dust_sw_rf_toa'].shape) == 4:
-        dust_sw_rf_toa = np.sum(np.array(ds.variables['dust_sw_rf_toa'][...]),axis=0)
-    elif len(ds.variables['dust_sw_rf_toa'].shape) == 3:
-        dust_sw_rf_toa = np.array(ds.variables['dust_sw_rf_toa'][...])
+def make_browse(input_rf_file, output_file, time_block=12):
+    ds = Dataset(input_rf_file, 'r')
+    mean_sw_rf = time_mean(ds.variables['dust_sw_rf_toa'], time_block)
+    ds.close()
 
-    mean_sw_rf = np.mean(dust_sw_rf_toa, axis=0)
+    render_browse(mean_sw_rf, output_file)
+    return output_file
 
-    fig = plt.figure(figsize=(8, 4))
-    plt.imshow(mean_sw_rf)
-    plt.axis('off')
-    print('Mean :',np.mean(mean_sw_rf))
-    plt.title('Time Averaged Dust Shortwave\nRadiative Forcing TOA (W m$^{-2}$)')
-    plt.colorbar()
 
+def main():
+    parser = argparse.ArgumentParser(description='netcdf conversion')
+    parser.add_argument('input_rf_file', type=str, nargs='?')
+    parser.add_argument('output_file', type=str, nargs='?', help='PNG to write, <input_rf_file>.png by default')
+    parser.add_argument('--time_block', type=int, default=12, help='Number of time steps read at a time')
+    parser.add_argument('--granule_dirs', nargs='*', default=[],
+                        help='Granule directories to make <granule>.png browse images for from their DSWRFTOA file')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used for --granule_dirs')
+    args = parser.parse_args()
+
+    jobs = []
+    if args.input_rf_file is not None:
+        # Next to the input file by default
+        output_file = args.output_file or os.path.splitext(args.input_rf_file)[0] + '.png'
+        jobs.append((args.input_rf_file, output_file))
+    for granule_dir in args.granule_dirs:
+        granule = os.path.basename(os.path.normpath(granule_dir))
+        jobs.append((os.path.join(granule_dir, f'{granule}_DSWRFTOA.nc'), os.path.join(granule_dir, f'{granule}.png')))
+    if len(jobs) == 0:
+        parser.error('Give an input_rf_file or --granule_dirs')
 
-    plt.savefig(args.output_file, dpi=300, bbox_inches='tight')
+    if len(jobs) == 1 or args.workers <= 1:
+        for input_rf_file, output_file in jobs:
+            print(f'Wrote {make_browse(input_rf_file, output_file, args.time_block)}')
+        return
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(make_browse, input_rf_file, output_file, args.time_block)
+                   for input_rf_file, output_file in jobs]
+        for future in futures:
+            print(f'Wrote {future.result()}')
 
 
 
@@ -53,4 +205,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
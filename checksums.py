@@ -0,0 +1,101 @@
+"""
+Cached checksums of L4 granule files, shared by UMM-G and CNM generation
+"""
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import active_recorder, recording, stage
+
+
+# Read files in large blocks, shared filesystems are much faster with few large reads than many small ones
+CHECKSUM_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def calc_checksum(path, hash_alg="sha512", block_size=CHECKSUM_BLOCK_SIZE):
+    if hash_alg.lower() == "sha512":
+        h = hashlib.sha512()
+    else:
+        raise ValueError(f"Unsupported checksum algorithm {hash_alg}")
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with stage("hash", os.path.getsize(path)):
+        with open(path, "rb", buffering=0) as f:
+            # Read into a reused buffer, hashlib releases the GIL while hashing large blocks
+            for n in iter(lambda: f.readinto(buffer), 0):
+                h.update(view[:n])
+    return h.hexdigest()
+
+
+def sidecar_path(granule_dir, granule_ur):
+    """ Path of the checksum sidecar of a granule """
+    return os.path.join(granule_dir, f"{granule_ur}.checksums.json")
+
+
+class ChecksumCache:
+    """SHA-512 checksums keyed by path, size and modification time.
+
+    Entries are only reused while a file keeps the same size and mtime.  If a sidecar path is given, existing
+    entries are loaded from it and save() writes them back, with file names relative to the sidecar directory.
+    """
+
+    def __init__(self, sidecar=None):
+        self.sidecar = sidecar
+        self._entries = {}
+        self._lock = threading.Lock()
+        if sidecar is not None and os.path.exists(sidecar):
+            with open(sidecar) as f:
+                files = json.load(f).get("files", {})
+            for name, entry in files.items():
+                self._entries[os.path.abspath(os.path.join(os.path.dirname(sidecar), name))] = entry
+
+    def _lookup(self, path, stat):
+        entry = self._entries.get(os.path.abspath(path))
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha512"]
+        return None
+
+    def checksum(self, path):
+        """ SHA-512 of a file, computed only if it isn't cached for the current size and mtime """
+        stat = os.stat(path)
+        with self._lock:
+            value = self._lookup(path, stat)
+        if value is None:
+            value = calc_checksum(path, "sha512")
+            self.add(path, value, stat)
+        return value
+
+    def add(self, path, value, stat=None):
+        """ Record the SHA-512 of a file, e.g. one computed while it was written """
+        if stat is None:
+            stat = os.stat(path)
+        with self._lock:
+            self._entries[os.path.abspath(path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                                    "sha512": value}
+
+    def prefetch(self, paths, workers=4):
+        """ Compute the checksums of several files in parallel threads """
+        # Hashing time is recorded by the caller's recorder, if it has one
+        recorder = active_recorder()
+
+        def checksum(path):
+            with recording(recorder):
+                return self.checksum(path)
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            list(pool.map(checksum, paths))
+
+    def save(self):
+        """ Atomically write the cached entries under the sidecar directory to the sidecar """
+        if self.sidecar is None:
+            return
+        sidecar_dir = os.path.dirname(os.path.abspath(self.sidecar))
+        with self._lock:
+            files = {os.path.relpath(path, sidecar_dir): entry for path, entry in self._entries.items()
+                     if os.path.dirname(path) == sidecar_dir}
+        with open(self.sidecar + ".partial", "w") as f:
+            f.write(json.dumps({"algorithm": "SHA-512", "files": files}, indent=2, sort_keys=True))
+        os.replace(self.sidecar + ".partial", self.sidecar)
@@ -0,0 +1,221 @@
+"""
+Byte-range chunk indexes of L4 netCDF4 products, for remote clients that read chunks directly
+
+Example:
+    python chunk_index.py /path/to/<granule> --verify
+"""
+
+import argparse
+import glob
+import json
+import os
+import zlib
+
+import h5py
+import numpy as np
+from netCDF4 import Dataset
+
+
+# HDF5 filter ids the index readers understand
+H5Z_FILTER_DEFLATE = 1
+H5Z_FILTER_SHUFFLE = 2
+# Registered id of the zstd plugin, written by netCDF4 for compression='zstd'
+H5Z_FILTER_ZSTD = 32015
+SUPPORTED_FILTERS = {H5Z_FILTER_DEFLATE, H5Z_FILTER_SHUFFLE, H5Z_FILTER_ZSTD}
+
+# Coordinate variables whose values are written into the index
+INDEX_COORDINATES = ['lat', 'lon', 'time', 'lev', 'bins', 'mineral']
+
+
+def index_path(nc_path):
+    """ Path of the chunk index of a netCDF file """
+    return nc_path[:-len('.nc')] + '.index.json' if nc_path.endswith('.nc') else nc_path + '.index.json'
+
+
+def dataset_filters(dset):
+    """ Filter pipeline of an HDF5 dataset, in the order the filters are applied on write """
+    plist = dset.id.get_create_plist()
+    filters = []
+    for _f in range(plist.get_nfilters()):
+        code, _, values, name = plist.get_filter(_f)
+        filters.append({'id': int(code), 'name': name.decode() if isinstance(name, bytes) else str(name),
+                        'values': [int(v) for v in values]})
+    return filters
+
+
+def dataset_chunks(dset):
+    """ Byte ranges of the stored chunks of an HDF5 dataset
+    Returns:
+        dictionary of '<i>.<j>...' chunk grid keys to [offset, length] or [offset, length, filter_mask] when some
+        filters were skipped for the chunk
+    """
+    if dset.chunks is None:
+        offset = dset.id.get_offset()
+        if offset is None:
+            return {}
+        return {'.'.join(['0'] * dset.ndim) or '0': [int(offset), int(dset.id.get_storage_size())]}
+
+    chunks = {}
+    for _c in range(dset.id.get_num_chunks()):
+        info = dset.id.get_chunk_info(_c)
+        key = '.'.join(str(start // length) for start, length in zip(info.chunk_offset, dset.chunks))
+        entry = [int(info.byte_offset), int(info.size)]
+        if info.filter_mask:
+            entry.append(int(info.filter_mask))
+        chunks[key] = entry
+    return chunks
+
+
+def build_index(nc_path):
+    """ Chunk index of a netCDF4 file
+    Args:
+        nc_path: path of the netCDF4 file
+
+    Returns:
+        dictionary with the file size, the coordinate values and, per variable (with its group path), the
+        dimensions, shape, dtype, chunk shape, fill value, filters and chunk byte ranges
+    """
+    index = {'file': os.path.basename(nc_path), 'size': os.path.getsize(nc_path), 'format': 'NETCDF-4',
+             'coordinates': {}, 'variables': {}}
+
+    nc_ds = Dataset(nc_path, 'r')
+    h5 = h5py.File(nc_path, 'r')
+    try:
+        for name in INDEX_COORDINATES:
+            if name in nc_ds.variables:
+                index['coordinates'][name] = np.asarray(nc_ds.variables[name][:]).tolist()
+
+        groups = [('', nc_ds)]
+        while groups:
+            path, group = groups.pop(0)
+            groups += [(f'{path}{name}/', sub) for name, sub in group.groups.items()]
+            for name, nc_var in group.variables.items():
+                # Variable length strings live in the global heap, their values are in the coordinates instead
+                if nc_var.ndim == 0 or nc_var.dtype is str:
+                    continue
+                dset = h5[path + name]
+                filters = dataset_filters(dset)
+                # An index clients can't decode is worse than none, so it is never written
+                unsupported = [f'{filt["name"]} ({filt["id"]})' for filt in filters
+                               if filt['id'] not in SUPPORTED_FILTERS]
+                if unsupported:
+                    raise ValueError(f'Unsupported filters {", ".join(unsupported)} of {path + name} in {nc_path}')
+                fill_value = dset.fillvalue
+                index['variables'][path + name] = {
+                    'dimensions': list(nc_var.dimensions),
+                    'shape': list(dset.shape),
+                    'dtype': dset.dtype.str,
+                    'chunk_shape': list(dset.chunks if dset.chunks is not None else dset.shape),
+                    'fill_value': fill_value.item() if isinstance(fill_value, np.generic) else fill_value,
+                    'filters': filters,
+                    'chunks': dataset_chunks(dset),
+                }
+    finally:
+        h5.close()
+        nc_ds.close()
+    return index
+
+
+def write_index(nc_path, output_file=None):
+    """ Atomically write the chunk index of a netCDF4 file next to it, or to output_file """
+    output_file = index_path(nc_path) if output_file is None else output_file
+    index = build_index(nc_path)
+    with open(output_file + '.partial', 'w') as f:
+        f.write(json.dumps(index, separators=(',', ':')))
+    os.replace(output_file + '.partial', output_file)
+    return output_file
+
+
+def index_is_current(nc_path):
+    """ Check whether the chunk index of a netCDF4 file exists and is newer than the file """
+    path = index_path(nc_path)
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(nc_path)
+
+
+def read_chunk(f, variable, key):
+    """ Read and decode a single chunk with a plain byte-range read, as a remote client would
+    Args:
+        f: open binary file of the netCDF4 file
+        variable: variable entry of the index
+        key: chunk grid key
+
+    Returns:
+        array of the full chunk shape
+    """
+    entry = variable['chunks'][key]
+    offset, length = entry[:2]
+    filter_mask = entry[2] if len(entry) > 2 else 0
+    f.seek(offset)
+    data = f.read(length)
+
+    dtype = np.dtype(variable['dtype'])
+    # Filters are undone in the reverse order they were applied
+    for _f, filt in reversed(list(enumerate(variable['filters']))):
+        if filter_mask & (1 << _f):
+            continue
+        if filt['id'] == H5Z_FILTER_DEFLATE:
+            data = zlib.decompress(data)
+        elif filt['id'] == H5Z_FILTER_SHUFFLE:
+            data = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.tobytes()
+        elif filt['id'] == H5Z_FILTER_ZSTD:
+            # Imported here, so indexes without zstd chunks don't need numcodecs (installed with zarr)
+            from numcodecs import Zstd
+            data = Zstd().decode(data)
+        else:
+            raise ValueError(f'Unsupported filter {filt["name"]} ({filt["id"]})')
+    return np.frombuffer(data, dtype=dtype).reshape(variable['chunk_shape'])
+
+
+def verify_index(nc_path):
+    """ Compare every chunk read through the index against the same region read through netCDF4
+    Returns:
+        number of chunks verified
+    """
+    with open(index_path(nc_path)) as f:
+        index = json.load(f)
+
+    nc_ds = Dataset(nc_path, 'r')
+    nc_ds.set_auto_mask(False)
+    count = 0
+    try:
+        with open(nc_path, 'rb') as f:
+            for name, variable in index['variables'].items():
+                nc_var = nc_ds[name]
+                for key in variable['chunks']:
+                    start = [int(i) * length for i, length in zip(key.split('.'), variable['chunk_shape'])]
+                    slices = tuple(slice(s, min(s + length, size))
+                                   for s, length, size in zip(start, variable['chunk_shape'], variable['shape']))
+                    expected = nc_var[slices]
+                    chunk = read_chunk(f, variable, key)[tuple(slice(0, n) for n in np.shape(expected))]
+                    if not np.array_equal(chunk, expected):
+                        raise ValueError(f'Chunk {key} of {name} in {nc_path} does not match its index')
+                    count += 1
+    finally:
+        nc_ds.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write byte-range chunk indexes of L4 netCDF4 products')
+    parser.add_argument('paths', nargs='+', help='netCDF files or granule directories')
+    parser.add_argument('--force', action='store_true', help='Rewrite indexes that are newer than their file')
+    parser.add_argument('--verify', action='store_true',
+                        help='Read every chunk back through the index and compare it against netCDF4')
+    args = parser.parse_args()
+
+    nc_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            nc_paths += sorted(glob.glob(os.path.join(path, '*.nc')))
+        else:
+            nc_paths.append(path)
+
+    for nc_path in nc_paths:
+        if args.force or not index_is_current(nc_path):
+            print(f'Wrote {write_index(nc_path)}')
+        if args.verify:
+            print(f'Verified {verify_index(nc_path)} chunks of {nc_path}')
+
+
+if __name__ == "__main__":
+    main()
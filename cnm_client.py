@@ -0,0 +1,204 @@
+"""
+In-process submission of CNM notifications to the DAAC, in batches with retries
+
+Backends:
+    sqs      the DAAC submission queue, through boto3
+    file     a local JSON lines file, one message per line, for testing
+    sqlite   a local SQLite queue, for testing
+    dry_run  prints the messages without sending them
+"""
+
+import datetime
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+# Limits of a single SQS SendMessageBatch call
+SQS_BATCH_ENTRIES = 10
+SQS_BATCH_BYTES = 256 * 1024
+
+CNM_BACKENDS = ['sqs', 'file', 'sqlite', 'dry_run']
+
+
+class SQSBackend:
+    """ Sends messages to an SQS queue with SendMessageBatch """
+
+    def __init__(self, queue_url, profile=None):
+        # Imported here, so deliveries to a local queue don't need boto3
+        import boto3
+        self.queue_url = queue_url
+        # Queue URLs look like https://sqs.<region>.amazonaws.com/<account>/<queue>
+        region = re.match(r'https://sqs\.([a-z0-9-]+)\.amazonaws\.com', queue_url)
+        session = boto3.Session(profile_name=profile)
+        self._client = session.client('sqs', region_name=region.group(1) if region else None)
+
+    def send_batch(self, bodies):
+        """ Send up to SQS_BATCH_ENTRIES message bodies
+        Returns:
+            dictionary of the index of each message to its result - the message id, or an error with whether
+            sending it again may succeed
+        """
+        response = self._client.send_message_batch(
+            QueueUrl=self.queue_url, Entries=[{'Id': str(_b), 'MessageBody': body} for _b, body in enumerate(bodies)])
+        results = {}
+        for entry in response.get('Successful', []):
+            results[int(entry['Id'])] = {'message_id': entry['MessageId']}
+        for entry in response.get('Failed', []):
+            # Sender faults, e.g. a malformed message, fail again however often they are retried
+            results[int(entry['Id'])] = {'error': f"{entry.get('Code')}: {entry.get('Message')}",
+                                         'retry': not entry.get('SenderFault', False)}
+        return results
+
+
+class FileQueueBackend:
+    """ Appends messages to a local JSON lines file, a stand-in for the DAAC queue when testing """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send_batch(self, bodies):
+        with self._lock, open(self.path, 'a') as f:
+            offset = f.tell()
+            for body in bodies:
+                f.write(body + '\n')
+        return {_b: {'message_id': f'{self.path}:{offset}:{_b}'} for _b in range(len(bodies))}
+
+    def messages(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+class SQLiteQueueBackend:
+    """ Inserts messages into a local SQLite queue, a stand-in for the DAAC queue when testing """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                       'identifier TEXT, body TEXT, sent TEXT)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def send_batch(self, bodies):
+        sent = datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        results = {}
+        db = self._connect()
+        try:
+            # One transaction per batch, so a batch is queued whole or not at all
+            with db:
+                for _b, body in enumerate(bodies):
+                    cursor = db.execute('INSERT INTO messages (identifier, body, sent) VALUES (?, ?, ?)',
+                                        (json.loads(body).get('identifier'), body, sent))
+                    results[_b] = {'message_id': str(cursor.lastrowid)}
+        finally:
+            db.close()
+        return results
+
+    def messages(self):
+        db = self._connect()
+        try:
+            return [json.loads(body) for body, in db.execute('SELECT body FROM messages ORDER BY id')]
+        finally:
+            db.close()
+
+
+class DryRunBackend:
+    """ Prints the messages instead of sending them """
+
+    def send_batch(self, bodies):
+        for body in bodies:
+            print(f"Dry run, not submitting CNM notification {json.loads(body).get('identifier')}")
+        return {_b: {'message_id': 'dry-run'} for _b in range(len(bodies))}
+
+
+def make_backend(name, config, queue_path=None):
+    """ Notification backend by name
+    Args:
+        name: one of CNM_BACKENDS
+        config: workflow manager configuration, with the DAAC submission queue URL and AWS profile
+        queue_path: path of the local queue, for the file and sqlite backends
+    """
+    if name == 'sqs':
+        return SQSBackend(config['daac_submission_url_forward'], config.get('aws_profile'))
+    if name in ('file', 'sqlite'):
+        if queue_path is None:
+            raise ValueError(f'The {name} CNM backend needs a queue path')
+        return FileQueueBackend(queue_path) if name == 'file' else SQLiteQueueBackend(queue_path)
+    if name == 'dry_run':
+        return DryRunBackend()
+    raise ValueError(f'Unknown CNM backend {name}, expected one of {CNM_BACKENDS}')
+
+
+class CNMClient:
+    """ Submits CNM notifications in batches, retrying failed messages with exponential backoff """
+
+    def __init__(self, backend, retries=3, backoff_seconds=1., batch_entries=SQS_BATCH_ENTRIES,
+                 batch_bytes=SQS_BATCH_BYTES):
+        self.backend = backend
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.batch_entries = batch_entries
+        self.batch_bytes = batch_bytes
+
+    def batches(self, bodies):
+        """ Split message bodies into batches within the entry and size limits of a batch call """
+        batch, nbytes = [], 0
+        for body in bodies:
+            size = len(body.encode('utf-8'))
+            if size > self.batch_bytes:
+                raise ValueError(f'CNM notification of {size} bytes exceeds the {self.batch_bytes} byte limit')
+            if batch and (len(batch) == self.batch_entries or nbytes + size > self.batch_bytes):
+                yield batch
+                batch, nbytes = [], 0
+            batch.append(body)
+            nbytes += size
+        if batch:
+            yield batch
+
+    def send_with_retries(self, bodies):
+        """ Send one batch, sending the messages that failed again after a backoff
+        Returns:
+            list of results in message order, each with a message_id or an error
+        """
+        results = [None] * len(bodies)
+        pending = list(range(len(bodies)))
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+            try:
+                sent = self.backend.send_batch([bodies[_p] for _p in pending])
+            except Exception as e:
+                # Connection and throttling errors fail the whole call
+                sent = {_i: {'error': str(e), 'retry': True} for _i in range(len(pending))}
+            retry = []
+            for _i, _p in enumerate(pending):
+                results[_p] = sent.get(_i, {'error': 'No result returned for the message', 'retry': True})
+                if results[_p].get('retry'):
+                    retry.append(_p)
+            pending = retry
+            if len(pending) == 0:
+                break
+        return results
+
+    def submit(self, notifications):
+        """ Submit CNM notifications
+        Args:
+            notifications: list of CNM notification dictionaries
+
+        Returns:
+            dictionary of each notification identifier to its result, a message_id or an error
+        """
+        bodies = [json.dumps(notification) for notification in notifications]
+        results = []
+        for batch in self.batches(bodies):
+            results += self.send_with_retries(batch)
+        return {notification['identifier']: {k: v for k, v in result.items() if k != 'retry'}
+                for notification, result in zip(notifications, results)}
@@ -0,0 +1,198 @@
+"""
+Long-running L4 conversion worker.  Converts each source ESM file as it arrives in a watched directory or is listed
+in a queue file, keeping the imports, naming tables, metadata templates and worker processes warm between files
+
+Example:
+    python conversion_worker.py --watch_dir /path/to/incoming --output_dir /path/to/granules --workers 4
+    python conversion_worker.py --queue_file /path/to/queue.txt --once --output_dir /path/to/granules
+
+Any argument the worker doesn't know is passed on to netcdf_conversion_template.py for every file.
+"""
+
+import argparse
+import fnmatch
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from netcdf_conversion_template import conversion_parser, convert_granule, epsg_wkt, read_table
+
+
+def warm_up(model_lookup, l4_naming_file):
+    """ Load what every conversion needs up front, in the worker and in each of its processes """
+    read_table(model_lookup)
+    read_table(l4_naming_file)
+    epsg_wkt(4326)
+
+
+def make_pool(conversion_args):
+    """ Process pool shared by the conversions, or None to convert the products in the worker itself """
+    if conversion_args.workers <= 1:
+        return None
+    # Spawn rather than fork, so no HDF5 library state is shared with the workers
+    return ProcessPoolExecutor(max_workers=conversion_args.workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=warm_up,
+                               initargs=(conversion_args.model_lookup, conversion_args.l4_naming_file))
+
+
+def file_state(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class DirectoryWatcher:
+    """ Finds source files in a directory that are known to the model lookup.  A file is only handed out once its
+    size and modification time held still over a poll, so files that are still being copied in are left alone """
+
+    def __init__(self, watch_dir, pattern, model_lookup):
+        self.watch_dir = watch_dir
+        self.pattern = pattern
+        self.model_lookup = model_lookup
+        self._pending = {}
+        self._ignored = set()
+
+    def poll(self):
+        input_filenames = set(read_table(self.model_lookup)['Input Filename'])
+        ready = []
+        for name in sorted(os.listdir(self.watch_dir)):
+            path = os.path.join(self.watch_dir, name)
+            if not fnmatch.fnmatch(name, self.pattern) or not os.path.isfile(path):
+                continue
+            if name not in input_filenames:
+                if name not in self._ignored:
+                    print(f'Ignoring {path}, it is not listed in {self.model_lookup}')
+                    self._ignored.add(name)
+                continue
+            state = file_state(path)
+            if self._pending.get(path) == state:
+                ready.append(path)
+            self._pending[path] = state
+        return ready
+
+
+class QueueReader:
+    """ Reads source file paths appended to a queue file, one per line.  Blank lines and lines starting with # are
+    skipped, and a line is only read once it is complete """
+
+    def __init__(self, queue_file):
+        self.queue_file = queue_file
+        self._offset = 0
+        self._paths = []
+
+    def poll(self):
+        if os.path.exists(self.queue_file):
+            with open(self.queue_file) as f:
+                f.seek(self._offset)
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    self._offset += len(line.encode())
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        self._paths.append(line)
+        ready = [path for path in self._paths if os.path.exists(path)]
+        for path in [path for path in self._paths if not os.path.exists(path)]:
+            print(f'Skipping {path} from {self.queue_file}, it does not exist')
+        self._paths = []
+        return ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert source ESM files as they arrive, with the conversion kept '
+                                                 'warm between files')
+    parser.add_argument('--watch_dir', default=None, help='Convert the source files that arrive in this directory')
+    parser.add_argument('--queue_file', default=None, help='Convert the source files listed in this file, one per line')
+    parser.add_argument('--pattern', default='*.nc', help='File name pattern of the source files in the watch_dir')
+    parser.add_argument('--poll_seconds', type=float, default=10.,
+                        help='Seconds between looks at the watch_dir or queue_file')
+    parser.add_argument('--once', action='store_true',
+                        help='Convert the files found in one look at the watch_dir or queue_file, then exit')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Times a file whose conversion failed is tried again, one poll later each time')
+    args, conversion_argv = parser.parse_known_args()
+    if (args.watch_dir is None) == (args.queue_file is None):
+        parser.error('Give exactly one of --watch_dir and --queue_file')
+
+    # The conversion arguments are checked once here, and parsed again for each file with its input path
+    conversion_args = conversion_parser().parse_args(conversion_argv + ['input_file'])
+    start_time = time.time()
+    warm_up(conversion_args.model_lookup, conversion_args.l4_naming_file)
+    pool = make_pool(conversion_args)
+    print(f'Conversion worker ready in {time.time() - start_time:.1f} s')
+
+    if args.watch_dir is not None:
+        source = DirectoryWatcher(args.watch_dir, args.pattern, conversion_args.model_lookup)
+    else:
+        source = QueueReader(args.queue_file)
+
+    # Finish the file at hand on SIGTERM/SIGINT, then exit
+    stopping = threading.Event()
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda *_: stopping.set())
+
+    # Files are converted again only if they change; the granule manifests skip products that are already complete
+    converted = {}
+    # Failed files with their state and number of attempts, retried up to --retries times unless they change
+    failures = {}
+
+    def retrying():
+        return [path for path, (_, attempts) in failures.items() if attempts <= args.retries and os.path.exists(path)]
+
+    converted_count = 0
+    failed_count = 0
+    try:
+        while not stopping.is_set():
+            # A directory file has to hold still over two looks, so --once looks twice
+            if args.once and args.watch_dir is not None:
+                source.poll()
+            # The queue hands out a path only once, so its failed files are listed again here
+            for input_file in dict.fromkeys(source.poll() + retrying()):
+                if stopping.is_set():
+                    break
+                state = file_state(input_file)
+                if args.queue_file is None and converted.get(input_file) == state:
+                    continue
+                failed_state, attempts = failures.get(input_file, (None, 0))
+                if failed_state != state:
+                    attempts = 0
+                elif attempts > args.retries:
+                    continue
+                file_start_time = time.time()
+                print(f'Converting {input_file}')
+                try:
+                    output_dir = convert_granule(conversion_parser().parse_args(conversion_argv + [input_file]), pool)
+                except BrokenProcessPool:
+                    traceback.print_exc()
+                    print(f'Failed to convert {input_file}, restarting the worker processes')
+                    pool.shutdown(wait=False)
+                    pool = make_pool(conversion_args)
+                except Exception:
+                    traceback.print_exc()
+                    print(f'Failed to convert {input_file}')
+                else:
+                    converted_count += 1
+                    print(f'Converted {input_file} to {output_dir} in {time.time() - file_start_time:.1f} s')
+                    converted[input_file] = state
+                    failures.pop(input_file, None)
+                    continue
+                failures[input_file] = (state, attempts + 1)
+                if attempts + 1 > args.retries:
+                    failed_count += 1
+                    print(f'Giving up on {input_file} after {attempts + 1} attempt(s), until it changes')
+            if args.once and not retrying():
+                break
+            stopping.wait(args.poll_seconds)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(f'Conversion worker stopping, {converted_count} file(s) converted and {failed_count} failed in '
+          f'{time.time() - start_time:.1f} s')
+
+
+if __name__ == "__main__":
+    main()
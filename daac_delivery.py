@@ -7,16 +7,22 @@ Author: Winston Olson-Duvall, winston.olson-duvall@jpl.nasa.gov
 import argparse
 import datetime
 import glob
-import hashlib
 import json
 import os
 import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 from emit_main.workflow.workflow_manager import WorkflowManager
 
+from checksums import ChecksumCache, calc_checksum, sidecar_path
+from cnm_client import CNM_BACKENDS, CNMClient, make_backend
+from instrumentation import active_recorder, monitor, recording, stage, write_report
+
 
 def initialize_ummg(granule_name: str, creation_time: datetime, collection_name: str, collection_version: str,
                     start_year:str, end_year: str, pge_name: str, pge_version: str,
@@ -92,23 +98,13 @@ def initialize_ummg(granule_name: str, creation_time: datetime, collection_name:
     return ummg
 
 
-def calc_checksum(path, hash_alg="sha512"):
-    checksum = {}
-    if hash_alg.lower() == "sha512":
-        h = hashlib.sha512()
-    with open(path, "rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            h.update(byte_block)
-    return h.hexdigest()
-
-
-def add_data_files_ummg(ummg: dict, paths: list, daynight: str):
+def add_data_files_ummg(ummg: dict, paths: list, daynight: str, checksums: ChecksumCache = None):
     """
     Add boundary points list to UMMG in correct format
     Args:
         ummg: existing UMMG to augment
         paths: list of paths to existing data files to add
+        checksums: optional checksum cache, shared with the CNM notification
 
     Returns:
         dictionary representation of ummg with new data granule
@@ -122,13 +118,17 @@ def add_data_files_ummg(ummg: dict, paths: list, daynight: str):
 
     archive_info = []
     for path in paths:
-        fileformat = "PNG" if path.endswith(".png") else "NETCDF-4"
+        fileformat = "NETCDF-4"
+        if path.endswith(".png"):
+            fileformat = "PNG"
+        if path.endswith(".index.json"):
+            fileformat = "JSON"
         archive_info.append({
                              "Name": os.path.basename(path),
                              "SizeInBytes": os.path.getsize(path),
                              "Format": fileformat,
                              "Checksum": {
-                                 'Value': calc_checksum(path),
+                                 'Value': calc_checksum(path) if checksums is None else checksums.checksum(path),
                                  'Algorithm': 'SHA-512'
                                  }
                             })
@@ -157,39 +157,101 @@ class SerialEncoder(json.JSONEncoder):
             return super(SerialEncoder, self).default(obj)
 
 
-def stage_files(wm, paths):
-    # Copy files to staging server
-    daac_partial_dir = os.path.join(wm.config["daac_base_dir"], wm.config['environment'], "partial_transfers")
-    partial_dir_arg = f"--partial-dir={daac_partial_dir}"
-    daac_staging_dir = os.path.join(wm.config["daac_base_dir"], wm.config['environment'], "products", "l4")
-    target = f"{wm.config['daac_server_internal']}:{daac_staging_dir}/"
-    group = f"emit-{wm.config['environment']}" if wm.config["environment"] in ("test", "ops") else "emit-dev"
-    # This command only makes the directory and changes ownership if the directory doesn't exist
-    cmd_make_target = ["ssh", wm.config["daac_server_internal"], "\"if", "[", "!", "-d",
-                       f"'{daac_staging_dir}'", "];", "then", "mkdir", f"{daac_staging_dir};", "chgrp",
-                       group, f"{daac_staging_dir};", "fi\""]
-    # print(f"cmd_make_target: {' '.join(cmd_make_target)}")
-    output = subprocess.run(" ".join(cmd_make_target), shell=True, capture_output=True)
-    if output.returncode != 0:
+# Reuse one authenticated ssh connection for the directory check and every rsync of a delivery
+SSH_MULTIPLEX_OPTIONS = ["-o", "ControlMaster=auto", "-o", "ControlPath=~/.ssh/emit-l4-%r@%h:%p",
+                         "-o", "ControlPersist=300"]
+
+# Files at least this large get their own rsync stream when staging with several streams
+STAGE_LARGE_FILE_BYTES = 256 * 1024 * 1024
+
+
+def rsync_files(files, destination, rsync_args, retries=2):
+    """ Copy files to a destination directory with a single rsync, retrying failed files one at a time
+    Args:
+        files: list of local paths
+        destination: rsync destination directory, local or host:path, ending in /
+        rsync_args: extra rsync arguments
+        retries: number of retries of each file after a failed batch
+    """
+    with stage("rsync", sum(os.path.getsize(p) for p in files)):
+        output = subprocess.run(["rsync", "-av"] + rsync_args + list(files) + [destination], capture_output=True)
+    if output.returncode == 0:
+        return
+    if retries <= 0:
         raise RuntimeError(output.stderr.decode("utf-8"))
 
-    # files is a list of local paths
-    for p in paths:
-        cmd_rsync = ["rsync", "-av", partial_dir_arg, p, target + os.path.basename(p)]
-        # print(f"rsync cmd: {' '.join(cmd_rsync)}")
-        output = subprocess.run(" ".join(cmd_rsync), shell=True, capture_output=True)
+    # rsync skips files that already made it, so retrying file by file only resends the failed ones
+    for p in files:
+        for attempt in range(retries):
+            time.sleep(2 ** attempt)
+            with stage("rsync_retry", os.path.getsize(p)):
+                output = subprocess.run(["rsync", "-av"] + rsync_args + [p, destination], capture_output=True)
+            if output.returncode == 0:
+                break
+        if output.returncode != 0:
+            raise RuntimeError(output.stderr.decode("utf-8"))
+
+
+def stage_files(wm, paths, local_dir=None, streams=1, retries=2):
+    """ Copy a granule's files to the staging server, or to a local directory
+    Args:
+        wm: workflow manager, providing the DAAC server configuration
+        paths: list of local paths to stage
+        local_dir: optional local directory to stage to instead of the DAAC server
+        streams: number of parallel rsync streams, large NetCDF files get a stream of their own
+        retries: number of retries of each file after a failed transfer
+    """
+    if local_dir is not None:
+        os.makedirs(local_dir, exist_ok=True)
+        target = os.path.join(local_dir, "")
+        rsync_args = ["--partial-dir=.rsync-partial"]
+    else:
+        # Copy files to staging server
+        daac_partial_dir = os.path.join(wm.config["daac_base_dir"], wm.config['environment'], "partial_transfers")
+        partial_dir_arg = f"--partial-dir={daac_partial_dir}"
+        daac_staging_dir = os.path.join(wm.config["daac_base_dir"], wm.config['environment'], "products", "l4")
+        target = f"{wm.config['daac_server_internal']}:{daac_staging_dir}/"
+        group = f"emit-{wm.config['environment']}" if wm.config["environment"] in ("test", "ops") else "emit-dev"
+        # This command only makes the directory and changes ownership if the directory doesn't exist
+        cmd_make_target = ["ssh"] + SSH_MULTIPLEX_OPTIONS + [
+            wm.config["daac_server_internal"],
+            f"if [ ! -d '{daac_staging_dir}' ]; then mkdir {daac_staging_dir}; chgrp {group} {daac_staging_dir}; fi"]
+        # print(f"cmd_make_target: {' '.join(cmd_make_target)}")
+        output = subprocess.run(cmd_make_target, capture_output=True)
         if output.returncode != 0:
             raise RuntimeError(output.stderr.decode("utf-8"))
+        rsync_args = [partial_dir_arg, "-e", " ".join(["ssh"] + SSH_MULTIPLEX_OPTIONS)]
+
+    # One rsync for all the small files, plus one per large NetCDF file when running several streams
+    batches = [list(paths)]
+    if streams > 1:
+        large = [p for p in paths if p.endswith(".nc") and os.path.getsize(p) >= STAGE_LARGE_FILE_BYTES]
+        batches = [[p] for p in large] + [[p for p in paths if p not in large]]
+    batches = [batch for batch in batches if len(batch) > 0]
 
+    # rsync time is recorded by the caller's recorder, if it has one
+    recorder = active_recorder()
 
-def submit_cnm_notification(wm, granule_ur, paths, collection, collection_version):
+    def stage_batch(batch):
+        with recording(recorder):
+            rsync_files(batch, target, rsync_args, retries)
+
+    with ThreadPoolExecutor(max_workers=max(streams, 1)) as pool:
+        for future in [pool.submit(stage_batch, batch) for batch in batches]:
+            future.result()
+
+
+def build_cnm_notification(wm, granule_ur, paths, collection, collection_version, checksums=None):
+    """ Build the CNM notification of a granule, and keep a copy of it next to the granule files
+    Returns:
+        the notification and the path of its copy
+    """
     # Build notification dictionary
     utc_now = datetime.datetime.now(tz=datetime.timezone.utc)
     cnm_submission_id = f"{granule_ur}_{utc_now.strftime('%Y%m%dt%H%M%S')}"
     cnm_submission_path = os.path.join(os.path.dirname(paths[0]), cnm_submission_id + "_cnm.json")
     # TODO: Use S3 provider?
     provider = wm.config["daac_provider_forward"]
-    queue_url = wm.config["daac_submission_url_forward"]
 
     notification = {
         "collection": collection,
@@ -218,7 +280,7 @@ def submit_cnm_notification(wm, granule_ur, paths, collection, collection_versio
                 "type": format,
                 "size": os.path.getsize(p),
                 "checksumType": "sha512",
-                "checksum": calc_checksum(p, "sha512")
+                "checksum": calc_checksum(p, "sha512") if checksums is None else checksums.checksum(p)
             }
         )
 
@@ -228,52 +290,84 @@ def submit_cnm_notification(wm, granule_ur, paths, collection, collection_versio
         p.write(json.dumps(notification, indent=4))
     wm.change_group_ownership(cnm_submission_path)
 
-    # Submit notification via AWS SQS
-    print(f"Submitting CNM notification via AWS SQS")
+    return notification, cnm_submission_path
+
+
+def record_cnm_result(cnm_submission_path, result):
+    """ Write the result of a submission next to the notification, and raise if it failed """
     cnm_submission_output = cnm_submission_path.replace(".json", ".out")
-    cmd_aws = [wm.config["aws_cli_exe"], "sqs", "send-message", "--queue-url", queue_url, "--message-body",
-               f"file://{cnm_submission_path}", "--profile", wm.config["aws_profile"], ">", cnm_submission_output]
-    # print(f"cmd_aws: {' '.join(cmd_aws)}")
-    output = subprocess.run(" ".join(cmd_aws), shell=True, capture_output=True)
-    if output.returncode != 0:
-        raise RuntimeError(output.stderr.decode("utf-8"))
+    with open(cnm_submission_output, "w") as f:
+        f.write(json.dumps(result, indent=4))
+    if "error" in result:
+        raise RuntimeError(f"CNM notification {os.path.basename(cnm_submission_path)} failed: {result['error']}")
 
 
-def main():
-    # Set up args
-    parser = argparse.ArgumentParser(description="Deliver L4 products to LP DAAC")
-    parser.add_argument("path", help="The path to the directory of the granule to be delivered.")
-    parser.add_argument("--env", default="ops", help="The operating environment - dev, test, ops")
-    parser.add_argument("--collection_version", default="001", help="The DAAC collection version")
-    parser.add_argument('--model_lookup', default='data/models.csv')
-    args = parser.parse_args()
+def submit_cnm_notification(wm, granule_ur, paths, collection, collection_version, checksums=None, client=None):
+    """ Build the CNM notification of a granule and submit it
+    Args:
+        client: CNM client to submit with, one for the DAAC SQS queue if not given
+    """
+    notification, cnm_submission_path = build_cnm_notification(wm, granule_ur, paths, collection,
+                                                               collection_version, checksums)
+    if client is None:
+        client = CNMClient(make_backend("sqs", wm.config))
 
-    # Get workflow manager and ghg config options
-    sds_config_path = f"/store/emit/{args.env}/repos/emit-main/emit_main/config/{args.env}_sds_config.json"
+    print(f"Submitting CNM notification via {type(client.backend).__name__}")
+    with stage("cnm_submit"):
+        result = client.submit([notification])[notification["identifier"]]
+    record_cnm_result(cnm_submission_path, result)
 
-    # Get the current emit-sds-l4 version
-    cmd = ["git", "symbolic-ref", "-q", "--short", "HEAD", "||", "git", "describe", "--tags", "--exact-match"]
-    output = subprocess.run(" ".join(cmd), shell=True, capture_output=True)
-    if output.returncode != 0:
-        raise RuntimeError(output.stderr.decode("utf-8"))
-    repo_version = output.stdout.decode("utf-8").replace("\n", "")
 
-    l4_config = {
-        "collection_version": args.collection_version,
-        "repo_name": "emit-sds-l4",
-        "repo_version": repo_version,
-        "doi": f"10.5067/EMIT/EMITL4ESM.{args.collection_version}"
-    }
+def submit_cnm_batch(cnm_client, cnm_batch, results):
+    """ Submit the notifications of a batch of delivered granules, and mark the granules whose notification failed
+    Args:
+        cnm_client: CNM client to submit the notifications with
+        cnm_batch: list of (notification, path of its copy) tuples, as built by deliver_granule
+        results: dictionary of each granule path to its (status, timings, error) summary, updated in place
+    """
+    start_time = time.time()
+    print(f"Submitting {len(cnm_batch)} CNM notifications via {type(cnm_client.backend).__name__}")
+    try:
+        cnm_results = cnm_client.submit([notification for notification, _ in cnm_batch])
+    except Exception as e:
+        # Nothing is known about which notifications went out, so every granule of the batch is reported as failed
+        print(f"CNM batch submission failed: {e}")
+        cnm_results = {notification["identifier"]: {"error": str(e)} for notification, _ in cnm_batch}
+    elapsed = time.time() - start_time
+    granule_paths_by_ur = {os.path.basename(os.path.normpath(path)): path for path in results}
+    for notification, cnm_submission_path in cnm_batch:
+        path = granule_paths_by_ur[notification["product"]["name"]]
+        _, timings, _ = results[path]
+        timings["cnm_batch"] = elapsed
+        try:
+            record_cnm_result(cnm_submission_path, cnm_results[notification["identifier"]])
+        except Exception as e:
+            results[path] = ("failed", timings, str(e))
+
+
+def deliver_granule(path, df, l4_config, wm, args, cnm_client=None, cnm_batch=None):
+    """ Build the UMM-G and CNM notification of one granule and stage its files
+    Args:
+        path: granule directory
+        df: model lookup table
+        l4_config: collection and software version configuration
+        wm: workflow manager
+        args: parsed command line arguments
+        cnm_client: CNM client to submit the notification with
+        cnm_batch: if given, a list to add the notification and the path of its copy to, for the caller to submit
+                   together with those of other granules, instead of submitting it here
 
-    print(f"Using sds_config_path: {sds_config_path}")
-    print(f"Using l4_config: {l4_config}")
-    print(f"Publishing granule at path: {args.path}")
+    Returns:
+        dictionary of elapsed seconds per delivery stage
+    """
+    timings = {}
+    granule_start_time = time.time()
+    print(f"Publishing granule at path: {path}")
 
     # Example granule_ur: EMIT_L4_ESM_001_CESM_1.0-1.0-05_EMIT001-B_MER_2007-2011_SSP2-4.5
     # See https://github.com/emit-sds/emit-sds-l4/blob/main/README.md for description of fields
     collection = "EMITL4ESM"
-    granule_ur = os.path.basename(args.path)
-    df = pd.read_csv(args.model_lookup, keep_default_na=False)
+    granule_ur = os.path.basename(os.path.normpath(path))
     row = df.loc[df["Granule Name"] == granule_ur]
     esm = row["ESM"].values[0]
     resolution = row["Resolution"].values[0]
@@ -283,17 +377,53 @@ def main():
     scenario = row["Emissions/concentration scenario"].values[0]
     vegetation = row["Vegetation for emission source mask"].values[0]
 
-    nc_paths = glob.glob(os.path.join(args.path, f"{granule_ur}*nc"))
-    browse_path = os.path.join(args.path, f"{granule_ur}.png")
-    ummg_path = os.path.join(args.path, f"{granule_ur}.cmr.json")
+    # Only products that match their source are delivered
+    if args.verify_source_dir is not None or args.require_verification:
+        # Imported here, so deliveries without verification don't need the conversion dependencies
+        import verify_conversion
+        start_time = time.time()
+        if args.verify_source_dir is not None:
+            input_file = os.path.join(args.verify_source_dir, row["Input Filename"].values[0])
+            print(f"Verifying {granule_ur} against {input_file}")
+            with stage("verify"):
+                report = verify_conversion.verify_granule(input_file, path, pd.read_csv(args.l4_naming_file),
+                                                          workers=args.verify_workers,
+                                                          max_slab_bytes=verify_conversion.DEFAULT_SLAB_MB * 1024**2)
+            write_report(verify_conversion.report_path(path, granule_ur), report)
+        passed, reason = verify_conversion.verification_passed(path, granule_ur)
+        if not passed:
+            raise RuntimeError(f"Not delivering {granule_ur}, its verification did not pass: {reason}")
+        timings["verify"] = time.time() - start_time
+
+    nc_paths = glob.glob(os.path.join(path, f"{granule_ur}*nc"))
+    browse_path = os.path.join(path, f"{granule_ur}.png")
+    ummg_path = os.path.join(path, f"{granule_ur}.cmr.json")
+    # Chunk indexes written by the converter are delivered with their files, rebuilt if a file changed since
+    index_paths = []
+    for p in nc_paths:
+        index = os.path.join(path, os.path.basename(p)[:-len(".nc")] + ".index.json")
+        if os.path.exists(index):
+            if os.path.getmtime(index) < os.path.getmtime(p):
+                import chunk_index
+                print(f"Rebuilding stale chunk index {index}")
+                chunk_index.write_index(p, index)
+            index_paths.append(index)
     if os.path.exists(browse_path):
-        paths = nc_paths + [browse_path] + [ummg_path]
+        paths = nc_paths + index_paths + [browse_path] + [ummg_path]
     else:
-        paths = nc_paths + [ummg_path]
+        paths = nc_paths + index_paths + [ummg_path]
 
     print(f"paths: {paths}")
 
+    # Checksum the data and browse files once, in parallel, for both the UMM-G and the CNM notification.  Checksums
+    # written by the converter are reused as long as the file size and mtime still match.
+    start_time = time.time()
+    checksums = ChecksumCache(sidecar_path(path, granule_ur))
+    checksums.prefetch(paths[:-1], workers=args.checksum_workers)
+    timings["checksum"] = time.time() - start_time
+
     # Create the UMM-G file
+    start_time = time.time()
     print(f"Creating ummg file at {ummg_path}")
     creation_times = []
     for p in nc_paths:
@@ -306,7 +436,7 @@ def main():
                            doi=l4_config["doi"], esm=esm, resolution=resolution,
                            in_mineralogy=in_mineralogy, ext_meteorology=ext_meteorology,
                            scenario=scenario, vegetation=vegetation)
-    ummg = add_data_files_ummg(ummg, paths[:-1], daynight)
+    ummg = add_data_files_ummg(ummg, paths[:-1], daynight, checksums=checksums)
 
     # ummg = add_boundary_ummg(ummg, acq.gring)
     # TODO: Update?
@@ -327,14 +457,159 @@ def main():
 
     with open(ummg_path, 'w', errors='ignore') as fout:
         fout.write(json.dumps(ummg, indent=2, sort_keys=False, cls=SerialEncoder))
+    timings["ummg"] = time.time() - start_time
 
     # Copy files to staging server
-    wm = WorkflowManager(config_path=sds_config_path)
+    start_time = time.time()
     print(f"Staging files to web server")
-    stage_files(wm, paths)
+    stage_files(wm, paths, local_dir=args.stage_local_dir, streams=args.stage_streams, retries=args.stage_retries)
+    timings["stage"] = time.time() - start_time
 
     # Build and submit CNM notification
-    submit_cnm_notification(wm, granule_ur, paths, collection, l4_config["collection_version"])
+    start_time = time.time()
+    if cnm_batch is not None:
+        cnm_batch.append(build_cnm_notification(wm, granule_ur, paths, collection, l4_config["collection_version"],
+                                                checksums=checksums))
+    else:
+        submit_cnm_notification(wm, granule_ur, paths, collection, l4_config["collection_version"],
+                                checksums=checksums, client=cnm_client)
+    if args.checksum_sidecar:
+        checksums.save()
+    timings["cnm"] = time.time() - start_time
+    timings["total"] = time.time() - granule_start_time
+
+    return timings
+
+
+def deliver_granule_with_report(path, df, l4_config, wm, args, cnm_client=None, cnm_batch=None):
+    """ Deliver a granule, recording its stage timings and writing <granule>.delivery_report.json if requested """
+    granule_ur = os.path.basename(os.path.normpath(path))
+    report = {}
+    try:
+        with monitor(granule_ur, profile_dir=args.profile_dir) as report:
+            timings = deliver_granule(path, df, l4_config, wm, args, cnm_client, cnm_batch)
+            report["timings"] = timings
+    except Exception as e:
+        report["error"] = str(e)
+        raise
+    finally:
+        if args.run_report:
+            # Peak RSS is that of the whole process, which is shared by the granules delivered concurrently
+            report["granule_workers"] = args.granule_workers
+            write_report(os.path.join(path, f"{granule_ur}.delivery_report.json"), report)
+    return timings
+
+
+def find_granules(base_dir, df):
+    """ Granule directories directly under base_dir that are listed in the model lookup """
+    return sorted(os.path.join(base_dir, name) for name in os.listdir(base_dir)
+                  if name in set(df["Granule Name"]) and os.path.isdir(os.path.join(base_dir, name)))
+
+
+def main():
+    # Set up args
+    parser = argparse.ArgumentParser(description="Deliver L4 products to LP DAAC")
+    parser.add_argument("path", nargs="*", help="The path to the directory of each granule to be delivered.")
+    parser.add_argument("--all_under", default=None,
+                        help="Deliver every granule of the model lookup found directly under this directory")
+    parser.add_argument("--granule_workers", type=int, default=1,
+                        help="Number of granules delivered concurrently")
+    parser.add_argument("--env", default="ops", help="The operating environment - dev, test, ops")
+    parser.add_argument("--collection_version", default="001", help="The DAAC collection version")
+    parser.add_argument('--model_lookup', default='data/models.csv')
+    parser.add_argument("--checksum_workers", type=int, default=4,
+                        help="Number of threads used to checksum the granule files")
+    parser.add_argument("--checksum_sidecar", action="store_true",
+                        help="Save the computed checksums to <granule>.checksums.json for later deliveries")
+    parser.add_argument("--stage_local_dir", default=None,
+                        help="Stage the files to this local directory instead of the DAAC server")
+    parser.add_argument("--stage_streams", type=int, default=1,
+                        help="Number of parallel rsync streams used to stage large NetCDF files")
+    parser.add_argument("--stage_retries", type=int, default=2,
+                        help="Number of retries of each file that fails to stage")
+    parser.add_argument("--run_report", action="store_true",
+                        help="Write stage timings, byte counts and peak memory to <granule>.delivery_report.json")
+    parser.add_argument("--require_verification", action="store_true",
+                        help="Only deliver granules with a passing <granule>.verification.json that covers their "
+                             "current files")
+    parser.add_argument("--verify_source_dir", default=None,
+                        help="Verify each granule against its source file in this directory before delivering it")
+    parser.add_argument("--verify_workers", type=int, default=1,
+                        help="Number of worker processes used to verify the products of a granule")
+    parser.add_argument('--l4_naming_file', default='data/L4_varnames.csv')
+    parser.add_argument("--profile_dir", default=None,
+                        help="Run each granule under cProfile and write <granule>.prof files to this directory")
+    parser.add_argument("--cnm_backend", choices=CNM_BACKENDS, default="sqs",
+                        help="Where CNM notifications are submitted - the DAAC SQS queue, a local JSON lines file or "
+                             "SQLite queue for testing, or nowhere with dry_run")
+    parser.add_argument("--cnm_queue_path", default=None,
+                        help="Path of the local queue of the file and sqlite CNM backends")
+    parser.add_argument("--cnm_retries", type=int, default=3,
+                        help="Number of retries of a CNM notification that fails to submit, with exponential backoff")
+    parser.add_argument("--batch_cnm", action="store_true",
+                        help="Submit the CNM notifications of all granules together in batches once they are staged, "
+                             "instead of one by one")
+    args = parser.parse_args()
+    if args.profile_dir is not None and args.granule_workers > 1:
+        # Only one cProfile profiler can be active in a process at a time
+        parser.error("--profile_dir needs --granule_workers 1")
+    if args.cnm_backend in ("file", "sqlite") and args.cnm_queue_path is None:
+        parser.error(f"--cnm_backend {args.cnm_backend} needs --cnm_queue_path")
+
+    # Get workflow manager and ghg config options
+    sds_config_path = f"/store/emit/{args.env}/repos/emit-main/emit_main/config/{args.env}_sds_config.json"
+
+    # Get the current emit-sds-l4 version
+    cmd = ["git", "symbolic-ref", "-q", "--short", "HEAD", "||", "git", "describe", "--tags", "--exact-match"]
+    output = subprocess.run(" ".join(cmd), shell=True, capture_output=True)
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr.decode("utf-8"))
+    repo_version = output.stdout.decode("utf-8").replace("\n", "")
+
+    l4_config = {
+        "collection_version": args.collection_version,
+        "repo_name": "emit-sds-l4",
+        "repo_version": repo_version,
+        "doi": f"10.5067/EMIT/EMITL4ESM.{args.collection_version}"
+    }
+
+    print(f"Using sds_config_path: {sds_config_path}")
+    print(f"Using l4_config: {l4_config}")
+    granule_paths = list(args.path)
+    df = pd.read_csv(args.model_lookup, keep_default_na=False)
+    if args.all_under is not None:
+        granule_paths += find_granules(args.all_under, df)
+    if len(granule_paths) == 0:
+        parser.error("No granules to deliver, give granule paths or --all_under")
+    wm = WorkflowManager(config_path=sds_config_path)
+    # One client for all granules, so the queue connection is made once
+    cnm_client = CNMClient(make_backend(args.cnm_backend, wm.config, args.cnm_queue_path), retries=args.cnm_retries)
+    cnm_batch = [] if args.batch_cnm else None
+
+    # Granules run concurrently, so UMM-G generation, checksums, staging and notification of different granules
+    # overlap.  Failures are collected for the summary instead of stopping the batch.
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(args.granule_workers, 1)) as pool:
+        futures = {path: pool.submit(deliver_granule_with_report, path, df, l4_config, wm, args, cnm_client,
+                                     cnm_batch)
+                   for path in granule_paths}
+        for path, future in futures.items():
+            try:
+                results[path] = ("delivered", future.result(), "")
+            except Exception as e:
+                results[path] = ("failed", {}, str(e))
+
+    if cnm_batch:
+        # Only staged granules get this far, their notifications go out in as few calls as the queue allows
+        submit_cnm_batch(cnm_client, cnm_batch, results)
+
+    print(f"Delivery summary:")
+    for path, (status, timings, error) in results.items():
+        fields = [status] + [f"{stage} {seconds:.1f}s" for stage, seconds in timings.items()] + [error]
+        print(f"{os.path.basename(os.path.normpath(path))}: {' '.join(fields).rstrip()}")
+    if any(status != "delivered" for status, _, _ in results.values()):
+        print("Delivery failed for some granules")
+        sys.exit(1)
 
 
 if __name__ == '__main__':
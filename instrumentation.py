@@ -0,0 +1,176 @@
+"""
+Stage timers, byte counters and memory sampling for the L4 conversion and delivery run reports
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+
+class StageRecorder:
+    """Wall time, bytes and number of calls accumulated per stage (read, transpose, write, sync, hash, rsync...).
+
+    Recorders are made active for the current thread with recording(); the module level stage() and count_bytes()
+    helpers then add to it, and do nothing while no recorder is active.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds=0., nbytes=0, calls=1):
+        with self._lock:
+            entry = self.stages.setdefault(name, {'seconds': 0., 'bytes': 0, 'calls': 0})
+            entry['seconds'] += seconds
+            entry['bytes'] += int(nbytes)
+            entry['calls'] += calls
+
+    def merge(self, stages):
+        """ Add the stages of another recorder, e.g. one returned from a worker process """
+        for name, entry in stages.items():
+            self.add(name, entry['seconds'], entry['bytes'], entry['calls'])
+
+    def to_dict(self):
+        with self._lock:
+            stages = {name: dict(entry) for name, entry in self.stages.items()}
+        for entry in stages.values():
+            if entry['bytes'] and entry['seconds'] > 0:
+                entry['mb_per_s'] = entry['bytes'] / 1024**2 / entry['seconds']
+        return stages
+
+
+_active = threading.local()
+
+
+def active_recorder():
+    return getattr(_active, 'recorder', None)
+
+
+@contextlib.contextmanager
+def recording(recorder):
+    """ Make a recorder the active one of the current thread """
+    previous = active_recorder()
+    _active.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _active.recorder = previous
+
+
+@contextlib.contextmanager
+def stage(name, nbytes=0):
+    """ Time a block as a stage of the active recorder """
+    recorder = active_recorder()
+    if recorder is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - start_time, nbytes)
+
+
+def count_bytes(name, nbytes):
+    """ Add bytes to a stage of the active recorder, for sizes only known once the stage is done """
+    recorder = active_recorder()
+    if recorder is not None:
+        recorder.add(name, nbytes=nbytes, calls=0)
+
+
+def current_rss():
+    """ Resident set size of this process in bytes, None where /proc is not available """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """ Samples the resident set size in a background thread, to find the peak over a window of time """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while True:
+            rss = current_rss()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if self.peak == 0:
+            # ru_maxrss is the peak of the whole process so far, in KiB on Linux
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextlib.contextmanager
+def monitor(name, profile_dir=None, trace_memory=False):
+    """ Record the stages, wall time and peak memory of a unit of work, e.g. one product
+    Args:
+        name: name of the unit of work, used for the profile file name
+        profile_dir: if given, run the work under cProfile and dump the statistics to <profile_dir>/<name>.prof
+        trace_memory: if True, trace Python allocations with tracemalloc and report their peak
+
+    Returns:
+        context manager yielding a report dictionary that is filled in when the block exits
+    """
+    report = {'name': name}
+    recorder = StageRecorder()
+    profiler = cProfile.Profile() if profile_dir is not None else None
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.time()
+    try:
+        with recording(recorder), RssSampler() as sampler:
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield report
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    finally:
+        report['seconds'] = time.time() - start_time
+        report['peak_rss_mb'] = sampler.peak / 1024**2
+        report['stages'] = recorder.to_dict()
+        if trace_memory:
+            report['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+            tracemalloc.stop()
+        if profiler is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+            report['profile'] = os.path.join(profile_dir, f'{name}.prof')
+            profiler.dump_stats(report['profile'])
+
+
+def total_stages(reports):
+    """ Stages summed over several reports """
+    recorder = StageRecorder()
+    for report in reports:
+        recorder.merge(report.get('stages', {}))
+    return recorder.to_dict()
+
+
+def write_report(path, report):
+    """ Atomically write a run report """
+    with open(path + '.partial', 'w') as f:
+        f.write(json.dumps(report, indent=2, default=str))
+    os.replace(path + '.partial', path)
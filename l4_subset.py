@@ -0,0 +1,364 @@
+"""
+Spatial and temporal subsets of converted L4 granules, reading only the hyperslabs a request covers
+
+Example:
+    python l4_subset.py /path/to/<granule> wet_dep_ill --bbox -20 10 40 35 --time 5 7
+    python l4_subset.py /path/to/<granule> atm_min_kao --bbox 170 -10 -170 10 --lev 31 --bins 0 1 --output subset.nc
+    python l4_subset.py /path/to/<granule> atm_min --mineral ill kao --time 5 7
+"""
+
+import argparse
+import collections
+import functools
+import os
+import threading
+
+import numpy as np
+from netCDF4 import Dataset
+
+from instrumentation import stage
+from netcdf_conversion_template import ACCEPTED_MINERAL_NAMES, MINERAL_DIMENSION, NODATA, destination_name, read_table
+
+
+# Number of product files kept open, and of decoded coordinate sets kept in memory
+DATASET_CACHE_SIZE = 16
+COORDINATE_CACHE_SIZE = 64
+
+
+class DatasetCache:
+    """ Least recently used cache of open, read-only product Datasets, closing the handles it evicts.  Handles are
+    keyed by path and modification time, so a product rewritten by a new conversion is opened again """
+
+    def __init__(self, maxsize=DATASET_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._datasets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        key = (os.path.abspath(path), os.path.getmtime(path))
+        with self._lock:
+            if key in self._datasets:
+                self._datasets.move_to_end(key)
+                return self._datasets[key]
+            for stale in [k for k in self._datasets if k[0] == key[0]]:
+                self._datasets.pop(stale).close()
+            nc_ds = Dataset(path, 'r')
+            self._datasets[key] = nc_ds
+            while len(self._datasets) > self.maxsize:
+                self._datasets.popitem(last=False)[1].close()
+            return nc_ds
+
+    def clear(self):
+        with self._lock:
+            while self._datasets:
+                self._datasets.popitem()[1].close()
+
+
+_datasets = DatasetCache()
+
+
+def clear_caches():
+    """ Close the cached Datasets and drop the cached coordinates """
+    _datasets.clear()
+    grid_coordinates.cache_clear()
+
+
+def variable_suffix(variable, l4_naming):
+    """ Product suffix of an output variable name, including the <short name>_<mineral> names of mineral repeat rows
+    and the <short name> of their stacked variable
+    Args:
+        variable: output variable name, after VARIABLE_MAPPING
+        l4_naming: L4 naming table
+
+    Returns:
+        product suffix, or None if no row of the naming table writes the variable
+    """
+    for _v, varname in enumerate(l4_naming['Short Name']):
+        if l4_naming['Mineral Repeat'][_v]:
+            names = [varname] + [varname + "_" + mineral_name for mineral_name in ACCEPTED_MINERAL_NAMES]
+        else:
+            names = [varname]
+        if variable in [destination_name(name) for name in names]:
+            return l4_naming['Suffix'][_v]
+    return None
+
+
+def product_file(granule_dir, variable, l4_naming_file='data/L4_varnames.csv'):
+    """ Path of the netCDF product of a granule that holds an output variable """
+    suffix = variable_suffix(variable, read_table(l4_naming_file))
+    if suffix is None:
+        raise ValueError(f'{variable} is not an L4 variable of {l4_naming_file}')
+    granule = os.path.basename(os.path.normpath(granule_dir))
+    path = os.path.join(granule_dir, f'{granule}_{suffix}.nc')
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'{variable} belongs to the {suffix} product, and {path} does not exist')
+    return path
+
+
+@functools.lru_cache(maxsize=COORDINATE_CACHE_SIZE)
+def grid_coordinates(path, mtime):
+    """ Decoded coordinates of a product file, cached by path and modification time
+    Returns:
+        dictionary of the lat, lon, time and mineral values present in the file, and the lon/lat cell sizes of its
+        GeoTransform as dlon/dlat
+    """
+    nc_ds = _datasets.get(path)
+    coordinates = {name: np.asarray(nc_ds.variables[name][:]) for name in ['lat', 'lon', 'time', MINERAL_DIMENSION]
+                   if name in nc_ds.variables}
+    if 'latitude_longitude' in nc_ds.variables:
+        geotransform = [float(v) for v in nc_ds.variables['latitude_longitude'].GeoTransform.split()]
+        coordinates['dlon'], coordinates['dlat'] = geotransform[1], geotransform[5]
+    return coordinates
+
+
+def cell_slice(centers, step, low, high):
+    """ Slice of the cells of a regular axis that overlap [low, high]
+    Args:
+        centers: cell centers, in file order
+        step: signed cell size along the axis, from the GeoTransform
+        low: lower coordinate bound
+        high: upper coordinate bound
+
+    Returns:
+        slice of cell indices, empty if no cell overlaps the range
+    """
+    # The cells are anchored on the coordinate values, the GeoTransform only provides their size
+    origin = centers[0] - step / 2.
+    first, last = sorted([(low - origin) / step, (high - origin) / step])
+    start = min(max(0, int(np.floor(first))), len(centers))
+    stop = min(max(0, int(np.floor(last)) + 1), len(centers))
+    return slice(start, max(start, stop))
+
+
+def lon_slices(lon, dlon, west, east):
+    """ Slices of the longitude cells of a bounding box, two when it crosses the antimeridian """
+    west = west - 360 if west > 180 else west
+    east = east - 360 if east > 180 else east
+    if west <= east:
+        return [cell_slice(lon, dlon, west, east)]
+    return [cell_slice(lon, dlon, west, 180.), cell_slice(lon, dlon, -180., east)]
+
+
+def time_slice(time, time_range):
+    """ Slice of the time steps within an inclusive (start, end) range of time coordinate values, either end None
+    for open """
+    start, end = time_range
+    selected = np.ones(len(time), dtype=bool)
+    if start is not None:
+        selected &= time >= start
+    if end is not None:
+        selected &= time <= end
+    steps = np.nonzero(selected)[0]
+    if len(steps) == 0:
+        return slice(0, 0)
+    return slice(int(steps[0]), int(steps[-1]) + 1)
+
+
+def index_selection(index):
+    """ Selection along a dimension without coordinate values (lev, bins) - an index, a slice or a list of indices.
+    Lists of consecutive indices become slices, so they are read as one hyperslab """
+    if index is None:
+        return slice(None)
+    if isinstance(index, (int, np.integer)):
+        return slice(int(index), int(index) + 1)
+    if isinstance(index, slice):
+        return index
+    index = sorted(int(i) for i in index)
+    if len(index) > 0 and index == list(range(index[0], index[-1] + 1)):
+        return slice(index[0], index[-1] + 1)
+    return index
+
+
+def mineral_selection(minerals, mineral):
+    """ Selection along the mineral dimension of a stacked variable, from a mineral name or a list of names """
+    if mineral is None:
+        return slice(None)
+    names = [mineral] if isinstance(mineral, str) else list(mineral)
+    missing = [name for name in names if name not in list(minerals)]
+    if missing:
+        raise ValueError(f'Minerals {missing} are not stacked in the product, expected some of {list(minerals)}')
+    return index_selection([list(minerals).index(name) for name in names])
+
+
+def stacked_variable(nc_ds, variable):
+    """ Stacked variable and mineral that hold a <short name>_<mineral> variable of a product written with
+    --mineral_layout stacked, or None if the product has no such variable """
+    if MINERAL_DIMENSION not in nc_ds.variables:
+        return None
+    for mineral in nc_ds.variables[MINERAL_DIMENSION][:]:
+        name = variable[:-len(mineral) - 1]
+        if variable.endswith('_' + mineral) and name in nc_ds.variables:
+            return name, mineral
+    return None
+
+
+def subset_selection(path, nc_var, bbox=None, time_range=None, lev=None, bins=None, mineral=None):
+    """ Map a subset request onto the dimensions of a product variable
+    Args:
+        path: path of the product file
+        nc_var: product variable
+        bbox: (west, south, east, north) in degrees, west > east crosses the antimeridian, or None for the globe
+        time_range: inclusive (start, end) in time coordinate values, either end None for open, or None for all
+        lev: level index, slice or list of indices, None for all
+        bins: size bin index, slice or list of indices, None for all
+        mineral: mineral name or list of names of a stacked variable, None for all
+
+    Returns:
+        per dimension, a list of selections that are read separately and joined along the dimension
+    """
+    coordinates = grid_coordinates(path, os.path.getmtime(path))
+    selection = []
+    for name in nc_var.dimensions:
+        if name == 'lon' and bbox is not None:
+            selection.append(lon_slices(coordinates['lon'], coordinates['dlon'], bbox[0], bbox[2]))
+        elif name == 'lat' and bbox is not None:
+            selection.append([cell_slice(coordinates['lat'], coordinates['dlat'], bbox[1], bbox[3])])
+        elif name == 'time' and time_range is not None:
+            selection.append([time_slice(coordinates['time'], time_range)])
+        elif name == 'lev':
+            selection.append([index_selection(lev)])
+        elif name == 'bins':
+            selection.append([index_selection(bins)])
+        elif name == MINERAL_DIMENSION:
+            selection.append([mineral_selection(coordinates[MINERAL_DIMENSION], mineral)])
+        else:
+            selection.append([slice(None)])
+    return selection
+
+
+def selected_values(values, selections):
+    """ Coordinate values of the selections along a dimension """
+    return np.concatenate([values[selection] for selection in selections])
+
+
+def read_selection(nc_var, selection):
+    """ Read the hyperslabs of a selection, joining the pieces of dimensions that are split """
+    split = [_d for _d, selections in enumerate(selection) if len(selections) > 1]
+    if len(split) == 0:
+        with stage('read'):
+            return nc_var[tuple(selections[0] for selections in selection)]
+    axis = split[0]
+    pieces = []
+    for piece in selection[axis]:
+        piece_selection = list(selection)
+        piece_selection[axis] = [piece]
+        pieces.append(read_selection(nc_var, piece_selection))
+    return np.ma.concatenate(pieces, axis=axis)
+
+
+def subset(granule_dir, variable, bbox=None, time_range=None, lev=None, bins=None, mineral=None,
+           l4_naming_file='data/L4_varnames.csv'):
+    """ Read a spatial and temporal subset of an L4 variable from a converted granule
+    Args:
+        granule_dir: granule directory written by netcdf_conversion_template.py
+        variable: output variable name, e.g. dust_aod_vis or atm_min_kao.  In a product written with
+                  --mineral_layout stacked, atm_min_kao is read from the stacked atm_min without its mineral dimension
+        bbox: (west, south, east, north) in degrees, west > east crosses the antimeridian, or None for the globe.
+              Every cell that overlaps the box is returned
+        time_range: inclusive (start, end) in time coordinate values, either end None for open, or None for all
+        lev: level index, slice or list of indices, None for all
+        bins: size bin index, slice or list of indices, None for all
+        mineral: mineral name or list of names, to subset a stacked variable such as atm_min, None for all
+        l4_naming_file: L4 naming table used to find the product of the variable
+
+    Returns:
+        dictionary with the masked data, its dimensions, the coordinate values of the subset, the units, the product
+        file and the size of the subset in bytes
+    """
+    path = product_file(granule_dir, variable, l4_naming_file)
+    nc_ds = _datasets.get(path)
+    # A single mineral of a stacked variable is returned as it would be read from the separate layout
+    stacked = None if variable in nc_ds.variables else stacked_variable(nc_ds, variable)
+    if stacked is not None:
+        if mineral is not None:
+            raise ValueError(f'{variable} is a single mineral, request the stacked variable to select minerals')
+        name, mineral = stacked
+        nc_var = nc_ds.variables[name]
+    elif variable in nc_ds.variables:
+        nc_var = nc_ds.variables[variable]
+    else:
+        raise ValueError(f'{variable} is not in {path}')
+    if mineral is not None and MINERAL_DIMENSION not in nc_var.dimensions:
+        raise ValueError(f'{variable} in {path} is not stacked along {MINERAL_DIMENSION}')
+    selection = subset_selection(path, nc_var, bbox, time_range, lev, bins, mineral)
+    data = read_selection(nc_var, selection)
+
+    coordinates = grid_coordinates(path, os.path.getmtime(path))
+    subset_coordinates = {}
+    for name, selections in zip(nc_var.dimensions, selection):
+        if name in coordinates:
+            subset_coordinates[name] = selected_values(coordinates[name], selections)
+        else:
+            subset_coordinates[name] = selected_values(np.arange(len(nc_ds.dimensions[name])), selections)
+    dimensions = list(nc_var.dimensions)
+    if stacked is not None:
+        data = data[0]
+        dimensions.remove(MINERAL_DIMENSION)
+        subset_coordinates.pop(MINERAL_DIMENSION)
+    return {'variable': variable,
+            'file': path,
+            'data': data,
+            'dimensions': dimensions,
+            'coordinates': subset_coordinates,
+            'units': getattr(nc_var, 'units', None),
+            'long_name': getattr(nc_var, 'long_name', None),
+            'nbytes': int(data.nbytes)}
+
+
+def write_subset(result, output_file):
+    """ Write a subset to a netCDF file, with its coordinates """
+    nc_ds = Dataset(output_file, 'w', clobber=True, format='NETCDF4')
+    try:
+        for name in result['dimensions']:
+            nc_ds.createDimension(name, len(result['coordinates'][name]))
+            # Mineral names are variable length strings
+            datatype = result['coordinates'][name].dtype
+            coordinate = nc_ds.createVariable(name, str if datatype == object else datatype, (name,))
+            coordinate[:] = result['coordinates'][name]
+        nc_var = nc_ds.createVariable(result['variable'], 'f4', result['dimensions'], fill_value=NODATA,
+                                      compression='zlib', complevel=4, shuffle=True)
+        if result['long_name'] is not None:
+            nc_var.long_name = result['long_name']
+        if result['units'] is not None:
+            nc_var.units = result['units']
+        nc_var[:] = result['data']
+        nc_ds.source = os.path.basename(result['file'])
+    finally:
+        nc_ds.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read a spatial and temporal subset of a converted L4 granule')
+    parser.add_argument('granule_dir', help='Granule directory written by netcdf_conversion_template.py')
+    parser.add_argument('variable', help='Output variable name, e.g. dust_aod_vis or atm_min_kao')
+    parser.add_argument('--bbox', type=float, nargs=4, default=None, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                        help='Bounding box in degrees, WEST > EAST crosses the antimeridian')
+    parser.add_argument('--time', type=float, nargs=2, default=None, metavar=('START', 'END'),
+                        help='Inclusive range of time coordinate values')
+    parser.add_argument('--lev', type=int, nargs='+', default=None, help='Level indices')
+    parser.add_argument('--bins', type=int, nargs='+', default=None, help='Size bin indices')
+    parser.add_argument('--mineral', nargs='+', default=None,
+                        help='Mineral names, to subset a variable written with --mineral_layout stacked')
+    parser.add_argument('--l4_naming_file', default='data/L4_varnames.csv')
+    parser.add_argument('--output', default=None, help='Write the subset to this netCDF file')
+    args = parser.parse_args()
+
+    result = subset(args.granule_dir, args.variable, args.bbox, args.time, args.lev, args.bins, args.mineral,
+                    args.l4_naming_file)
+    data = result['data']
+    coordinates = result['coordinates']
+    print(f'{result["variable"]} from {result["file"]}')
+    print('Dimensions: ' + ', '.join(f'{name}({len(coordinates[name])})' for name in result['dimensions']))
+    for name in ['lat', 'lon', 'time']:
+        if name in coordinates and len(coordinates[name]) > 0:
+            print(f'{name}: {coordinates[name][0]} to {coordinates[name][-1]}')
+    print(f'Subset of {result["nbytes"]} bytes')
+    if data.size > 0 and data.count() > 0:
+        print(f'min {data.min()}, mean {data.mean()}, max {data.max()} {result["units"] or ""}')
+    if args.output is not None:
+        write_subset(result, args.output)
+        print(f'Wrote {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,107 @@
 
 
-from netCDF4 import Dataset
+from netCDF4 import Dataset, get_chunk_cache
 import argparse
+import contextlib
+import functools
+import glob
+import io
+import itertools
+import json
+import multiprocessing
 import numpy as np
 import os
+import queue
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait
 from datetime import datetime
+from multiprocessing import shared_memory
 import pandas as pd
 from osgeo import osr
 
+from aggregates import SEASONS, AggregateObserver, aggregate_path
+from checksums import ChecksumCache, calc_checksum, sidecar_path
+from instrumentation import (StageRecorder, active_recorder, count_bytes, monitor, recording, stage, total_stages,
+                             write_report)
+from nodata import NODATA
+from overviews import OVERVIEW_FACTORS, OverviewObserver
+from quantization import add_quantization_info, bitround, keep_bits, parse_quantization, quantization_attributes
+from scheduler import (MIN_SLAB_BYTES, PROCESS_BASE_BYTES, order_schedule, print_plan, run_scheduled, simulate_schedule,
+                       slab_memory, streaming_slab_bytes)
 
-NODATA = -9999
 
-
-def add_main_metadata(nc_ds):
-    nc_ds.ncei_template_version = "NCEI_NetCDF_Swath_Template_v2.0"  
-    nc_ds.summary = "The Earth Surface Mineral Dust Source Investigation (EMIT) is an Earth Ventures-Instrument (EVI-4) \
+# Global attributes shared by every product, date_created is filled in when a file is created
+MAIN_METADATA = {
+    'ncei_template_version': "NCEI_NetCDF_Swath_Template_v2.0",
+    'summary': "The Earth Surface Mineral Dust Source Investigation (EMIT) is an Earth Ventures-Instrument (EVI-4) \
 Mission that maps the surface mineralogy of arid dust source regions via imaging spectroscopy in the visible and \
 short-wave infrared (VSWIR). Installed on the International Space Station (ISS), the EMIT instrument is a Dyson \
 imaging spectrometer that uses contiguous spectroscopic measurements from 410 to 2450 nm to resolve absoprtion \
 features of iron oxides, clays, sulfates, carbonates, and other dust-forming minerals. During its one-year mission, \
 EMIT will observe the sunlit Earth's dust source regions that occur within +/-52° latitude and produce maps of the \
 source regions that can be used to improve forecasts of the role of mineral dust in the radiative forcing \
-(warming or cooling) of the atmosphere.\n"
+(warming or cooling) of the atmosphere.\n",
 
-    nc_ds.keywords = "Imaging Spectroscopy, minerals, EMIT, dust, radiative forcing"
-    nc_ds.Conventions = "CF-1.63, ACDD-1.3"
-    nc_ds.sensor = "EMIT (Earth Surface Mineral Dust Source Investigation)"
-    nc_ds.instrument = "EMIT"
-    nc_ds.platform = "ISS"
+    'keywords': "Imaging Spectroscopy, minerals, EMIT, dust, radiative forcing",
+    'Conventions': "CF-1.63, ACDD-1.3",
+    'sensor': "EMIT (Earth Surface Mineral Dust Source Investigation)",
+    'instrument': "EMIT",
+    'platform': "ISS",
 
     # Feel free to modify institution
-    nc_ds.institution = "NASA Jet Propulsion Laboratory/California Institute of Technology"
-    nc_ds.license = "Freely Distributed"
-    nc_ds.naming_authority = "LPDAAC"
-    dt_now = datetime.utcnow()
-    nc_ds.date_created = dt_now.strftime("%Y-%m-%dT%H:%M:%SZ")
-    nc_ds.keywords_vocabulary = "NASA Global Change Master Directory (GCMD) Science Keywords"
-    nc_ds.stdname_vocabulary = "NetCDF Climate and Forecast (CF) Metadata Convention"
+    'institution': "NASA Jet Propulsion Laboratory/California Institute of Technology",
+    'license': "Freely Distributed",
+    'naming_authority': "LPDAAC",
+    'date_created': None,
+    'keywords_vocabulary': "NASA Global Change Master Directory (GCMD) Science Keywords",
+    'stdname_vocabulary': "NetCDF Climate and Forecast (CF) Metadata Convention",
 
     # Feel free to modify
-    nc_ds.creator_name = "Jet Propulsion Laboratory/California Institute of Technology"
+    'creator_name': "Jet Propulsion Laboratory/California Institute of Technology",
+
+    'creator_url': "https://www.jpl.nasa.gov",
+    'project': "Earth Surface Mineral Dust Source Investigation",
+    'project_url': "https://earth.jpl.nasa.gov/emit",
+    'publisher_name': "NASA LPDAAC",
+    'publisher_url': "https://lpdaac.usgs.gov",
+    'publisher_email': "lpdaac@usgs.gov",
+    'identifier_product_doi_authority': "https://doi.org",
+    'processing_level': "L4",
+
+    'geospatial_bounds_crs': "EPSG:4326",
+}
 
-    nc_ds.creator_url = "https://www.jpl.nasa.gov"
-    nc_ds.project = "Earth Surface Mineral Dust Source Investigation"
-    nc_ds.project_url = "https://earth.jpl.nasa.gov/emit"
-    nc_ds.publisher_name = "NASA LPDAAC"
-    nc_ds.publisher_url = "https://lpdaac.usgs.gov"
-    nc_ds.publisher_email = "lpdaac@usgs.gov"
-    nc_ds.identifier_product_doi_authority = "https://doi.org"
-    nc_ds.processing_level = "L4"
-    
-    nc_ds.geospatial_bounds_crs = "EPSG:4326"
 
+def add_main_metadata(nc_ds):
+    for name, value in MAIN_METADATA.items():
+        if name == 'date_created':
+            value = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        setattr(nc_ds, name, value)
 
     nc_ds.title = "EMIT L4 Earth System Model Products V001; "
 
 
-def add_variable(nc_ds, nc_name, data_type, long_name, units, data, kargs, lat_order=None, lon_order=None):
-    kargs['fill_value'] = NODATA
+@functools.lru_cache(maxsize=None)
+def epsg_wkt(epsg):
+    """ WKT of an EPSG coordinate reference system, built once per process """
+    spatial_ref = osr.SpatialReference()
+    spatial_ref.ImportFromEPSG(epsg)
+    return spatial_ref.ExportToWkt()
 
-    
-    keys = list(kargs['dimensions'])
+
+def output_dimensions(keys):
+    """ Reorder source dimensions so that lat and lon are the last two axes
+    Args:
+        keys: source dimension names
+
+    Returns:
+        output dimension names and the transpose index that maps source axes onto them
+    """
+    keys = list(keys)
     idx = list(range(len(keys)))
+    newkeys = keys
     if 'lon' in keys and 'lat' in keys:
 
         newkeys = [x for x in keys if (x != 'lon' and x != 'lat')]
@@ -69,31 +109,361 @@ def add_variable(nc_ds, nc_name, data_type, long_name, units, data, kargs, lat_o
         newkeys.insert(len(keys)-1,'lon')
 
         idx = [keys.index(x) for x in newkeys]
-        kargs['dimensions'] = newkeys
+    return newkeys, idx
+
+
+# Leading dimension of the stacked variable of a mineral repeat row, with the mineral names as a string coordinate
+MINERAL_DIMENSION = 'mineral'
+# Mineral repeat rows are written as one variable per mineral, or stacked into one variable along MINERAL_DIMENSION
+MINERAL_LAYOUTS = ['separate', 'stacked']
+
+
+class MineralStack:
+    """ The source variables of the minerals of a mineral repeat row, read as a single variable with a leading
+    mineral dimension, so that a slab can span all the minerals """
+
+    def __init__(self, variables):
+        self.variables = list(variables)
+        self.dimensions = (MINERAL_DIMENSION,) + tuple(self.variables[0].dimensions)
+        self.shape = (len(self.variables),) + tuple(self.variables[0].shape)
+        self.dtype = self.variables[0].dtype
+
+    def __getitem__(self, slices):
+        minerals = range(len(self.variables))[slices[0]]
+        return np.ma.stack([self.variables[_m][slices[1:]] for _m in minerals])
+
+
+def source_variable(source_dataset, source):
+    """ Source variable of a job, a MineralStack if the job stacks several source variables """
+    if isinstance(source, str):
+        return source_dataset.variables[source]
+    return MineralStack([source_dataset.variables[name] for name in source])
+
+
+# Preferred order of output axes to split a variable along when streaming
+SLAB_DIMENSIONS = ['time', 'lev', 'bins']
+
+
+# Output layouts - chunks maps dimension names to a chunk length (None for the full dimension), any dimension not
+# listed gets a chunk length of 1.  An empty profile leaves the variable contiguous and uncompressed.  Note that
+# netCDF4-python only applies the shuffle filter together with zlib.
+OUTPUT_PROFILES = {
+    'contiguous': {},
+    # Full lat/lon maps per time step, for map viewers and spatial analyses
+    'map': {'compression': 'zlib', 'complevel': 4, 'shuffle': True, 'chunks': {'lat': None, 'lon': None}},
+    'map_zstd': {'compression': 'zstd', 'complevel': 6, 'shuffle': True, 'chunks': {'lat': None, 'lon': None}},
+    # Long time chunks over small lat/lon tiles, for point and regional time series
+    'timeseries': {'compression': 'zlib', 'complevel': 4, 'shuffle': True,
+                   'chunks': {'time': None, 'lat': 32, 'lon': 32}},
+    'timeseries_zstd': {'compression': 'zstd', 'complevel': 6, 'shuffle': True,
+                        'chunks': {'time': None, 'lat': 32, 'lon': 32}},
+}
+
+
+def chunk_sizes(profile, newkeys, shape):
+    """ Chunk shape for an output variable under the given profile, or None to leave it contiguous """
+    if 'chunks' not in profile:
+        return None
+    chunks = []
+    for name, size in zip(newkeys, shape):
+        length = profile['chunks'].get(name, 1)
+        chunks.append(max(1, size if length is None else min(length, size)))
+    return chunks
+
+
+def stacked_profile(profile):
+    """ Profile of a stacked mineral variable, chunked across every mineral so that a region or time step of all
+    the minerals is a single read """
+    if profile is None or 'chunks' not in profile:
+        return profile
+    return dict(profile, chunks=dict(profile['chunks'], **{MINERAL_DIMENSION: None}))
+
+
+def profile_kargs(profile, chunks):
+    """ createVariable keyword arguments for the given profile and chunk shape """
+    kargs = {}
+    if profile.get('compression') is not None:
+        kargs['compression'] = profile['compression']
+        kargs['complevel'] = profile.get('complevel', 4)
+        kargs['shuffle'] = profile.get('shuffle', True)
+    if chunks is not None:
+        kargs['chunksizes'] = chunks
+    return kargs
+
+
+def slab_axes(newkeys, out_shape, chunks=None):
+    """ Output axes a variable can be streamed along, in the order they are preferred.  Axes that are chunked one
+    index at a time come first, so that every slab covers whole chunks, and axes chunked at their full length come
+    last.  lat is only split after the other axes, lon never """
+    candidates = [name for name in SLAB_DIMENSIONS if name in newkeys]
+    candidates += [name for name in newkeys if name not in candidates and name not in ('lat', 'lon')]
+    if 'lat' in newkeys:
+        candidates.append('lat')
+    axes = [newkeys.index(name) for name in candidates if out_shape[newkeys.index(name)] > 1]
+    if chunks is not None:
+        axes.sort(key=lambda axis: (chunks[axis] >= out_shape[axis], chunks[axis] != 1))
+    return axes
+
+
+def order_slices(order, size):
+    """ Express an axis reordering as (output slice, source slice) pairs
+    Args:
+        order: index array the axis is reordered with, or None to keep it as is
+        size: length of the axis
+
+    Returns:
+        one pair for a plain or reversed order, two pairs for a rotation (split where it wraps around, e.g. at the
+        dateline), or None if the order is neither
+    """
+    if order is None:
+        return [(slice(0, size), slice(0, size))]
+    order = np.asarray(order)
+    if len(order) == 0:
+        return None
+    start = int(order[0])
+    positions = np.arange(size)
+    if np.array_equal(order, (start + positions) % size):
+        pairs = [(slice(0, size - start), slice(start, size)), (slice(size - start, size), slice(0, start))]
+    elif np.array_equal(order, (start - positions) % size):
+        pairs = [(slice(0, start + 1), slice(start, None, -1)), (slice(start + 1, size), slice(size - 1, start, -1))]
+    else:
+        return None
+    return [(out, src) for out, src in pairs if out.stop > out.start]
+
+
+def reorder_pieces(block, idx, newkeys, lat_order=None, lon_order=None):
+    """ Transpose a block of source data into output order and apply the lat/lon reordering, without copying it
+    where the reordering is a reversal or a rotation
+    Returns:
+        list of (output slices within the block, strided view of the block) pieces
+    """
+    out_dat = block.transpose(idx)
+    split_axes = []
+    for name, order in [('lat', lat_order), ('lon', lon_order)]:
+        if name not in newkeys or order is None:
+            continue
+        axis = newkeys.index(name)
+        pairs = order_slices(order, out_dat.shape[axis])
+        if pairs is None:
+            # Arbitrary orders fall back to integer indexing, which copies the block
+            slices = [slice(None)] * out_dat.ndim
+            slices[axis] = order
+            out_dat = out_dat[tuple(slices)]
+        else:
+            split_axes.append((axis, pairs))
+
+    pieces = [(tuple([slice(None)] * out_dat.ndim), out_dat)]
+    for axis, pairs in split_axes:
+        split = []
+        for piece_slices, piece in pieces:
+            for out, src in pairs:
+                out_slices = list(piece_slices)
+                out_slices[axis] = out
+                src_slices = [slice(None)] * piece.ndim
+                src_slices[axis] = src
+                split.append((tuple(out_slices), piece[tuple(src_slices)]))
+        pieces = split
+    return pieces
+
+
+def pieces_shape(pieces):
+    """ Shape of the block a list of pieces makes up """
+    shape = list(pieces[0][1].shape)
+    for piece_slices, piece in pieces:
+        for axis, piece_slice in enumerate(piece_slices):
+            if piece_slice.stop is not None:
+                shape[axis] = max(shape[axis], piece_slice.stop)
+    return tuple(shape)
+
+
+def assemble_pieces(pieces):
+    """ Copy the pieces of a reordered block into a single array, a single piece is returned as is """
+    if len(pieces) == 1:
+        return pieces[0][1]
+    dtype = pieces[0][1].dtype
+    shape = pieces_shape(pieces)
+    if any(np.ma.isMaskedArray(piece) for _, piece in pieces):
+        out_dat = np.ma.empty(shape, dtype=dtype)
+    else:
+        out_dat = np.empty(shape, dtype=dtype)
+    for piece_slices, piece in pieces:
+        out_dat[piece_slices] = piece
+    return out_dat
+
+
+def reorder_block(block, idx, newkeys, lat_order=None, lon_order=None):
+    """ Transpose a block of source data into output order and apply the lat/lon reordering """
+    return assemble_pieces(reorder_pieces(block, idx, newkeys, lat_order, lon_order))
+
+
+def merge_slices(out_slices, piece_slices):
+    """ Output slices of a piece of a slab.  Piece slices are relative to the slab, so on the axes the slab is split
+    along they are offset by the start of the slab """
+    merged = []
+    for out, piece in zip(out_slices, piece_slices):
+        if piece == slice(None):
+            merged.append(out)
+        elif out == slice(None):
+            merged.append(piece)
+        else:
+            start, stop, _ = piece.indices(out.stop - out.start)
+            merged.append(slice(out.start + start, out.start + stop))
+    return tuple(merged)
+
+
+def iter_slabs(data, idx, newkeys, lat_order=None, lon_order=None, max_slab_bytes=None, chunks=None):
+    """ Read, reorder and yield a variable one slab at a time
+    Args:
+        data: source array or netCDF variable, in source dimension order
+        idx: transpose index from source to output order
+        newkeys: output dimension names
+        lat_order: optional index array to reorder the lat axis with
+        lon_order: optional index array to reorder the lon axis with
+        max_slab_bytes: memory budget for a single slab; None reads the whole variable at once
+        chunks: optional output chunk shape, slabs are aligned to it
+
+    Returns:
+        generator of (output slices, pieces) tuples, with the pieces of each slab as from reorder_pieces
+    """
+    out_shape = [data.shape[i] for i in idx]
+    plan = slab_plan(out_shape, np.dtype(data.dtype).itemsize, newkeys, max_slab_bytes, chunks)
+    for out_slices in slab_slices(out_shape, plan):
+        src_slices, slab_lat_order, slab_lon_order = source_slab(out_slices, idx, newkeys, lat_order, lon_order)
+        yield out_slices, read_slab(data, src_slices, idx, newkeys, slab_lat_order, slab_lon_order)
+
+
+def source_slab(out_slices, idx, newkeys, lat_order=None, lon_order=None):
+    """ Source slices of an output slab, and the lat/lon orders within it.  A slab split along a reordered axis is
+    read from the range of source rows its output rows come from, e.g. in reverse for the flipped latitudes
+    Returns:
+        source slices, and the lat and lon orders to reorder the block read with them
+    """
+    src_slices = [slice(None)] * len(idx)
+    orders = {'lat': lat_order, 'lon': lon_order}
+    for axis, out_slice in enumerate(out_slices):
+        name = newkeys[axis]
+        if orders.get(name) is not None and out_slice != slice(None):
+            rows = np.asarray(orders[name])[out_slice]
+            start = int(rows.min())
+            orders[name] = rows - start
+            out_slice = slice(start, int(rows.max()) + 1)
+        src_slices[idx[axis]] = out_slice
+    return tuple(src_slices), orders['lat'], orders['lon']
+
+
+def read_slab(data, src_slices, idx, newkeys, lat_order=None, lon_order=None):
+    """ Read a slab of source data and reorder it into output pieces, timing both stages """
+    with stage('read'):
+        block = data[src_slices]
+    count_bytes('read', block.nbytes)
+    with stage('transpose'):
+        return reorder_pieces(block, idx, newkeys, lat_order, lon_order)
+
 
+def slab_plan(out_shape, itemsize, newkeys, max_slab_bytes=None, chunks=None):
+    """ Output axes and number of indices per slab to stream a variable with.  A variable is split along the first
+    of its slab_axes, and only if a single chunk row along it is still larger than max_slab_bytes, e.g. one time step
+    of a stacked mineral variable, also along the next ones
+    Returns:
+        list of (axis, step) splits, empty to read the variable whole
+    """
+    nbytes = itemsize * int(np.prod(out_shape))
+    if max_slab_bytes is None or nbytes <= max_slab_bytes:
+        return []
+
+    plan = []
+    for axis in slab_axes(newkeys, out_shape, chunks):
+        # Slabs are whole chunk rows along the axis, unless it is chunked at its full length
+        unit = 1 if chunks is None or chunks[axis] >= out_shape[axis] else chunks[axis]
+        index_bytes = nbytes // max(out_shape[axis], 1)
+        step = max(1, int(max_slab_bytes // max(index_bytes, 1)))
+        step = max(unit, step - step % unit)
+        plan.append((axis, step))
+        nbytes = index_bytes * min(step, out_shape[axis])
+        if nbytes <= max_slab_bytes:
+            break
+    return plan
+
+
+def slab_slices(out_shape, plan):
+    """ Output slices of every slab of a slab plan, in order """
+    ranges = [range(0, out_shape[axis], step) for axis, step in plan]
+    for starts in itertools.product(*ranges):
+        out_slices = [slice(None)] * len(out_shape)
+        for (axis, step), start in zip(plan, starts):
+            out_slices[axis] = slice(start, min(start + step, out_shape[axis]))
+        yield tuple(out_slices)
+
+
+def slab_shape(out_shape, plan):
+    """ Shape of the largest slab of a slab plan """
+    shape = list(out_shape)
+    for axis, step in plan:
+        shape[axis] = min(step, out_shape[axis])
+    return shape
+
+
+def slab_nbytes(out_shape, itemsize, newkeys, max_slab_bytes=None, chunks=None):
+    """ Size in bytes of the largest slab a variable is streamed in """
+    plan = slab_plan(out_shape, itemsize, newkeys, max_slab_bytes, chunks)
+    return itemsize * int(np.prod(slab_shape(out_shape, plan)))
+
+
+def add_variable(nc_ds, nc_name, data_type, long_name, units, data, kargs, lat_order=None, lon_order=None,
+                 max_slab_bytes=None, profile=None, sync=True, observers=(), chunk_cache_bytes=None, quantization=None):
+    if data_type is not str:
+        kargs['fill_value'] = NODATA
+
+    keys = list(kargs['dimensions'])
+    newkeys, idx = output_dimensions(keys)
+    kargs['dimensions'] = newkeys
+
+    chunks = None
+    if profile is not None and data_type is not str:
+        chunks = chunk_sizes(profile, newkeys, [len(nc_ds.dimensions[name]) for name in newkeys])
+        kargs.update(profile_kargs(profile, chunks))
 
     nc_var = nc_ds.createVariable(nc_name, data_type, **kargs)
+    if chunks is not None and chunk_cache_bytes is not None and hasattr(nc_var, 'set_var_chunk_cache'):
+        # HDF5 keeps written chunks cached until the file is closed, up to this size per variable
+        nc_var.set_var_chunk_cache(size=chunk_cache_bytes)
     if long_name is not None:
         nc_var.long_name = long_name
     if units is not None:
         nc_var.units = units
+    keepbits = None
+    if quantization is not None:
+        keepbits = keep_bits(quantization)
+        nc_var.setncatts(quantization_attributes(quantization))
+        add_quantization_info(nc_ds)
 
-    if data_type is str:
+    if data is None:
+        # Only define the variable, its data is written by the caller
+        pass
+    elif data_type is str:
         for _n in range(len(data)):
             nc_var[_n] = data[_n]
     else:
-        out_dat = data.transpose(idx).copy()
-        if lat_order is not None:
-            lat_ax = newkeys.index('lat')
-            slices = [slice(None)] * out_dat.ndim
-            slices[lat_ax] = lat_order
-            out_dat = out_dat[tuple(slices)]
-        if lon_order is not None:
-            lon_ax = newkeys.index('lon')
-            slices = [slice(None)] * out_dat.ndim
-            slices[lon_ax] = lon_order
-            out_dat = out_dat[tuple(slices)]
-        nc_var[...] = out_dat
+        # data may be an in-memory array or a source netCDF variable, which is then read slab by slab
+        for out_slices, pieces in iter_slabs(data, idx, newkeys, lat_order, lon_order, max_slab_bytes, chunks):
+            if keepbits is not None:
+                # Rounded before compression, so the zeroed trailing bits compress away
+                with stage('quantize'):
+                    pieces = [(piece_slices, bitround(piece, keepbits)) for piece_slices, piece in pieces]
+            if len(observers) == 0:
+                # Write the reordered views straight into the variable, without assembling the slab
+                for piece_slices, piece in pieces:
+                    with stage('write', piece.nbytes):
+                        nc_var[merge_slices(out_slices, piece_slices)] = piece
+                continue
+            with stage('transpose'):
+                out_dat = assemble_pieces(pieces)
+            with stage('write', out_dat.nbytes):
+                nc_var[out_slices] = out_dat
+            # Observers see every slab while it is in memory, e.g. to build browse images or aggregates
+            with stage('observe'):
+                for observer in observers:
+                    observer(nc_var, out_slices, out_dat)
 
     if nc_name == "lat":
         nc_var.standard_name = "latitude"
@@ -114,17 +484,156 @@ def add_variable(nc_ds, nc_name, data_type, long_name, units, data, kargs, lat_o
         grid_mapping.GeoTransform = f"{lon[0] - dlon/2.} {dlon} 0 {lat[-1] + dlat/2.} 0 {dlat} "
         print(grid_mapping.GeoTransform)
 
-        spatial_ref = osr.SpatialReference()
-        spatial_ref.ImportFromEPSG(4326)
-        wkt = spatial_ref.ExportToWkt()
-        grid_mapping.spatial_ref = wkt
+        grid_mapping.spatial_ref = epsg_wkt(4326)
 
 
 
     if 'lon' in keys and 'lat' in keys:
         nc_var.grid_mapping = 'latitude_longitude'
 
-    nc_ds.sync()
+    if sync:
+        with stage('sync'):
+            nc_ds.sync()
+
+
+# Seconds the pipeline writer waits for a slab before checking that the reader process is still alive
+READER_POLL_SECONDS = 2
+
+
+def next_from_reader(ready_queue, reader):
+    """ Next item the pipeline reader handed over, raising if the reader process died without handing one over,
+    e.g. when it was killed for running out of memory """
+    while True:
+        try:
+            return ready_queue.get(timeout=READER_POLL_SECONDS)
+        except queue.Empty:
+            if reader.is_alive():
+                continue
+        # An item put just before the reader exited may still be on its way through the queue
+        try:
+            return ready_queue.get(timeout=1)
+        except queue.Empty:
+            raise RuntimeError(f'Pipeline reader process died with exit code {reader.exitcode}')
+
+
+def _pipeline_reader(input_file, jobs, lat_order, lon_order, max_slab_bytes, buffer_names, free_queue,
+                     ready_queue):
+    """ Reader side of the conversion pipeline - reads and reorders slabs into the shared buffers.  Its stage
+    timings are handed back to the writer once all slabs are read """
+    buffers = [shared_memory.SharedMemory(name=name) for name in buffer_names]
+    recorder = StageRecorder()
+    try:
+        with recording(recorder):
+            source_dataset = Dataset(input_file, 'r')
+            for job in jobs:
+                _read_job(source_dataset, job, lat_order, lon_order, max_slab_bytes, buffers, free_queue, ready_queue)
+            source_dataset.close()
+        ready_queue.put(recorder.to_dict())
+    except Exception:
+        ready_queue.put(traceback.format_exc())
+    finally:
+        for buffer in buffers:
+            buffer.close()
+
+
+def _read_job(source_dataset, job, lat_order, lon_order, max_slab_bytes, buffers, free_queue, ready_queue):
+    """ Read one variable of the pipeline slab by slab into the shared buffers """
+    source_var = source_variable(source_dataset, job['source'])
+    newkeys, idx = output_dimensions(source_var.dimensions)
+    chunks = None
+    if job['profile'] is not None:
+        chunks = chunk_sizes(job['profile'], newkeys, [source_var.shape[i] for i in idx])
+    for out_slices, pieces in iter_slabs(source_var, idx, newkeys, lat_order, lon_order, max_slab_bytes, chunks):
+        shape = pieces_shape(pieces)
+        dtype = pieces[0][1].dtype
+        with stage('wait_writer'):
+            _b = free_queue.get()
+        out_dat = np.ndarray(shape, dtype=dtype, buffer=buffers[_b].buf)
+        # Copy the reordered views straight into the shared buffer, masked values are written as the fill value
+        # either way
+        with stage('transpose'):
+            for piece_slices, piece in pieces:
+                target = out_dat[piece_slices]
+                target[...] = np.ma.getdata(piece)
+                mask = np.ma.getmask(piece)
+                if mask is not np.ma.nomask:
+                    target[mask] = NODATA
+        if job['quantization'] is not None:
+            with stage('quantize'):
+                out_dat[...] = bitround(out_dat, keep_bits(job['quantization']))
+        ready_queue.put((job['name'], out_slices, _b, shape, dtype.str))
+
+
+def write_variables_pipelined(nc_ds, source_dataset, jobs, lat_order, lon_order, max_slab_bytes=None, depth=2,
+                              observers=()):
+    """ Write variables with a reader process prefetching the next slabs while the current one is written
+    Args:
+        nc_ds: output netCDF dataset
+        source_dataset: open source netCDF dataset, the reader process opens its own handle on the same file
+        jobs: list of variables to write, each a dictionary with name, source (a source variable name, or a list of
+              them to stack along the mineral dimension), long_name, units, dimensions, profile, chunk_cache_bytes
+              and quantization keys
+        lat_order: optional index array to reorder the lat axis with
+        lon_order: optional index array to reorder the lon axis with
+        max_slab_bytes: memory budget for a single slab; None moves whole variables through the pipeline
+        depth: number of slabs that can be in flight between the reader and the writer
+        observers: callables invoked with the output variable, output slices and data of every slab written
+    """
+    # The netCDF library is not thread-safe, so the reader runs in its own process and hands over slabs through
+    # a bounded set of shared memory buffers
+    buffer_bytes = 1
+    for job in jobs:
+        source_var = source_variable(source_dataset, job['source'])
+        newkeys, idx = output_dimensions(source_var.dimensions)
+        out_shape = [source_var.shape[i] for i in idx]
+        chunks = None if job['profile'] is None else chunk_sizes(job['profile'], newkeys, out_shape)
+        buffer_bytes = max(buffer_bytes, slab_nbytes(out_shape, source_var.dtype.itemsize, newkeys, max_slab_bytes,
+                                                     chunks))
+
+    # Define all variables up front, so the reader never waits on metadata writes
+    for job in jobs:
+        add_variable(nc_ds, job['name'], "f4", job['long_name'], job['units'], None,
+                     {"dimensions": job['dimensions']}, profile=job['profile'], sync=False,
+                     chunk_cache_bytes=job['chunk_cache_bytes'], quantization=job['quantization'])
+
+    ctx = multiprocessing.get_context('spawn')
+    buffers = [shared_memory.SharedMemory(create=True, size=buffer_bytes) for _ in range(max(depth, 1))]
+    free_queue = ctx.Queue()
+    ready_queue = ctx.Queue()
+    for _b in range(len(buffers)):
+        free_queue.put(_b)
+    reader = ctx.Process(target=_pipeline_reader,
+                         args=(source_dataset.filepath(), jobs, lat_order, lon_order, max_slab_bytes,
+                               [buffer.name for buffer in buffers], free_queue, ready_queue))
+    reader.start()
+    try:
+        while True:
+            with stage('wait_reader'):
+                item = next_from_reader(ready_queue, reader)
+            if isinstance(item, dict):
+                # The reader is done and sent its stage timings
+                recorder = active_recorder()
+                if recorder is not None:
+                    recorder.merge(item)
+                break
+            if isinstance(item, str):
+                raise RuntimeError(f'Pipeline reader failed:\n{item}')
+            name, out_slices, _b, shape, dtype = item
+            out_dat = np.ndarray(shape, dtype=dtype, buffer=buffers[_b].buf)
+            with stage('write', out_dat.nbytes):
+                nc_ds.variables[name][out_slices] = out_dat
+            with stage('observe'):
+                for observer in observers:
+                    observer(nc_ds.variables[name], out_slices, out_dat)
+            free_queue.put(_b)
+        reader.join()
+    finally:
+        if reader.is_alive():
+            reader.terminate()
+            reader.join()
+        for buffer in buffers:
+            buffer.close()
+            buffer.unlink()
 
 
 ACCEPTED_MINERAL_NAMES = [
@@ -153,12 +662,510 @@ ACCEPTED_MINERAL_NAMES = [
     'GyFe'
 ]
 
+# Variable the browse image is made from
+BROWSE_VARIABLE = 'dust_sw_rf_toa'
+
 # If needed, map variable to correct name (e.g. {"incorrect_name": "correct_name"})
 VARIABLE_MAPPING = {
 }
 
 
-def main():
+def resolve_products(source_dataset, l4_naming):
+    """ Match the L4 naming table against the variables in the source dataset
+    Args:
+        source_dataset: open source netCDF dataset
+        l4_naming: L4 naming table
+
+    Returns:
+        list of products (one per output file) and the list of resolved short names
+    """
+    products = []
+    resolved_names = []
+
+    #for varname in list(source_dataset.variables):
+    for _v, varname in enumerate(l4_naming['Short Name']):
+
+        l4_names = []
+        l4_longnames = []
+        l4_units = []
+        minerals = None
+        if l4_naming['Mineral Repeat'][_v]:
+            minerals = []
+            for mineral_name in ACCEPTED_MINERAL_NAMES:
+                ds_name = varname + "_" + mineral_name
+                ds_longname = l4_naming['Long Name'][_v] + " " + mineral_name
+                if ds_name in list(source_dataset.variables):
+                    l4_names.append(ds_name)
+                    l4_longnames.append(ds_longname)
+                    l4_units.append(l4_naming['Units'][_v])
+                    minerals.append(mineral_name)
+                    resolved_names.append(varname)
+        else:
+            if varname in list(source_dataset.variables):
+                l4_names.append(varname)
+                l4_longnames.append(l4_naming['Long Name'][_v])
+                l4_units.append(l4_naming['Units'][_v])
+                resolved_names.append(varname)
+
+        if len(l4_names) > 0:
+            products.append({'row': _v,
+                             'short_name': varname,
+                             'suffix': l4_naming['Suffix'][_v],
+                             'long_name': l4_naming['Long Name'][_v],
+                             'description': l4_naming['Description'][_v],
+                             'profile': l4_naming['Output Profile'][_v] if 'Output Profile' in l4_naming else 'contiguous',
+                             'quantization': l4_naming['Quantization'][_v] if 'Quantization' in l4_naming else None,
+                             'l4_names': l4_names,
+                             'l4_longnames': l4_longnames,
+                             'l4_units': l4_units,
+                             'minerals': minerals})
+
+    return products, resolved_names
+
+
+def destination_name(l4_name):
+    """ Output variable name of a source variable, after VARIABLE_MAPPING """
+    dest_l4_name = l4_name
+    for k, v in VARIABLE_MAPPING.items():
+        if l4_name.startswith(k):
+            dest_l4_name = l4_name.replace(k, v)
+    return dest_l4_name
+
+
+def grid_order(source_dataset):
+    """ Flip the source latitudes to run north to south and wrap the longitudes to -180..180, in increasing order
+    Returns:
+        latitudes and longitudes in output order, and the index arrays that reorder the source lat and lon axes
+    """
+    lat = np.array(source_dataset.variables['lat'][:])
+    lat_idx = np.argsort(lat)[::-1]
+    lat = lat[lat_idx]
+
+    lon = np.array(source_dataset.variables['lon'][:])
+    lon[lon > 180] = lon[lon > 180] - 360
+    lon_idx = np.argsort(lon)
+    lon = lon[lon_idx]
+    return lat, lat_idx, lon, lon_idx
+
+
+def open_output(output_file, output_format='netcdf'):
+    """ Create an output dataset, a netCDF4 Dataset or a zarr store with the same interface """
+    if output_format == 'zarr':
+        # Imported here, so netCDF conversions don't need zarr
+        import zarr_output
+        return zarr_output.ZarrDataset(output_file)
+    return Dataset(output_file, 'w', clobber=True, format='NETCDF4')
+
+
+def convert_product(source_dataset, output_file, product, esm, print_grid=False, max_slab_bytes=None, profile=None,
+                    pipeline_depth=0, browse_file=None, aggregate_file=None, overview_factors=None,
+                    output_format='netcdf', zarr_file=None, chunk_cache_bytes=None, quantization=None,
+                    mineral_layout='separate'):
+    """ Write a single L4 product (one suffix file) from the source dataset
+    Args:
+        source_dataset: open source netCDF dataset
+        output_file: path of the netCDF file, or of the zarr store if output_format is 'zarr', to write
+        product: product description from resolve_products
+        esm: earth system model name from the model lookup
+        print_grid: print the reordered lat/lon coordinates
+        max_slab_bytes: memory budget for streaming variables slab by slab, or None to load them whole
+        profile: output profile (compression and chunking) for the product variables
+        pipeline_depth: number of slabs prefetched by a reader process while writing, 0 reads and writes in turn
+        browse_file: if given and the product holds the browse variable, render its browse image to this path
+        aggregate_file: if given, write the time mean, climatologies and zonal means of the product to this path
+        overview_factors: if given, add overview groups coarsened over lat/lon by each of these factors
+        output_format: 'netcdf' or 'zarr'
+        zarr_file: if given, write a zarr store of the product to this path as well, in the same pass
+        chunk_cache_bytes: if given, limit the HDF5 chunk cache of each chunked variable to this size, otherwise
+                           every variable can keep up to the netCDF default (64 MB) cached until the file is closed
+        quantization: if given, a Quantization setting of the naming table ('nsd=<digits>' or 'nsb=<bits>') to round
+                      the product variables to before compression
+        mineral_layout: 'separate' to write a variable per mineral of a mineral repeat row, or 'stacked' to write
+                        them as a single variable along a leading mineral dimension
+    """
+    l4_names = product['l4_names']
+    l4_longnames = product['l4_longnames']
+    l4_units = product['l4_units']
+
+    print(f'Creating file {output_file} with variables:')
+    nc_ds = open_output(output_file, output_format)
+    if zarr_file is not None:
+        import zarr_output
+        print(f'Creating zarr store {zarr_file}')
+        nc_ds = zarr_output.TeeDataset([nc_ds, zarr_output.ZarrDataset(zarr_file + '.partial')])
+    add_main_metadata(nc_ds)
+
+    if esm == 'GISS ModelE2.1':
+        nc_ds.summary += "This version of GISS ModelE2.1 is described by Obiso et al. ACP (2024)"
+        nc_ds.input_description = "The FeOx (iron oxides) tracer contains both hematite and goethite; illite additionally contains chlorite and vermiculite.  A fraction of the non-iron-oxide minerals are mixed internally with iron oxides (Perlwitz et al., ACP 2015)."
+
+
+    nc_ds.sync()
+    stacked = mineral_layout == 'stacked' and product.get('minerals') is not None
+    if stacked:
+        nc_ds.createDimension(MINERAL_DIMENSION, len(product['minerals']))
+    # Add dimensions based on matching L4 variables in source dataset
+    for _n, name in enumerate(source_dataset.variables[l4_names[0]].dimensions):
+        nc_ds.createDimension(name, source_dataset.dimensions[name].size)
+
+    # Add variables for lat/lon/time
+    lat, lat_idx, lon, lon_idx = grid_order(source_dataset)
+
+    if print_grid:
+        print(lat)
+        print(lon)
+
+    # Account for slipage in the first/last lat index
+    lat[0] = lat[1] + (lat[1] - lat[2])
+    lat[-1] = lat[-2] - (lat[-3] - lat[-2])
+
+    add_variable(nc_ds, 'lat', source_dataset.variables['lat'].dtype, 'Latitude (WGS-84)', 'degrees_north',
+                 lat, {"dimensions": source_dataset.variables['lat'].dimensions})
+    add_variable(nc_ds, 'lon', source_dataset.variables['lon'].dtype, 'Longitude (WGS-84)', 'degrees_east',
+                 lon, {"dimensions": source_dataset.variables['lon'].dimensions})
+
+    if 'time' in nc_ds.dimensions:
+        add_variable(nc_ds, 'time', source_dataset.variables['time'].dtype, 'Time', 'none',
+                     source_dataset.variables['time'][:],
+                     {"dimensions": source_dataset.variables['time'].dimensions})
+
+    if stacked:
+        add_variable(nc_ds, MINERAL_DIMENSION, str, 'Mineral tracer', None, product['minerals'],
+                     {"dimensions": (MINERAL_DIMENSION,)})
+
+
+    # Add variables based on matching L4 variables in source dataset
+    quantization = parse_quantization(quantization)
+    jobs = []
+    if stacked:
+        # One variable for all the minerals of the row, read and written in slabs that span the minerals
+        dest_name = destination_name(product['short_name'])
+        print(f"Creating {dest_name} stacked from {', '.join(l4_names)}")
+        units = l4_units[0]
+        if esm == 'GISS ModelE2.1' and 'atm_min' in product['short_name']:
+            units = 'kg m-3'
+        jobs.append({'name': dest_name, 'source': list(l4_names), 'long_name': product['long_name'], 'units': units,
+                     'dimensions': (MINERAL_DIMENSION,) + source_dataset.variables[l4_names[0]].dimensions,
+                     'profile': stacked_profile(profile), 'chunk_cache_bytes': chunk_cache_bytes,
+                     'quantization': quantization})
+        l4_names = []
+    for _l4, l4_name in enumerate(l4_names):
+        dest_l4_name = destination_name(l4_name)
+        if dest_l4_name != l4_name:
+            print(f"Creating {dest_l4_name} (mapped from {l4_name})")
+        else:
+            print(f"Creating {dest_l4_name}")
+
+        units = l4_units[_l4]
+        if esm == 'GISS ModelE2.1' and 'atm_min' in l4_names[_l4]:
+            units = 'kg m-3'
+        jobs.append({'name': dest_l4_name, 'source': l4_name, 'long_name': l4_longnames[_l4], 'units': units,
+                     'dimensions': source_dataset.variables[l4_name].dimensions, 'profile': profile,
+                     'chunk_cache_bytes': chunk_cache_bytes, 'quantization': quantization})
+
+    observers = []
+    browse = None
+    if browse_file is not None and BROWSE_VARIABLE in [job['name'] for job in jobs]:
+        # Imported here, so conversions without a browse image don't need matplotlib
+        import browse_image
+        browse = browse_image.BrowseObserver(BROWSE_VARIABLE)
+        observers.append(browse)
+    aggregates = None
+    if aggregate_file is not None:
+        aggregate_kargs = None
+        if profile is not None:
+            # Aggregates are chunked and compressed like the product variables they summarize
+            aggregate_profile = stacked_profile(profile) if stacked else profile
+
+            def aggregate_kargs(dimensions, shape):
+                return profile_kargs(aggregate_profile, chunk_sizes(aggregate_profile, dimensions, shape))
+        aggregates = AggregateObserver(aggregate_file, aggregate_kargs)
+        observers.append(aggregates)
+    overviews = None
+    if overview_factors:
+        overviews = OverviewObserver(overview_factors)
+        observers.append(overviews)
+
+    if pipeline_depth > 0:
+        write_variables_pipelined(nc_ds, source_dataset, jobs, lat_idx, lon_idx, max_slab_bytes, pipeline_depth,
+                                  observers)
+    else:
+        for job in jobs:
+            add_variable(nc_ds, job['name'], "f4", job['long_name'], job['units'],
+                         source_variable(source_dataset, job['source']), {"dimensions": job['dimensions']},
+                         lat_order=lat_idx, lon_order=lon_idx, max_slab_bytes=max_slab_bytes, profile=job['profile'],
+                         observers=observers, chunk_cache_bytes=chunk_cache_bytes, quantization=job['quantization'])
+
+    title = product['long_name'].replace("_", " ").replace("radiativeforcing", "radiative forcing").replace("topofatmosphere", "top of atmosphere").title()
+    nc_ds.title += title
+    nc_ds.summary += product['description']
+
+    if overviews is not None:
+        overviews.finish(nc_ds)
+    with stage('sync'):
+        nc_ds.sync()
+    if aggregates is not None:
+        with stage('aggregates'):
+            aggregates.finish(nc_ds)
+    with stage('sync'):
+        nc_ds.close()
+    if zarr_file is not None:
+        zarr_output.replace_store(zarr_file + '.partial', zarr_file)
+
+    if browse is not None:
+        print(f'Creating browse image {browse_file}')
+        with stage('browse'):
+            browse_image.render_browse(browse.mean(), browse_file)
+
+
+def convert_product_worker(input_file, output_file, product, esm, options, monitoring=None):
+    """ Process pool entry point - opens its own source dataset and captures the product log
+    Returns:
+        the captured log text, the elapsed conversion time in seconds, the SHA-512 of the output file (None for
+        zarr stores) and the product run report
+    """
+    log = io.StringIO()
+    start_time = time.time()
+    with monitor(product['suffix'], **(monitoring or {})) as report:
+        with contextlib.redirect_stdout(log):
+            source_dataset = Dataset(input_file, 'r')
+            try:
+                convert_product(source_dataset, output_file, product, esm, **options)
+            finally:
+                source_dataset.close()
+        # Hash the file right after closing it, while it is still in the page cache
+        checksum = output_checksum(output_file)
+    return log.getvalue(), time.time() - start_time, checksum, report
+
+
+def output_checksum(path):
+    """ SHA-512 of an output file, None for zarr stores, which are directories """
+    return calc_checksum(path) if os.path.isfile(path) else None
+
+
+def output_size(path):
+    """ Size in bytes of an output file, or the total size of the files of a zarr store """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def product_report(report, output_file):
+    """ Run report of a product, with its output size and the input and output throughput """
+    report = dict(report, suffix=report['name'], output_bytes=output_size(output_file))
+    read_bytes = report['stages'].get('read', {}).get('bytes', 0)
+    report['input_mb_per_s'] = read_bytes / 1024**2 / max(report['seconds'], 1e-9)
+    report['output_mb_per_s'] = report['output_bytes'] / 1024**2 / max(report['seconds'], 1e-9)
+    return report
+
+
+def aggregate_sizes(out_shape, newkeys):
+    """ Accumulator memory and output size in bytes of the aggregates of a variable """
+    if 'lat' not in newkeys or 'lon' not in newkeys:
+        return 0, 0
+    size = int(np.prod(out_shape))
+    zonal = size // max(out_shape[newkeys.index('lon')], 1)
+    # Float64 sums and int32 counts, written out as float32 means
+    memory, disk = 12 * zonal, 4 * zonal
+    if 'time' in newkeys:
+        ntime = out_shape[newkeys.index('time')]
+        step = size // max(ntime, 1)
+        periods = 12 if ntime >= 12 and ntime % 12 == 0 else 1
+        memory += 12 * periods * step
+        disk += 4 * step * (1 + (12 + len(SEASONS) if periods == 12 else 0))
+    return memory, disk
+
+
+def browse_sizes(out_shape, newkeys):
+    """ Accumulator memory in bytes of the browse image of a variable """
+    size = int(np.prod([length for name, length in zip(newkeys, out_shape) if name not in ('time', 'bins')]))
+    # Float64 sums and int32 counts of the time and bin mean, and the validity of a time step whose bins are split
+    return 13 * size
+
+
+def overview_sizes(slab_bytes, itemsize, factors):
+    """ Working memory in bytes of the overview levels of a slab """
+    if not factors:
+        return 0
+    # The slab with the rows of its first coarse row read back, and the float64 sums and weights of each level
+    return slab_bytes + int(slab_bytes // itemsize * 16 * sum(1. / factor**2 for factor in factors))
+
+
+def estimate_product(source_dataset, product, options, size_guess_gb=None):
+    """ Predict the memory and disk use of converting a product
+    Args:
+        source_dataset: open source netCDF dataset
+        product: product description from resolve_products
+        options: convert_product keyword arguments of the product
+        size_guess_gb: Size Guess (GB) of the product in the L4 naming table, used if its variables can't be sized
+                       from the source
+
+    Returns:
+        dictionary with the suffix, the number of variables, the output data size, the predicted disk use and peak
+        memory in bytes, the slab and chunk cache sizes and where the estimate comes from
+    """
+    observed = options['aggregate_file'] is not None or bool(options['overview_factors']) or \
+        (options['browse_file'] is not None and BROWSE_VARIABLE in product['l4_names'])
+    chunk_cache_bytes = options.get('chunk_cache_bytes') or get_chunk_cache()[0]
+    estimate = {'suffix': product['suffix'], 'variables': 0, 'chunked_variables': 0, 'data_bytes': 0,
+                'slab_bytes': 0, 'cache_bytes': 0, 'accumulator_bytes': 0,
+                'max_slab_bytes': options['max_slab_bytes'], 'chunk_cache_bytes': options.get('chunk_cache_bytes'),
+                'observed': observed, 'streaming': False, 'estimated_from': 'source',
+                'size_guess_bytes': None if size_guess_gb is None else int(size_guess_gb * 1024**3)}
+    aggregate_disk = 0
+    aggregate_bytes = 0
+    browse_bytes = 0
+    profile = options['profile']
+    source_vars = [source_dataset.variables[l4_name] for l4_name in product['l4_names']
+                   if l4_name in source_dataset.variables]
+    stacked = options.get('mineral_layout') == 'stacked' and product.get('minerals') is not None
+    if stacked and source_vars:
+        # A single variable, with slabs and chunks that span the minerals
+        source_vars = [MineralStack(source_vars)]
+        profile = stacked_profile(profile)
+    for source_var in source_vars:
+        newkeys, idx = output_dimensions(source_var.dimensions)
+        out_shape = [source_var.shape[i] for i in idx]
+        chunks = None if profile is None else chunk_sizes(profile, newkeys, out_shape)
+        variable_bytes = 4 * int(np.prod(out_shape))
+        estimate['variables'] += 1
+        estimate['data_bytes'] += variable_bytes
+        estimate['slab_bytes'] = max(estimate['slab_bytes'],
+                                     slab_nbytes(out_shape, source_var.dtype.itemsize, newkeys,
+                                                 options['max_slab_bytes'], chunks))
+        if chunks is not None and options['output_format'] == 'netcdf':
+            # Written chunks stay in the HDF5 chunk cache of the variable until the file is closed
+            estimate['chunked_variables'] += 1
+            estimate['cache_bytes'] += min(variable_bytes, chunk_cache_bytes)
+        if options['aggregate_file'] is not None:
+            # Aggregates are written as soon as their variable is complete, so only one variable's sums are held
+            memory, disk = aggregate_sizes(out_shape, newkeys)
+            aggregate_bytes = max(aggregate_bytes, memory)
+            aggregate_disk += disk
+        if options['browse_file'] is not None and not stacked and source_var.name == BROWSE_VARIABLE:
+            browse_bytes = browse_sizes(out_shape, newkeys)
+
+    if estimate['variables'] == 0 and estimate['size_guess_bytes'] is not None:
+        estimate.update(variables=1 if stacked else len(product['l4_names']), data_bytes=estimate['size_guess_bytes'],
+                        estimated_from='size guess')
+        variable_bytes = estimate['data_bytes'] // max(estimate['variables'], 1)
+        estimate['slab_bytes'] = variable_bytes if options['max_slab_bytes'] is None else \
+            min(variable_bytes, options['max_slab_bytes'])
+
+    overview_bytes = 0
+    if options['overview_factors']:
+        overview_bytes = int(estimate['data_bytes'] * sum(1. / factor**2 for factor in options['overview_factors']))
+        if options['output_format'] == 'netcdf':
+            estimate['cache_bytes'] += overview_bytes
+
+    # Observer state - the aggregates of one variable at a time, the browse mean and the overviews of a slab
+    estimate['accumulator_bytes'] = aggregate_bytes + browse_bytes + \
+        overview_sizes(estimate['slab_bytes'], 4, options['overview_factors'])
+
+    processes = 2 if options['pipeline_depth'] > 0 else 1
+    estimate['memory_bytes'] = processes * PROCESS_BASE_BYTES + estimate['accumulator_bytes'] + \
+        estimate['cache_bytes'] + slab_memory(estimate['slab_bytes'], options['pipeline_depth'], observed)
+    if options['quantization'] is not None:
+        # The rounded copy of a slab
+        estimate['memory_bytes'] += estimate['slab_bytes']
+    # Uncompressed sizes, compressed profiles write less
+    disk_bytes = (estimate['data_bytes'] + overview_bytes) * (2 if options['zarr_file'] is not None else 1)
+    estimate['disk_bytes'] = disk_bytes + aggregate_disk
+    return estimate
+
+
+def fit_product(source_dataset, product, options, budget_bytes=None, size_guess_gb=None):
+    """ Estimate a product, and if it would not fit the memory budget, limit the chunk caches of its variables and
+    stream it in slabs small enough to stay within the budget
+    Returns:
+        the product estimate, with streaming set and max_slab_bytes and chunk_cache_bytes the sizes to convert it
+        with if it was fitted
+    """
+    estimate = estimate_product(source_dataset, product, options, size_guess_gb)
+    if budget_bytes is None or estimate['memory_bytes'] <= budget_bytes:
+        return estimate
+
+    processes = 2 if options['pipeline_depth'] > 0 else 1
+    available = budget_bytes - processes * PROCESS_BASE_BYTES - estimate['accumulator_bytes']
+    options = dict(options)
+    if estimate['chunked_variables'] > 0:
+        # Half of what is left goes to the chunk caches, which work best holding a few slabs
+        options['chunk_cache_bytes'] = min(get_chunk_cache()[0],
+                                           max(MIN_SLAB_BYTES, available // 2 // estimate['chunked_variables']))
+        available -= options['chunk_cache_bytes'] * estimate['chunked_variables']
+    max_slab_bytes = streaming_slab_bytes(available, options['pipeline_depth'], estimate['observed'])
+    if options['chunk_cache_bytes'] is not None:
+        max_slab_bytes = min(max_slab_bytes, options['chunk_cache_bytes'] // 4)
+    if options['max_slab_bytes'] is not None:
+        max_slab_bytes = min(max_slab_bytes, options['max_slab_bytes'])
+    options['max_slab_bytes'] = max(MIN_SLAB_BYTES, max_slab_bytes)
+
+    estimate = estimate_product(source_dataset, product, options, size_guess_gb)
+    estimate['streaming'] = True
+    return estimate
+
+
+def source_identity(path):
+    """ Identity of a source file as recorded in the manifest """
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def load_manifest(manifest_path):
+    """ Load the conversion manifest of a granule, or start an empty one """
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    return {'products': {}}
+
+
+def write_manifest(manifest_path, manifest):
+    """ Atomically replace the conversion manifest of a granule """
+    with open(manifest_path + '.partial', 'w') as f:
+        f.write(json.dumps(manifest, indent=2, default=str))
+    os.replace(manifest_path + '.partial', manifest_path)
+
+
+def product_is_current(entry, expected, output_file):
+    """ Check whether a manifest entry describes a complete output that matches the expected source, naming row and
+    conversion options """
+    if entry is None or entry.get('status') != 'complete' or not os.path.exists(output_file):
+        return False
+    if output_size(output_file) != entry.get('size'):
+        return False
+    # Compare through JSON, so tuples and numpy scalars compare the same way as the stored values
+    expected = json.loads(json.dumps(expected, default=str))
+    return all(entry.get(key) == expected[key] for key in ('file', 'source', 'row', 'options'))
+
+
+def complete_product(manifest_path, manifest, suffix, output_file, checksums=None, checksum=None):
+    """ Move a finished product into place, record its checksum in the sidecar and mark it complete in the
+    manifest """
+    if os.path.isdir(output_file):
+        shutil.rmtree(output_file)
+    os.replace(output_file + '.partial', output_file)
+    if checksums is not None and checksum is not None:
+        # Renaming keeps the size and mtime the checksum was computed for
+        checksums.add(output_file, checksum)
+        checksums.save()
+    entry = manifest['products'][suffix]
+    entry['status'] = 'complete'
+    entry['size'] = output_size(output_file)
+    entry['completed'] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    write_manifest(manifest_path, manifest)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_table(path, mtime):
+    return pd.read_csv(path)
+
+
+def read_table(path):
+    """ Parsed CSV table (models.csv, L4_varnames.csv), cached per process until the file changes """
+    return _read_table(os.path.abspath(path), os.path.getmtime(path))
+
+
+def conversion_parser():
     parser = argparse.ArgumentParser(description='netcdf conversion')
     parser.add_argument('input_file', type=str)
     parser.add_argument('--output_dir', default='.')
@@ -166,17 +1173,91 @@ def main():
     parser.add_argument('--use_dimensions', nargs=5, default=[1,1,1,1,1])
     parser.add_argument('--l4_naming_file', default='data/L4_varnames.csv')
     parser.add_argument('--model_lookup', default='data/models.csv')
-    args = parser.parse_args()
+    parser.add_argument('--slab_mb', type=float, default=None,
+                        help='Stream each variable in slabs of at most this many MB instead of loading it whole')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes used to convert the products in parallel')
+    parser.add_argument('--memory_budget_gb', type=float, default=None,
+                        help='Schedule the products so their predicted memory use stays within this many GB, largest '
+                             'first, and stream those that would not fit in slabs')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the schedule with the predicted peak memory and disk use, without converting')
+    parser.add_argument('--pipeline_depth', type=int, default=0,
+                        help='Prefetch this many slabs in a reader process while writing, 0 disables the pipeline')
+    parser.add_argument('--browse', action='store_true',
+                        help='Render the granule browse image while the browse variable is converted')
+    parser.add_argument('--aggregates', nargs='*', default=None, metavar='SUFFIX',
+                        help='Write time mean, climatology and zonal mean companion files for these products, '
+                             'or for all products if no suffix is given')
+    parser.add_argument('--overviews', nargs='*', type=int, default=None, metavar='FACTOR',
+                        help=f'Add overview groups coarsened over lat/lon by these factors, {OVERVIEW_FACTORS} if no '
+                             f'factor is given')
+    parser.add_argument('--output_format', choices=['netcdf', 'zarr', 'both'], default='netcdf',
+                        help='Write each product as a netCDF file, a zarr store, or both in the same pass')
+    parser.add_argument('--chunk_index', action='store_true',
+                        help='Write a byte-range chunk index <file>.index.json next to every netCDF file of the granule')
+    parser.add_argument('--run_report', action='store_true',
+                        help='Write stage timings, byte counts and peak memory per product to '
+                             '<granule>.run_report.json')
+    parser.add_argument('--profile_dir', default=None,
+                        help='Run each product under cProfile and write <SUFFIX>.prof files to this directory')
+    parser.add_argument('--trace_memory', action='store_true',
+                        help='Trace Python allocations with tracemalloc and report their peak per product')
+    parser.add_argument('--mineral_layout', choices=MINERAL_LAYOUTS, default='separate',
+                        help='Write mineral repeat rows as a variable per mineral, or stacked into one variable with a '
+                             'mineral dimension and coordinate')
+    parser.add_argument('--quantize', nargs='*', default=None, metavar='SUFFIX=SETTING',
+                        help='Round the product variables to the precision in the Quantization column before '
+                             'compression, or for individual products to the given setting, e.g. ATMMIN=nsd=3')
+    parser.add_argument('--force', action='store_true',
+                        help='Rebuild every product, even if the manifest lists it as complete and up to date')
+    parser.add_argument('--output_profile', choices=list(OUTPUT_PROFILES), default=None,
+                        help='Output profile for all products, overriding the Output Profile column')
+    parser.add_argument('--product_profile', nargs='*', default=[], metavar='SUFFIX=PROFILE',
+                        help='Output profile for individual products, e.g. WETDEP=timeseries')
+    parser.add_argument('--compression', choices=['zlib', 'zstd'], default=None,
+                        help='Override the compression filter of the selected profiles')
+    parser.add_argument('--complevel', type=int, default=None,
+                        help='Override the compression level of the selected profiles')
+    return parser
+
+
+def partial_paths(output_file, options):
+    """ Temporary outputs of a product, which are only moved into place once it is complete """
+    return [output_file + '.partial'] + [path + '.partial' for path in [options['aggregate_file'], options['zarr_file']]
+                                         if path is not None]
+
+
+def remove_partials(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
 
-    lk = pd.read_csv(args.model_lookup)
+def convert_granule(args, pool=None):
+    """ Convert a source ESM file into the products of its granule
+    Args:
+        args: parsed conversion_parser arguments
+        pool: if given, a process pool of args.workers workers to convert the products with, instead of one made for
+              this granule
+
+    Returns:
+        the granule directory
+    """
+    max_slab_bytes = None if args.slab_mb is None else int(args.slab_mb * 1024**2)
+
+    lk = read_table(args.model_lookup)
     lk_idx = lk["Input Filename"] == os.path.basename(args.input_file)
     output_base = lk.loc[lk_idx, "Granule Name"].values[0]
+    esm = lk['ESM'][lk_idx].values[0]
     print(f"Using granule name from lookup: {output_base}")
     output_dir = os.path.join(args.output_dir, output_base)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    l4_naming = pd.read_csv(args.l4_naming_file)
+    l4_naming = read_table(args.l4_naming_file)
     # Add duplicated mapped rows
     for k, v in VARIABLE_MAPPING.items():
         mapped_row = l4_naming.loc[l4_naming['Short Name'] == v].copy()
@@ -184,100 +1265,216 @@ def main():
         l4_naming = l4_naming.append(mapped_row, ignore_index=True)
 
     source_dataset = Dataset(args.input_file, 'r')
+    pending = []
+    try:
+        products, resolved_names = resolve_products(source_dataset, l4_naming)
 
-    resolved_names = []
-    leftover_names = []
+        product_profiles = dict(x.split('=', 1) for x in args.product_profile)
+        for product in products:
+            profile_name = product_profiles.get(product['suffix'], args.output_profile or product['profile'])
+            if profile_name not in OUTPUT_PROFILES:
+                raise ValueError(f'Unknown output profile {profile_name} for {product["suffix"]}')
+            product['profile'] = profile_name
 
+        # Quantization is opt-in, with the precision of each product from the naming table or the command line
+        product_quantization = dict(x.split('=', 1) for x in args.quantize or [])
+        for product in products:
+            setting = None
+            if args.quantize is not None:
+                setting = product_quantization.get(product['suffix'], product['quantization'])
+            product['quantization'] = None if parse_quantization(setting) is None else str(setting).strip()
 
-    #for varname in list(source_dataset.variables):
-    for _v, varname in enumerate(l4_naming['Short Name']):
-        
-        l4_names = []
-        l4_longnames = []
-        l4_units = []
-        if l4_naming['Mineral Repeat'][_v]:
-            for mineral_name in ACCEPTED_MINERAL_NAMES:
-                ds_name = varname + "_" + mineral_name
-                ds_longname = l4_naming['Long Name'][_v] + " " + mineral_name
-                if ds_name in list(source_dataset.variables):
-                    l4_names.append(ds_name)
-                    l4_longnames.append(ds_longname)
-                    l4_units.append(l4_naming['Units'][_v])
-                    resolved_names.append(varname)
-        else:
-            if varname in list(source_dataset.variables):
-                l4_names.append(varname)
-                l4_longnames.append(l4_naming['Long Name'][_v])
-                l4_units.append(l4_naming['Units'][_v])
-                resolved_names.append(varname)
+        def product_options(product):
+            profile = dict(OUTPUT_PROFILES[product['profile']])
+            if 'chunks' in profile:
+                if args.compression is not None:
+                    profile['compression'] = args.compression
+                if args.complevel is not None:
+                    profile['complevel'] = args.complevel
+            return {'max_slab_bytes': product.get('max_slab_bytes', max_slab_bytes), 'profile': profile, 'print_grid': product['row'] == 0,
+                    'pipeline_depth': args.pipeline_depth, 'browse_file': browse_file,
+                    'aggregate_file': aggregate_files.get(product['suffix']), 'overview_factors': overview_factors,
+                    'output_format': 'zarr' if args.output_format == 'zarr' else 'netcdf',
+                    'zarr_file': zarr_files.get(product['suffix']),
+                    'chunk_cache_bytes': product.get('chunk_cache_bytes'), 'quantization': product['quantization'],
+                    'mineral_layout': args.mineral_layout}
 
-        if len(l4_names) > 0:
-            # Now make the output
-            print(f'Creating file {output_dir}/{output_base}' + f'_{l4_naming["Suffix"][_v]}.nc with variables:')
-            nc_ds = Dataset(f'{output_dir}/{output_base}' + f'_{l4_naming["Suffix"][_v]}.nc', 'w', clobber=True, format='NETCDF4')
-            add_main_metadata(nc_ds)
+        extension = 'zarr' if args.output_format == 'zarr' else 'nc'
+        output_files = [f'{output_dir}/{output_base}_{product["suffix"]}.{extension}' for product in products]
+        # With both formats, the zarr store is written alongside each netCDF file
+        zarr_files = {}
+        if args.output_format == 'both':
+            zarr_files = {product['suffix']: f'{output_dir}/{output_base}_{product["suffix"]}.zarr'
+                          for product in products}
+        browse_file = os.path.join(output_dir, f'{output_base}.png') if args.browse else None
+        overview_factors = None
+        if args.overviews is not None:
+            overview_factors = args.overviews or OVERVIEW_FACTORS
+        aggregate_files = {}
+        if args.aggregates is not None:
+            aggregate_files = {product['suffix']: aggregate_path(output_dir, output_base, product['suffix'])
+                               for product in products
+                               if len(args.aggregates) == 0 or product['suffix'] in args.aggregates}
 
-            if lk['ESM'][lk_idx].values[0] == 'GISS ModelE2.1':
-                nc_ds.summary += "This version of GISS ModelE2.1 is described by Obiso et al. ACP (2024)"
-                nc_ds.input_description = "The FeOx (iron oxides) tracer contains both hematite and goethite; illite additionally contains chlorite and vermiculite.  A fraction of the non-iron-oxide minerals are mixed internally with iron oxides (Perlwitz et al., ACP 2015)."
+        # Skip products that the manifest lists as complete for this source file, naming row and options
+        manifest_path = os.path.join(output_dir, f'{output_base}.manifest.json')
+        manifest = load_manifest(manifest_path)
+        manifest['granule'] = output_base
+        source_id = source_identity(args.input_file)
+        pending = []
+        for product, output_file in zip(products, output_files):
+            options = product_options(product)
+            entry = {'file': os.path.basename(output_file),
+                     'source': source_id,
+                     'row': {k: str(v) for k, v in l4_naming.iloc[product['row']].items()},
+                     'options': {'profile': options['profile'], 'variable_mapping': VARIABLE_MAPPING},
+                     'status': 'pending'}
+            if overview_factors:
+                entry['options']['overviews'] = overview_factors
+            if product['quantization'] is not None:
+                entry['options']['quantization'] = product['quantization']
+            if args.mineral_layout == 'stacked' and product['minerals'] is not None:
+                entry['options']['mineral_layout'] = args.mineral_layout
+            # A missing browse image is made by converting the browse variable again
+            browse_missing = browse_file is not None and not os.path.exists(browse_file) and \
+                BROWSE_VARIABLE in product['l4_names']
+            # Likewise a missing aggregate companion or zarr store
+            companion_missing = any(path is not None and not os.path.exists(path)
+                                    for path in [options['aggregate_file'], options['zarr_file']])
+            if not args.force and not browse_missing and not companion_missing and \
+                    product_is_current(manifest['products'].get(product['suffix']), entry, output_file):
+                print(f'Skipping {output_file}, it is complete and up to date')
+                continue
+            manifest['products'][product['suffix']] = entry
+            pending.append((product, output_file))
 
+        # Predict the memory and disk use of the pending products, and stream those that would not fit the budget
+        budget_bytes = None if args.memory_budget_gb is None else int(args.memory_budget_gb * 1024**3)
+        # Worker processes share the budget with the main process
+        worker_budget = budget_bytes
+        if budget_bytes is not None and args.workers > 1:
+            worker_budget = budget_bytes - PROCESS_BASE_BYTES
+        schedule = None
+        if budget_bytes is not None or args.plan:
+            estimates = []
+            for product, output_file in pending:
+                size_guess = l4_naming['Size Guess (GB)'][product['row']] if 'Size Guess (GB)' in l4_naming else None
+                estimate = fit_product(source_dataset, product, product_options(product), worker_budget,
+                                       size_guess if pd.notna(size_guess) else None)
+                if estimate['streaming']:
+                    product['max_slab_bytes'] = estimate['max_slab_bytes']
+                    product['chunk_cache_bytes'] = estimate['chunk_cache_bytes']
+                estimates.append(dict(estimate, product=product, output_file=output_file))
+            schedule, peak_bytes = simulate_schedule(order_schedule(estimates, worker_budget), worker_budget,
+                                                     args.workers)
+            if args.workers > 1:
+                peak_bytes += PROCESS_BASE_BYTES
+            print_plan(schedule, peak_bytes, sum(entry['disk_bytes'] for entry in schedule),
+                       shutil.disk_usage(output_dir).free, budget_bytes, args.workers)
+            if args.plan:
+                return output_dir
+            if budget_bytes is not None:
+                pending = [(entry['product'], entry['output_file']) for entry in schedule]
+        write_manifest(manifest_path, manifest)
 
-            nc_ds.sync()
-            # Add dimensions based on matching L4 variables in source dataset
-            for _n, name in enumerate(source_dataset.variables[l4_names[0]].dimensions):
-                nc_ds.createDimension(name, source_dataset.dimensions[name].size)
-
-            # Add variables for lat/lon/time
-            lat = np.array(source_dataset.variables['lat'][:])
-            lat_idx = np.argsort(lat)[::-1]
-            lat = lat[lat_idx]
-
-            lon = np.array(source_dataset.variables['lon'][:])
-            lon[lon > 180] = lon[lon > 180] - 360
-            lon_idx = np.argsort(lon)
-            lon = lon[lon_idx]
-
-            if _v == 0:
-                print(lat)
-                print(lon)
-
-            # Account for slipage in the first/last lat index
-            lat[0] = lat[1] + (lat[1] - lat[2])
-            lat[-1] = lat[-2] - (lat[-3] - lat[-2])
-
-            add_variable(nc_ds, 'lat', source_dataset.variables['lat'].dtype, 'Latitude (WGS-84)', 'degrees_north',
-                         lat, {"dimensions": source_dataset.variables['lat'].dimensions})
-            add_variable(nc_ds, 'lon', source_dataset.variables['lon'].dtype, 'Longitude (WGS-84)', 'degrees_east',
-                         lon, {"dimensions": source_dataset.variables['lon'].dimensions})
-
-            if 'time' in nc_ds.dimensions:
-                add_variable(nc_ds, 'time', source_dataset.variables['time'].dtype, 'Time', 'none',
-                             source_dataset.variables['time'][:],
-                             {"dimensions": source_dataset.variables['time'].dimensions})
-
-
-            # Add variables based on matching L4 variables in source dataset
-            for _l4, l4_name in enumerate(l4_names):
-                dest_l4_name = l4_name
-                for k, v in VARIABLE_MAPPING.items():
-                    if l4_name.startswith(k):
-                        dest_l4_name = l4_name.replace(k, v)
-                if dest_l4_name != l4_name:
-                    print(f"Creating {dest_l4_name} (mapped from {l4_name})")
+        # Sizes and checksums of the finished products, for daac_delivery.py to reuse instead of reading them back
+        checksums = ChecksumCache(sidecar_path(output_dir, output_base))
+
+        # Stage timings and peak memory of each product, for the run report
+        monitoring = {'profile_dir': args.profile_dir, 'trace_memory': args.trace_memory}
+        product_reports = []
+        run_start_time = time.time()
+
+        # Products are written under a temporary name and only moved into place once complete
+        if args.workers > 1:
+            source_dataset.close()
+            print(f'Converting {len(pending)} products with {args.workers} worker processes')
+            if pool is None:
+                # Spawn rather than fork, so no HDF5 library state is shared with the workers
+                pool_context = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                # A long-running conversion worker passes its own pool, so the processes stay warm across granules
+                pool_context = contextlib.nullcontext(pool)
+            with pool_context as pool:
+                submitted = {}
+                completed = set()
+
+                def submit(product, output_file):
+                    future = pool.submit(convert_product_worker, args.input_file, output_file + '.partial', product,
+                                         esm, product_options(product), monitoring)
+                    submitted[future] = (product, output_file)
+                    return future
+
+                if budget_bytes is not None:
+                    # Start products as the memory budget allows, and report them as they finish
+                    finished = ((entry['product'], entry['output_file'], future) for entry, future in
+                                run_scheduled(schedule, lambda entry: submit(entry['product'], entry['output_file']),
+                                              worker_budget, args.workers))
                 else:
-                    print(f"Creating {dest_l4_name}")
-                
-                units = l4_units[_l4]
-                if lk['ESM'][lk_idx].values[0] == 'GISS ModelE2.1' and 'atm_min' in l4_names[_l4]:
-                    units = 'kg m-3'
-                add_variable(nc_ds, dest_l4_name, "f4", l4_longnames[_l4], units, source_dataset.variables[l4_name][:], {"dimensions": source_dataset.variables[l4_name].dimensions}, lat_order=lat_idx, lon_order=lon_idx)
+                    futures = [submit(product, output_file) for product, output_file in pending]
+                    # Report in product order, so logs from different workers never interleave
+                    finished = ((product, output_file, future)
+                                for (product, output_file), future in zip(pending, futures))
 
-            title = l4_naming['Long Name'][_v].replace("_", " ").replace("radiativeforcing", "radiative forcing").replace("topofatmosphere", "top of atmosphere").title()
-            nc_ds.title += title
-            nc_ds.summary += l4_naming['Description'][_v]
+                try:
+                    for _p, (product, output_file, future) in enumerate(finished):
+                        log, elapsed, checksum, report = future.result()
+                        complete_product(manifest_path, manifest, product['suffix'], output_file, checksums, checksum)
+                        completed.add(product['suffix'])
+                        product_reports.append(product_report(report, output_file))
+                        print(f'[{_p + 1}/{len(pending)}] {product["suffix"]} finished in {elapsed:.1f} s')
+                        print(log, end='')
+                except BaseException:
+                    # Products not started yet are dropped, and those running are left to finish, so no worker is still
+                    # writing when the temporary outputs are removed.  Products that did finish are kept.
+                    for future in submitted:
+                        future.cancel()
+                    wait(submitted)
+                    for future, (product, output_file) in submitted.items():
+                        if product['suffix'] not in completed and not future.cancelled() and \
+                                future.exception() is None:
+                            complete_product(manifest_path, manifest, product['suffix'], output_file, checksums,
+                                             future.result()[2])
+                    raise
+        else:
+            for product, output_file in pending:
+                with monitor(product['suffix'], **monitoring) as report:
+                    convert_product(source_dataset, output_file + '.partial', product, esm, **product_options(product))
+                    checksum = output_checksum(output_file + '.partial')
+                complete_product(manifest_path, manifest, product['suffix'], output_file, checksums, checksum)
+                product_reports.append(product_report(report, output_file))
+    except BaseException:
+        # A failed granule leaves no temporary outputs behind; complete products stay in place and in the manifest
+        for product, output_file in pending:
+            remove_partials(partial_paths(output_file, product_options(product)))
+        raise
+    finally:
+        if source_dataset.isopen():
+            source_dataset.close()
 
-            nc_ds.sync()
-            nc_ds.close()
+    if args.chunk_index:
+        # Imported here, so conversions without chunk indexes don't need h5py
+        import chunk_index
+        for nc_path in sorted(glob.glob(os.path.join(output_dir, f'{output_base}*.nc'))):
+            if not chunk_index.index_is_current(nc_path):
+                print(f'Creating chunk index {chunk_index.write_index(nc_path)}')
+
+    if args.run_report:
+        report_path = os.path.join(output_dir, f'{output_base}.run_report.json')
+        print(f'Writing run report {report_path}')
+        write_report(report_path, {'granule': output_base,
+                                   'source': source_id,
+                                   'started': datetime.utcfromtimestamp(run_start_time).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                                   'seconds': time.time() - run_start_time,
+                                   'arguments': vars(args),
+                                   'skipped': [product['suffix'] for product in products
+                                               if product['suffix'] not in [p['suffix'] for p, _ in pending]],
+                                   'peak_rss_mb': max([r['peak_rss_mb'] for r in product_reports], default=0.),
+                                   'stages': total_stages(product_reports),
+                                   'products': product_reports,
+                                   'plan': None if schedule is None else
+                                   [{k: v for k, v in entry.items() if k not in ('product', 'output_file')}
+                                    for entry in schedule]})
 
     resolved_names = np.unique(np.array(resolved_names)).tolist()
     for k, v in VARIABLE_MAPPING.items():
@@ -289,11 +1486,11 @@ def main():
     for varname in l4_naming['Short Name']:
         if varname not in resolved_names:
             print(varname)
-    
-
-    
+    return output_dir
 
 
+def main():
+    convert_granule(conversion_parser().parse_args())
 
 
 if __name__ == "__main__":
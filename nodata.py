@@ -0,0 +1,14 @@
+"""
+Fill value of the L4 products, shared by the conversion and the modules that read or derive from its output
+"""
+
+import numpy as np
+
+
+NODATA = -9999
+
+
+def masked_block(block):
+    """ Block as a float64 masked array, with fill values, masked and NaN entries masked """
+    data = np.ma.masked_invalid(np.ma.asarray(block, dtype=np.float64))
+    return np.ma.masked_where(np.ma.getdata(data) == NODATA, data)
@@ -0,0 +1,120 @@
+"""
+Coarsened overview levels of the L4 product variables, for cheap low-zoom reads
+"""
+
+import numpy as np
+
+from nodata import NODATA, masked_block
+
+
+# Coarsening factors of the overview levels over lat and lon
+OVERVIEW_FACTORS = [2, 4, 8]
+
+
+def overview_group(factor):
+    """ Name of the group holding an overview level """
+    return f'overview_{factor}x'
+
+
+def coarsen(block, weights, factor):
+    """ Area-weighted block average of the trailing lat and lon axes of a block
+    Args:
+        block: array with lat and lon as its last two axes, fill values and NaNs are ignored
+        weights: area weight of each latitude row
+        factor: number of cells averaged along each of lat and lon; edge blocks average the cells present
+
+    Returns:
+        masked float32 array, masked where a coarse cell holds no valid data
+    """
+    data = masked_block(block)
+    nlat, nlon = data.shape[-2:]
+    pad = [(0, 0)] * (data.ndim - 2) + [(0, -nlat % factor), (0, -nlon % factor)]
+    cell_weights = np.where(np.ma.getmaskarray(data), 0., weights[:, np.newaxis])
+    values = np.pad(np.ma.filled(data, 0) * cell_weights, pad)
+    cell_weights = np.pad(cell_weights, pad)
+
+    shape = data.shape[:-2] + (values.shape[-2] // factor, factor, values.shape[-1] // factor, factor)
+    total = values.reshape(shape).sum(axis=(-3, -1))
+    weight = cell_weights.reshape(shape).sum(axis=(-3, -1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.ma.array(total / np.where(weight > 0, weight, 1), mask=weight == 0).astype(np.float32)
+
+
+class OverviewObserver:
+    """Writes coarsened overview levels of every lat/lon variable from the slabs written during conversion.
+
+    Each level is a group of the output dataset, with the variables under their own names.  Every slab is coarsened
+    on its own and written to the same slices of the other dimensions.  Slabs split along lat may start within a
+    coarse row, whose first rows are then read back from the variable.  Cells are weighted by the cosine of their latitude.  finish() adds the coordinates and grid mapping of each
+    level once all variables are written.
+    """
+
+    def __init__(self, factors=OVERVIEW_FACTORS):
+        self.factors = list(factors)
+        self.weights = None
+
+    def __call__(self, nc_var, out_slices, out_dat):
+        dimensions = list(nc_var.dimensions)
+        if dimensions[-2:] != ['lat', 'lon']:
+            return
+        nc_ds = nc_var.group()
+        if self.weights is None:
+            self.weights = np.cos(np.deg2rad(np.asarray(nc_ds.variables['lat'][:], dtype=np.float64)))
+
+        lat_ax = len(dimensions) - 2
+        start, stop, _ = out_slices[lat_ax].indices(nc_var.shape[lat_ax])
+        for factor in self.factors:
+            group = self._group(nc_ds, factor)
+            if nc_var.name not in group.variables:
+                level_var = group.createVariable(nc_var.name, 'f4', nc_var.dimensions, fill_value=NODATA,
+                                                 compression='zlib', complevel=4, shuffle=True)
+                # Coarse means are not quantized, even if the full resolution values are
+                level_var.setncatts({attr: nc_var.getncattr(attr) for attr in nc_var.ncattrs()
+                                     if attr not in ('_FillValue', 'grid_mapping') and
+                                     not attr.startswith('quantization')})
+                level_var.grid_mapping = 'latitude_longitude'
+            block = out_dat
+            first = start - start % factor
+            if first < start:
+                # The coarse row started in the previous slab, which has already been written
+                previous = list(out_slices)
+                previous[lat_ax] = slice(first, start)
+                block = np.ma.concatenate([nc_var[tuple(previous)], out_dat], axis=lat_ax)
+            level_slices = list(out_slices)
+            level_slices[lat_ax] = slice(first // factor, -(-stop // factor))
+            group.variables[nc_var.name][tuple(level_slices)] = coarsen(block, self.weights[first:stop], factor)
+
+    @staticmethod
+    def _group(nc_ds, factor):
+        name = overview_group(factor)
+        if name in nc_ds.groups:
+            return nc_ds.groups[name]
+        group = nc_ds.createGroup(name)
+        group.overview_factor = np.int32(factor)
+        # Other dimensions are inherited from the parent dataset
+        group.createDimension('lat', -(-len(nc_ds.dimensions['lat']) // factor))
+        group.createDimension('lon', -(-len(nc_ds.dimensions['lon']) // factor))
+        return group
+
+    def finish(self, nc_ds):
+        """ Add the coordinates and the latitude_longitude grid mapping of every overview level """
+        if 'latitude_longitude' not in nc_ds.variables:
+            return
+        grid_mapping = nc_ds.variables['latitude_longitude']
+        x0, dlon, _, y0, _, dlat = [float(x) for x in grid_mapping.GeoTransform.split()]
+        for factor in self.factors:
+            name = overview_group(factor)
+            if name not in nc_ds.groups:
+                continue
+            group = nc_ds.groups[name]
+            level_grid_mapping = group.createVariable('latitude_longitude', 'i4')
+            level_grid_mapping.GeoTransform = f"{x0} {dlon * factor} 0 {y0} 0 {dlat * factor} "
+            level_grid_mapping.spatial_ref = grid_mapping.spatial_ref
+
+            # Coordinates are the mean of the full resolution coordinates of each coarse cell
+            for coord in ['lat', 'lon']:
+                source_var = nc_ds.variables[coord]
+                values = np.asarray(source_var[:], dtype=np.float64)
+                nc_var = group.createVariable(coord, 'f8', (coord,))
+                nc_var.setncatts({attr: source_var.getncattr(attr) for attr in source_var.ncattrs()})
+                nc_var[:] = [values[_i:_i + factor].mean() for _i in range(0, len(values), factor)]
@@ -0,0 +1,88 @@
+"""
+Precision-bounded quantization of the L4 product variables, applied before compression
+"""
+
+import math
+
+import numpy as np
+
+from nodata import NODATA
+
+
+# Explicit mantissa bits of a float32
+F4_MANTISSA_BITS = 23
+
+# Name of the CF quantization container variable
+QUANTIZATION_VARIABLE = 'quantization_info'
+
+
+def parse_quantization(setting):
+    """ Parse a quantization setting of the L4 naming table
+    Args:
+        setting: 'nsd=<digits>' to keep that many significant decimal digits, 'nsb=<bits>' to keep that many
+                 significant mantissa bits, or an empty value for none
+
+    Returns:
+        dictionary with the nsd or nsb key, or None if the variable is not quantized
+    """
+    if setting is None or (isinstance(setting, float) and math.isnan(setting)) or str(setting).strip() == '':
+        return None
+    name, _, value = str(setting).strip().partition('=')
+    if name not in ('nsd', 'nsb') or not value.isdigit():
+        raise ValueError(f'Invalid quantization {setting}, expected nsd=<digits> or nsb=<bits>')
+    value = int(value)
+    if not 1 <= value <= (7 if name == 'nsd' else F4_MANTISSA_BITS):
+        raise ValueError(f'Quantization {setting} is out of range for float32')
+    return {name: value}
+
+
+def keep_bits(quantization):
+    """ Number of mantissa bits kept for a quantization, enough to keep nsd significant decimal digits """
+    if 'nsb' in quantization:
+        return quantization['nsb']
+    return min(F4_MANTISSA_BITS, math.ceil(quantization['nsd'] * math.log2(10)))
+
+
+def max_relative_error(keepbits):
+    """ Largest relative error of rounding to keepbits mantissa bits """
+    return 2. ** -(keepbits + 1)
+
+
+def bitround(data, keepbits):
+    """ Round float32 data to keepbits mantissa bits, to nearest with ties to even, so the trailing bits are zero
+    and compress well
+    Args:
+        data: array or masked array, converted to float32
+        keepbits: number of explicit mantissa bits kept
+
+    Returns:
+        rounded float32 copy of data, with the same mask.  Fill values, NaNs and infinities are left as they are
+    """
+    values = np.array(np.ma.getdata(data), dtype=np.float32)
+    if keepbits < F4_MANTISSA_BITS:
+        shift = np.uint32(F4_MANTISSA_BITS - keepbits)
+        bits = values.view(np.uint32)
+        rounded = bits + np.uint32((1 << (int(shift) - 1)) - 1) + ((bits >> shift) & np.uint32(1))
+        rounded &= np.uint32(0xFFFFFFFF ^ ((1 << int(shift)) - 1))
+        np.copyto(bits, rounded, where=np.isfinite(values) & (values != NODATA))
+    mask = np.ma.getmask(data)
+    return values if mask is np.ma.nomask else np.ma.array(values, mask=mask)
+
+
+def quantization_attributes(quantization):
+    """ CF attributes of a quantized variable """
+    keepbits = keep_bits(quantization)
+    attrs = {'quantization': QUANTIZATION_VARIABLE, 'quantization_nsb': np.int32(keepbits),
+             'quantization_maximum_relative_error': np.float64(max_relative_error(keepbits))}
+    if 'nsd' in quantization:
+        attrs['quantization_requested_nsd'] = np.int32(quantization['nsd'])
+    return attrs
+
+
+def add_quantization_info(nc_ds):
+    """ Add the CF quantization container variable the quantized variables refer to, if it isn't there yet """
+    if QUANTIZATION_VARIABLE in nc_ds.variables:
+        return
+    info = nc_ds.createVariable(QUANTIZATION_VARIABLE, 'i4')
+    info.algorithm = 'bitround'
+    info.implementation = 'emit-sds-l4 quantization.bitround, round to nearest with ties to even'
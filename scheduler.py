@@ -0,0 +1,144 @@
+"""
+Memory model and budgeted scheduling of the L4 product conversions
+"""
+
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+# Rough memory model of a conversion, calibrated against the peak_rss_mb of the run reports.  Every process holds
+# the interpreter with numpy, pandas, netCDF4/HDF5 and GDAL loaded
+PROCESS_BASE_BYTES = 128 * 1024**2
+# Copies of a slab held while it is converted - the block as read with its mask, and the contiguous copy netCDF4
+# writes from
+READ_COPIES = 2.5
+# Float64 masked working copy made of a slab by the browse, aggregate and overview observers
+OBSERVER_COPIES = 3
+# Smallest slab the scheduler streams a variable in
+MIN_SLAB_BYTES = 1024**2
+
+
+def slab_memory(slab_bytes, pipeline_depth=0, observed=False):
+    """ Bytes held while a slab is converted
+    Args:
+        slab_bytes: size of the slab as read from the source
+        pipeline_depth: number of shared slab buffers between a reader process and the writer, 0 without pipeline
+        observed: True if observers see the slab
+
+    Returns:
+        predicted memory in bytes, over the writer and the reader process
+    """
+    copies = READ_COPIES + (OBSERVER_COPIES if observed else 0)
+    if pipeline_depth > 0:
+        # The reader process holds a read block of its own on top of the shared buffers
+        copies += max(pipeline_depth, 1) + READ_COPIES
+    return int(slab_bytes * copies)
+
+
+def streaming_slab_bytes(memory_bytes, pipeline_depth=0, observed=False):
+    """ Largest slab whose conversion holds at most memory_bytes, the inverse of slab_memory """
+    per_byte = slab_memory(1024**2, pipeline_depth, observed) / 1024**2
+    return max(MIN_SLAB_BYTES, int(memory_bytes / per_byte))
+
+
+def fits(memory_bytes, running, budget_bytes=None, workers=1):
+    """ Check whether work predicted to use memory_bytes can start next to the running work.  Work that doesn't fit
+    the budget on its own still runs, alone """
+    if len(running) >= workers:
+        return False
+    if budget_bytes is None or len(running) == 0:
+        return True
+    return sum(running) + memory_bytes <= budget_bytes
+
+
+def order_schedule(estimates, budget_bytes=None):
+    """ Order product estimates for scheduling - largest memory first under a budget, naming table order otherwise """
+    if budget_bytes is None:
+        return list(estimates)
+    return sorted(estimates, key=lambda estimate: -estimate['memory_bytes'])
+
+
+def simulate_schedule(estimates, budget_bytes=None, workers=1):
+    """ Play the schedule through, taking the conversion time of a product as proportional to its data size
+    Args:
+        estimates: product estimates in scheduling order, each with suffix, memory_bytes and data_bytes keys
+        budget_bytes: memory budget, or None to only limit the number of workers
+        workers: number of worker processes
+
+    Returns:
+        the estimates in start order, each with a 'runs_with' list of the products running when it starts, and
+        the predicted peak memory of the workers in bytes
+    """
+    queue = list(estimates)
+    running = []
+    now = 0.
+    peak = 0
+    started = []
+    while queue or running:
+        for estimate in list(queue):
+            if fits(estimate['memory_bytes'], [e['memory_bytes'] for _, e in running], budget_bytes, workers):
+                queue.remove(estimate)
+                started.append(dict(estimate, runs_with=[e['suffix'] for _, e in running]))
+                running.append((now + max(estimate['data_bytes'], 1), estimate))
+        peak = max(peak, sum(e['memory_bytes'] for _, e in running))
+        running.sort(key=lambda item: item[0])
+        now = running.pop(0)[0]
+    return started, peak
+
+
+def run_scheduled(items, submit, budget_bytes=None, workers=1):
+    """ Submit work as the memory budget allows, and yield it with its future as it finishes
+    Args:
+        items: work in scheduling order, each a dictionary with a memory_bytes key
+        submit: callable that submits an item to the pool and returns its future
+        budget_bytes: memory budget, or None to only limit the number of workers
+        workers: number of worker processes
+
+    Returns:
+        generator of (item, future) in the order the work finishes
+    """
+    queue = list(items)
+    running = {}
+    while queue or running:
+        for item in list(queue):
+            if fits(item['memory_bytes'], [i['memory_bytes'] for i in running.values()], budget_bytes, workers):
+                queue.remove(item)
+                running[submit(item)] = item
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield running.pop(future), future
+
+
+def format_bytes(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024 or unit == 'GB':
+            break
+        nbytes /= 1024
+    return f'{nbytes:.1f} {unit}' if unit != 'B' else f'{nbytes} B'
+
+
+def print_plan(schedule, peak_bytes, disk_bytes, free_bytes=None, budget_bytes=None, workers=1):
+    """ Print the schedule of the products with their predicted memory and disk use """
+    budget = 'no memory budget' if budget_bytes is None else f'a {format_bytes(budget_bytes)} memory budget'
+    print(f'Conversion plan for {len(schedule)} products under {budget} with {workers} worker(s):')
+    print(f'{"#":>3}  {"Product":<10}{"Vars":>5}{"Data":>11}{"Disk":>11}{"Memory":>11}{"Slab":>11}{"Cache":>11}'
+          f'{"Guess":>11}  Estimate     Runs with')
+    for _s, entry in enumerate(schedule):
+        # The largest slab the plan actually reads, which chunking can make smaller than max_slab_bytes
+        slab = format_bytes(entry['slab_bytes'])
+        if entry['streaming']:
+            slab += '*'
+        cache = 'default' if entry['chunk_cache_bytes'] is None else format_bytes(entry['chunk_cache_bytes'])
+        guess = '-' if entry['size_guess_bytes'] is None else format_bytes(entry['size_guess_bytes'])
+        print(f'{_s + 1:>3}  {entry["suffix"]:<10}{entry["variables"]:>5}{format_bytes(entry["data_bytes"]):>11}'
+              f'{format_bytes(entry["disk_bytes"]):>11}{format_bytes(entry["memory_bytes"]):>11}{slab:>11}{cache:>11}'
+              f'{guess:>11}  {entry["estimated_from"]:<12} {", ".join(entry["runs_with"]) or "-"}')
+    if any(entry['streaming'] for entry in schedule):
+        print('  * streamed in slabs, with smaller chunk caches, to stay within the memory budget')
+    print(f'Predicted peak memory: {format_bytes(peak_bytes)}')
+    print(f'Predicted disk use: {format_bytes(disk_bytes)} at most, before compression')
+    if free_bytes is not None:
+        print(f'Free disk space: {format_bytes(free_bytes)}')
+        if disk_bytes > free_bytes:
+            print('Warning: the uncompressed products may not fit the free disk space')
+    if budget_bytes is not None and peak_bytes > budget_bytes:
+        print('Warning: the largest product is predicted to exceed the memory budget even when run alone')
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from netcdf_conversion_template import OUTPUT_PROFILES, add_variable, chunk_sizes, grid_order, slab_plan
+
+
+SIZES = {'bins': 2, 'lon': 16, 'lat': 13, 'time': 6}
+
+
+def write_source(path, dimensions):
+    """ Source file with south to north latitudes and 0-360 longitudes, as in the model output """
+    rng = np.random.default_rng(0)
+    source_ds = Dataset(path, 'w')
+    for name in dimensions:
+        source_ds.createDimension(name, SIZES[name])
+    source_ds.createVariable('lat', 'f8', ('lat',))[:] = np.linspace(-90, 90, SIZES['lat'])
+    source_ds.createVariable('lon', 'f8', ('lon',))[:] = np.arange(SIZES['lon']) * 360. / SIZES['lon']
+    source_ds.createVariable('dust', 'f4', dimensions)[:] = rng.random([SIZES[name] for name in dimensions])
+    return source_ds
+
+
+def convert(source_ds, path, max_slab_bytes=None, profile=None, observers=()):
+    """ Write the source variable with add_variable, the way convert_product does, and read it back """
+    lat, lat_idx, lon, lon_idx = grid_order(source_ds)
+    nc_ds = Dataset(path, 'w')
+    for name, dimension in source_ds.dimensions.items():
+        nc_ds.createDimension(name, len(dimension))
+    add_variable(nc_ds, 'lat', 'f8', 'Latitude', 'degrees_north', lat, {'dimensions': ('lat',)})
+    add_variable(nc_ds, 'lon', 'f8', 'Longitude', 'degrees_east', lon, {'dimensions': ('lon',)})
+    source_var = source_ds.variables['dust']
+    add_variable(nc_ds, 'dust', 'f4', 'Dust', '1', source_var, {'dimensions': source_var.dimensions},
+                 lat_order=lat_idx, lon_order=lon_idx, max_slab_bytes=max_slab_bytes, profile=profile,
+                 observers=observers)
+    data = nc_ds.variables['dust'][:]
+    nc_ds.close()
+    return data
+
+
+@pytest.mark.parametrize('profile', [None, 'timeseries'])
+def test_lat_slabs_write_every_row(tmp_path, profile):
+    source_ds = write_source(str(tmp_path / 'source.nc'), ('lon', 'lat', 'time'))
+    profile = None if profile is None else OUTPUT_PROFILES[profile]
+    # Less than one time step, so the slabs split lat
+    max_slab_bytes = 4 * SIZES['lon'] * 3
+    out_shape = [SIZES['time'], SIZES['lat'], SIZES['lon']]
+    chunks = None if profile is None else chunk_sizes(profile, ['time', 'lat', 'lon'], out_shape)
+    assert 1 in [axis for axis, _ in slab_plan(out_shape, 4, ['time', 'lat', 'lon'], max_slab_bytes, chunks)]
+
+    expected = convert(source_ds, str(tmp_path / 'whole.nc'), profile=profile)
+    data = convert(source_ds, str(tmp_path / 'slabs.nc'), max_slab_bytes, profile=profile)
+    source_ds.close()
+    assert not np.ma.getmaskarray(data).any()
+    np.testing.assert_array_equal(data, expected)
+
+
+@pytest.mark.parametrize('slab_values', [SIZES['lat'] * SIZES['lon'] * 3, SIZES['lon'] * 5, SIZES['lon']])
+def test_direct_write_matches_whole_conversion(tmp_path, slab_values):
+    # Slabs of a few time steps, of part of the bins of a time step, or of a few lat rows
+    source_ds = write_source(str(tmp_path / 'source.nc'), ('bins', 'lon', 'lat', 'time'))
+
+    expected = convert(source_ds, str(tmp_path / 'whole.nc'))
+    # Without observers the reordered pieces are written straight into the variable, with them the slab is assembled
+    direct = convert(source_ds, str(tmp_path / 'direct.nc'), 4 * slab_values)
+    assembled = convert(source_ds, str(tmp_path / 'assembled.nc'), 4 * slab_values,
+                        observers=[lambda nc_var, out_slices, out_dat: None])
+    source_ds.close()
+    np.testing.assert_array_equal(direct, expected)
+    np.testing.assert_array_equal(assembled, expected)
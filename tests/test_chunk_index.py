@@ -0,0 +1,38 @@
+import json
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+import chunk_index
+
+
+def write_product(path, **compression):
+    nc_ds = Dataset(path, 'w', format='NETCDF4')
+    nc_ds.createDimension('time', 3)
+    nc_ds.createDimension('lat', 10)
+    nc_ds.createDimension('lon', 12)
+    nc_var = nc_ds.createVariable('dust', 'f4', ('time', 'lat', 'lon'), fill_value=-9999, chunksizes=(1, 4, 12),
+                                  **compression)
+    nc_var[:] = np.arange(3 * 10 * 12, dtype=np.float32).reshape(3, 10, 12)
+    nc_ds.close()
+    return path
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'zstd'])
+def test_index_reads_back_compressed_chunks(tmp_path, compression):
+    nc_path = write_product(str(tmp_path / 'product.nc'), compression=compression, complevel=4, shuffle=True)
+    chunk_index.write_index(nc_path)
+
+    with open(chunk_index.index_path(nc_path)) as f:
+        variable = json.load(f)['variables']['dust']
+    assert len(variable['chunks']) == 9
+    assert chunk_index.verify_index(nc_path) == 9
+
+
+def test_index_refuses_unsupported_filters(tmp_path):
+    nc_path = write_product(str(tmp_path / 'product.nc'), compression='bzip2', complevel=4)
+
+    with pytest.raises(ValueError, match='Unsupported filters'):
+        chunk_index.write_index(nc_path)
+    assert not (tmp_path / 'product.index.json').exists()
@@ -0,0 +1,99 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from netCDF4 import Dataset
+
+import netcdf_conversion_template as conversion
+from benchmark_conversion import BENCHMARK_PRESETS, BENCHMARK_RUNS, make_synthetic_input
+from verify_conversion import verify_granule
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_LOOKUP = os.path.join(REPO_DIR, 'data', 'models.csv')
+L4_NAMING = os.path.join(REPO_DIR, 'data', 'L4_varnames.csv')
+
+
+@pytest.fixture(scope='module')
+def input_file(tmp_path_factory):
+    """ Tiny synthetic CESM output, named as in the model lookup """
+    run = BENCHMARK_RUNS['cesm32']
+    lk = pd.read_csv(MODEL_LOOKUP)
+    model = lk.loc[lk['Resolution'] == run['resolution']].iloc[0]
+    path = str(tmp_path_factory.mktemp('input') / model['Input Filename'])
+    make_synthetic_input(path, run, BENCHMARK_PRESETS['tiny'], pd.read_csv(L4_NAMING))
+    return path
+
+
+def convert(input_file, output_dir, *options):
+    args = conversion.conversion_parser().parse_args([input_file, '--output_dir', str(output_dir),
+                                                      '--model_lookup', MODEL_LOOKUP,
+                                                      '--l4_naming_file', L4_NAMING] + list(options))
+    return conversion.convert_granule(args)
+
+
+def read_products(granule_dir):
+    """ Variables of every product of a granule, by file name """
+    products = {}
+    for path in sorted(glob.glob(os.path.join(granule_dir, '*.nc'))):
+        with Dataset(path) as ds:
+            # Scalar variables such as the grid mapping only carry attributes
+            products[os.path.basename(path)] = {name: var[:] for name, var in ds.variables.items() if var.dimensions}
+    return products
+
+
+def assert_same_products(granule_dir, expected_dir):
+    products, expected = read_products(granule_dir), read_products(expected_dir)
+    assert products and sorted(products) == sorted(expected)
+    for file_name, variables in expected.items():
+        assert sorted(products[file_name]) == sorted(variables), file_name
+        for name, data in variables.items():
+            assert not np.ma.getmaskarray(products[file_name][name]).any(), (file_name, name)
+            np.testing.assert_array_equal(products[file_name][name], data, err_msg=f'{file_name} {name}')
+
+
+@pytest.mark.parametrize('profile', ['map', 'timeseries'])
+def test_memory_budget_streams_the_same_products(tmp_path, monkeypatch, input_file, profile):
+    expected_dir = convert(input_file, tmp_path / 'whole', '--output_profile', profile)
+
+    # The tiny input fits any real budget, so allow slabs of a few rows of one time step
+    monkeypatch.setattr(conversion, 'MIN_SLAB_BYTES', 1024)
+    fitted = []
+    fit_product = conversion.fit_product
+
+    def record_fit(*args, **kargs):
+        estimate = fit_product(*args, **kargs)
+        fitted.append(estimate)
+        return estimate
+
+    monkeypatch.setattr(conversion, 'fit_product', record_fit)
+    granule_dir = convert(input_file, tmp_path / 'budget', '--output_profile', profile, '--memory_budget_gb', '0.01')
+    assert fitted and all(estimate['streaming'] and estimate['max_slab_bytes'] == 1024 for estimate in fitted)
+    assert_same_products(granule_dir, expected_dir)
+
+
+def test_stacked_zarr_aggregates_match_netcdf(tmp_path, input_file):
+    options = ['--mineral_layout', 'stacked', '--aggregates']
+    netcdf_dir = convert(input_file, tmp_path / 'netcdf', *options)
+    zarr_dir = convert(input_file, tmp_path / 'zarr', '--output_format', 'zarr', *options)
+
+    # The aggregate companions are netCDF files either way, with the mineral names copied from the product
+    aggregates = read_products(zarr_dir)
+    assert any('mineral' in variables for variables in aggregates.values())
+    expected = {file_name: variables for file_name, variables in read_products(netcdf_dir).items()
+                if file_name in aggregates}
+    assert sorted(expected) == sorted(aggregates)
+    for file_name, variables in expected.items():
+        assert sorted(aggregates[file_name]) == sorted(variables), file_name
+        for name, data in variables.items():
+            np.testing.assert_array_equal(aggregates[file_name][name], data, err_msg=f'{file_name} {name}')
+
+
+def test_stacked_slabs_pass_verification(input_file, tmp_path):
+    # Slabs of a few lat rows of one mineral and level
+    granule_dir = convert(input_file, tmp_path, '--mineral_layout', 'stacked', '--slab_mb', '0.001')
+    report = verify_granule(input_file, granule_dir, pd.read_csv(L4_NAMING))
+    errors = [error for product in report['products'] for error in product['errors']]
+    assert report['passed'], errors
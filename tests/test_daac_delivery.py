@@ -0,0 +1,44 @@
+import json
+import os
+
+from cnm_client import CNMClient, DryRunBackend
+from daac_delivery import submit_cnm_batch
+
+
+def delivered_batch(tmp_path, granules):
+    """ Notifications and summaries of granules that were staged, waiting for the batch submission """
+    cnm_batch, results = [], {}
+    for granule_ur in granules:
+        path = tmp_path / granule_ur
+        path.mkdir()
+        notification = {'identifier': f'{granule_ur}_20260101t000000', 'product': {'name': granule_ur, 'files': []}}
+        cnm_batch.append((notification, str(path / f'{notification["identifier"]}_cnm.json')))
+        results[str(path)] = ('delivered', {'staging': 1.}, '')
+    return cnm_batch, results
+
+
+def submission_outputs(cnm_batch):
+    outputs = []
+    for _, cnm_submission_path in cnm_batch:
+        with open(cnm_submission_path.replace('.json', '.out')) as f:
+            outputs.append(json.load(f))
+    return outputs
+
+
+def test_batch_submission(tmp_path):
+    cnm_batch, results = delivered_batch(tmp_path, ['GRANULE_A', 'GRANULE_B'])
+    submit_cnm_batch(CNMClient(DryRunBackend()), cnm_batch, results)
+    assert [status for status, _, _ in results.values()] == ['delivered', 'delivered']
+    assert all('cnm_batch' in timings for _, timings, _ in results.values())
+    assert submission_outputs(cnm_batch) == [{'message_id': 'dry-run'}] * 2
+
+
+def test_failed_batch_submission_fails_every_granule(tmp_path):
+    cnm_batch, results = delivered_batch(tmp_path, ['GRANULE_A', 'GRANULE_B'])
+    # Notifications over the batch size limit make the submission raise
+    submit_cnm_batch(CNMClient(DryRunBackend(), batch_bytes=16), cnm_batch, results)
+    for path, (status, timings, error) in results.items():
+        assert status == 'failed'
+        assert 'cnm_batch' in timings
+        assert os.path.basename(path) in error and 'byte limit' in error
+    assert all('byte limit' in output['error'] for output in submission_outputs(cnm_batch))
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from netcdf_conversion_template import (OUTPUT_PROFILES, MineralStack, add_variable, assemble_pieces, chunk_sizes,
+                                        iter_slabs, output_dimensions, slab_nbytes, slab_plan, slab_slices,
+                                        stacked_profile)
+
+
+# A stacked mineral variable, as converted with --mineral_layout stacked
+KEYS = ['mineral', 'time', 'lev', 'lat', 'lon']
+SHAPE = [3, 4, 5, 14, 12]
+ITEMSIZE = 4
+
+
+def stacked_chunks(profile_name):
+    return chunk_sizes(stacked_profile(OUTPUT_PROFILES[profile_name]), KEYS, SHAPE)
+
+
+def covered(plan):
+    """ Number of times each output value is covered by the slabs of a plan, and the largest slab in bytes """
+    counts = np.zeros(SHAPE, dtype=int)
+    largest = 0
+    for out_slices in slab_slices(SHAPE, plan):
+        counts[out_slices] += 1
+        largest = max(largest, ITEMSIZE * counts[out_slices].size)
+    return counts, largest
+
+
+def test_variable_that_fits_is_read_whole():
+    assert slab_plan(SHAPE, ITEMSIZE, KEYS, None, stacked_chunks('map')) == []
+    assert slab_plan(SHAPE, ITEMSIZE, KEYS, ITEMSIZE * np.prod(SHAPE), stacked_chunks('map')) == []
+
+
+def test_single_axis_when_a_chunk_row_fits():
+    time_step = ITEMSIZE * np.prod(SHAPE) // SHAPE[1]
+    plan = slab_plan(SHAPE, ITEMSIZE, KEYS, 2 * time_step, stacked_chunks('map'))
+    assert plan == [(KEYS.index('time'), 2)]
+
+
+def test_time_step_over_budget_splits_along_a_second_axis():
+    time_step = ITEMSIZE * np.prod(SHAPE) // SHAPE[1]
+    for profile_name in ['map', 'timeseries', 'contiguous']:
+        chunks = stacked_chunks(profile_name) if profile_name != 'contiguous' else None
+        max_slab_bytes = time_step // 4
+        plan = slab_plan(SHAPE, ITEMSIZE, KEYS, max_slab_bytes, chunks)
+        assert len(plan) > 1, profile_name
+
+        counts, largest = covered(plan)
+        assert (counts == 1).all(), profile_name
+        assert largest <= max_slab_bytes, profile_name
+        assert slab_nbytes(SHAPE, ITEMSIZE, KEYS, max_slab_bytes, chunks) == largest, profile_name
+
+
+def test_mineral_is_split_when_one_level_of_all_minerals_is_over_budget():
+    level = ITEMSIZE * SHAPE[0] * SHAPE[3] * SHAPE[4]
+    plan = slab_plan(SHAPE, ITEMSIZE, KEYS, level // 2, stacked_chunks('map'))
+    assert [axis for axis, _ in plan] == [KEYS.index('time'), KEYS.index('lev'), KEYS.index('mineral')]
+    assert (covered(plan)[0] == 1).all()
+
+
+def write_minerals(path):
+    """ Source file with a variable per mineral, and the mineral variables stacked as they are converted """
+    rng = np.random.default_rng(0)
+    source_keys = ['time', 'lev', 'lat', 'lon']
+    minerals = [rng.random(SHAPE[1:]).astype(np.float32) for _ in range(SHAPE[0])]
+    source_ds = Dataset(path, 'w')
+    for name, size in zip(source_keys, SHAPE[1:]):
+        source_ds.createDimension(name, size)
+    for _m, data in enumerate(minerals):
+        source_ds.createVariable(f'atm_min_{_m}', 'f4', source_keys)[:] = data
+    return source_ds, MineralStack([source_ds.variables[f'atm_min_{_m}'] for _m in range(SHAPE[0])]), minerals
+
+
+def test_split_slabs_reassemble_the_reordered_variable(tmp_path):
+    source_ds, stack, minerals = write_minerals(str(tmp_path / 'source.nc'))
+    newkeys, idx = output_dimensions(stack.dimensions)
+    # Latitudes flipped from south to north, as for the CESM source
+    lat_order = np.arange(SHAPE[3])[::-1]
+    expected = np.stack(minerals)[:, :, :, ::-1, :]
+
+    time_step = ITEMSIZE * np.prod(SHAPE) // SHAPE[1]
+    out = np.zeros(SHAPE, dtype=np.float32)
+    slabs = 0
+    for out_slices, pieces in iter_slabs(stack, idx, newkeys, lat_order, None, time_step // 8, stacked_chunks('map')):
+        out[out_slices] = assemble_pieces(pieces)
+        slabs += 1
+    source_ds.close()
+    assert slabs > SHAPE[1]
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize('profile_name', ['map', 'timeseries', 'contiguous'])
+@pytest.mark.parametrize('slab_values', [SHAPE[0] * SHAPE[3] * SHAPE[4] // 2, SHAPE[3] * SHAPE[4] // 2])
+def test_split_slabs_write_the_stacked_variable(tmp_path, profile_name, slab_values):
+    source_ds, stack, minerals = write_minerals(str(tmp_path / 'source.nc'))
+    profile = stacked_profile(OUTPUT_PROFILES[profile_name])
+    lat_order = np.arange(SHAPE[3])[::-1]
+    lon_order = np.roll(np.arange(SHAPE[4]), SHAPE[4] // 2)
+    expected = np.stack(minerals)[:, :, :, ::-1, :][..., lon_order]
+
+    def convert(path, max_slab_bytes):
+        nc_ds = Dataset(path, 'w')
+        for name, size in zip(KEYS, SHAPE):
+            nc_ds.createDimension(name, size)
+        nc_ds.createVariable('lat', 'f8', ('lat',))[:] = np.linspace(90, -90, SHAPE[3])
+        nc_ds.createVariable('lon', 'f8', ('lon',))[:] = np.linspace(-180, 150, SHAPE[4])
+        add_variable(nc_ds, 'atm_min', 'f4', None, None, stack, {'dimensions': stack.dimensions},
+                     lat_order=lat_order, lon_order=lon_order, max_slab_bytes=max_slab_bytes, profile=profile)
+        data = nc_ds.variables['atm_min'][:]
+        nc_ds.close()
+        return data
+
+    # Less than one level of all minerals, or of one mineral, so the slabs split time, lev, mineral and then lat
+    max_slab_bytes = ITEMSIZE * slab_values
+    chunks = chunk_sizes(profile, KEYS, SHAPE) if 'chunks' in profile else None
+    assert len(slab_plan(SHAPE, ITEMSIZE, KEYS, max_slab_bytes, chunks)) > 2
+
+    whole = convert(str(tmp_path / 'whole.nc'), None)
+    data = convert(str(tmp_path / 'slabs.nc'), max_slab_bytes)
+    source_ds.close()
+    np.testing.assert_array_equal(whole, expected)
+    assert not np.ma.getmaskarray(data).any()
+    np.testing.assert_array_equal(data, whole)
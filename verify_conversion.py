@@ -0,0 +1,312 @@
+"""
+Verifies converted L4 products against their source file, slab by slab
+
+Example:
+    python verify_conversion.py /path/to/ATBD.L4.CAM6.ALL.VARIABLES.EMIT_base_COUPLED_PD.nc /path/to/<granule> \
+        --workers 4
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset
+
+from instrumentation import write_report
+from netcdf_conversion_template import (MINERAL_DIMENSION, NODATA, VARIABLE_MAPPING, destination_name, grid_order,
+                                        output_dimensions, resolve_products, slab_plan, slab_slices)
+
+
+# Slab size variables are compared in, in MB
+DEFAULT_SLAB_MB = 64
+
+
+def report_path(granule_dir, granule):
+    """ Path of the verification report of a granule """
+    return os.path.join(granule_dir, f'{granule}.verification.json')
+
+
+def file_identity(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def compare_slab(source, output, tolerance=0.):
+    """ Compare a slab of source data against the same slab of output data
+    Args:
+        source: source values, as read from the source variable and put in output order
+        output: output values, masked where the output holds the fill value
+        tolerance: relative error allowed, 0 for exact equality
+
+    Returns:
+        dictionary of counts of values compared, value, mask and NaN mismatches, and the largest errors
+    """
+    source_values = np.ma.getdata(source).astype(np.float32)
+    output_values = np.ma.getdata(output)
+    # Source values that are masked or equal to the fill value are written as the fill value
+    source_mask = np.ma.getmaskarray(source) | (source_values == NODATA)
+    output_mask = np.ma.getmaskarray(output)
+    source_nan = np.isnan(source_values) & ~source_mask
+    output_nan = np.isnan(output_values) & ~output_mask
+
+    valid = ~source_mask & ~output_mask & ~source_nan & ~output_nan
+    expected = source_values[valid].astype(np.float64)
+    error = np.abs(output_values[valid].astype(np.float64) - expected)
+    if tolerance > 0:
+        mismatches = error > tolerance * np.abs(expected)
+    else:
+        mismatches = error != 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        relative = np.where(expected != 0, error / np.abs(expected), np.where(error != 0, np.inf, 0.))
+    return {'values': int(valid.sum()),
+            'value_mismatches': int(mismatches.sum()),
+            'mask_mismatches': int((source_mask != output_mask).sum()),
+            'fill_values': int(output_mask.sum()),
+            'source_nans': int(source_nan.sum()),
+            'output_nans': int(output_nan.sum()),
+            'max_abs_error': float(error.max()) if error.size else 0.,
+            'max_rel_error': float(relative.max()) if relative.size else 0.}
+
+
+def verify_variable(source_var, output_var, lat_idx, lon_idx, max_slab_bytes=None, mineral_index=None):
+    """ Compare an output variable against its source variable, reading both slab by slab
+    Args:
+        source_var: source netCDF variable
+        output_var: output netCDF variable
+        lat_idx: index array the source lat axis was reordered with
+        lon_idx: index array the source lon axis was reordered with
+        max_slab_bytes: largest output slab read at once, None to read the variable whole
+        mineral_index: for a stacked mineral variable, the index of the source variable's mineral
+
+    Returns:
+        dictionary with passed, the tolerance and the summed comparison counts
+    """
+    newkeys, idx = output_dimensions(source_var.dimensions)
+    out_shape = [source_var.shape[i] for i in idx]
+    result = {'source': source_var.name, 'passed': False, 'errors': []}
+    output_dims, output_shape = list(output_var.dimensions), list(output_var.shape)
+    chunks = output_var.chunking()
+    # Stacked mineral variables are compared one mineral at a time, with the leading mineral axis taken off
+    mineral = ()
+    if mineral_index is not None:
+        result['mineral_index'] = mineral_index
+        if output_dims[:1] != [MINERAL_DIMENSION]:
+            result['errors'].append(f'Output dimensions {output_var.dimensions} do not start with {MINERAL_DIMENSION}')
+            return result
+        output_dims, output_shape = output_dims[1:], output_shape[1:]
+        chunks = chunks if chunks == 'contiguous' else chunks[1:]
+        mineral = (mineral_index,)
+    if output_dims != newkeys or output_shape != out_shape:
+        result['errors'].append(f'Output dimensions {tuple(output_dims)} {tuple(output_shape)} do not match the '
+                                f'expected {tuple(newkeys)} {tuple(out_shape)}')
+        return result
+
+    # Quantized variables are compared within their documented error bound
+    tolerance = float(getattr(output_var, 'quantization_maximum_relative_error', 0.))
+    result['tolerance'] = tolerance
+    # The source rows of each output lat/lon index, taken independently of the conversion's own reordering
+    orders = {}
+    if 'lat' in newkeys and 'lon' in newkeys:
+        orders = {newkeys.index('lat'): np.asarray(lat_idx), newkeys.index('lon'): np.asarray(lon_idx)}
+
+    plan = slab_plan(out_shape, output_var.dtype.itemsize, newkeys, max_slab_bytes,
+                     None if chunks == 'contiguous' else chunks)
+    totals = {}
+    for out_slices in slab_slices(out_shape, plan):
+        output = np.ma.asarray(output_var[mineral + out_slices])
+        # Read the range of source rows the slab comes from, and put them in output order
+        src_slices = [None] * len(idx)
+        rows = {}
+        for ax, out_slice in enumerate(out_slices):
+            if ax in orders:
+                rows[ax] = orders[ax][out_slice]
+                out_slice = slice(int(rows[ax].min()), int(rows[ax].max()) + 1)
+            src_slices[idx[ax]] = out_slice
+        source = np.ma.asarray(source_var[tuple(src_slices)]).transpose(idx)
+        for ax, ax_rows in rows.items():
+            source = source.take(ax_rows - ax_rows.min(), axis=ax)
+        counts = compare_slab(source, output, tolerance)
+        for key, value in counts.items():
+            totals[key] = max(totals.get(key, 0), value) if key.startswith('max_') else totals.get(key, 0) + value
+
+    result.update(totals)
+    if totals['value_mismatches']:
+        result['errors'].append(f'{totals["value_mismatches"]} values differ from the source beyond a relative '
+                                f'tolerance of {tolerance}')
+    if totals['mask_mismatches']:
+        result['errors'].append(f'{totals["mask_mismatches"]} fill values do not match the source')
+    if totals['source_nans'] != totals['output_nans']:
+        result['errors'].append(f'{totals["output_nans"]} NaNs in the output, {totals["source_nans"]} in the source')
+    result['passed'] = len(result['errors']) == 0
+    return result
+
+
+def verify_coordinates(source_dataset, output_ds):
+    """ Check the output lat/lon against the reordered source coordinates
+    Returns:
+        list of errors
+    """
+    lat, _, lon, _ = grid_order(source_dataset)
+    errors = []
+    if not np.allclose(np.asarray(output_ds.variables['lon'][:]), lon):
+        errors.append('Longitudes do not match the wrapped source longitudes')
+    # The first and last latitudes are extrapolated from their neighbours during conversion
+    if not np.allclose(np.asarray(output_ds.variables['lat'][1:-1]), lat[1:-1]):
+        errors.append('Latitudes do not match the flipped source latitudes')
+    return errors
+
+
+def verify_product(input_file, output_file, product, max_slab_bytes=None):
+    """ Verify every variable of a product file against the source file
+    Args:
+        input_file: path of the source netCDF file
+        output_file: path of the product netCDF file
+        product: product description from resolve_products
+        max_slab_bytes: largest slab read at once from each file
+
+    Returns:
+        product verification report
+    """
+    start_time = time.time()
+    report = {'suffix': product['suffix'], 'file': os.path.basename(output_file), 'passed': False, 'errors': [],
+              'variables': {}}
+    if not os.path.exists(output_file):
+        report['errors'].append('Product file is missing')
+        return report
+    report.update(file_identity(output_file))
+
+    source_dataset = Dataset(input_file, 'r')
+    output_ds = Dataset(output_file, 'r')
+    try:
+        report['errors'] += verify_coordinates(source_dataset, output_ds)
+        _, lat_idx, _, lon_idx = grid_order(source_dataset)
+        # Mineral repeat rows may have been written stacked into one variable along the mineral dimension
+        minerals = []
+        stacked_name = destination_name(product['short_name'])
+        if product.get('minerals') is not None and MINERAL_DIMENSION in output_ds.variables:
+            minerals = list(output_ds.variables[MINERAL_DIMENSION][:])
+        for l4_name in product['l4_names']:
+            name = destination_name(l4_name)
+            output_name, mineral_index = name, None
+            if name not in output_ds.variables and minerals and stacked_name in output_ds.variables:
+                mineral = product['minerals'][product['l4_names'].index(l4_name)]
+                if mineral not in minerals:
+                    report['errors'].append(f'{name} (from {l4_name}) is missing from {stacked_name}')
+                    continue
+                output_name, mineral_index = stacked_name, minerals.index(mineral)
+            if output_name not in output_ds.variables:
+                report['errors'].append(f'{name} (from {l4_name}) is missing')
+                continue
+            result = verify_variable(source_dataset.variables[l4_name], output_ds.variables[output_name], lat_idx,
+                                     lon_idx, max_slab_bytes, mineral_index)
+            report['variables'][name] = result
+            report['errors'] += [f'{name}: {error}' for error in result['errors']]
+    finally:
+        output_ds.close()
+        source_dataset.close()
+    report['passed'] = len(report['errors']) == 0
+    report['seconds'] = time.time() - start_time
+    return report
+
+
+def verify_granule(input_file, granule_dir, l4_naming, suffixes=None, workers=1, max_slab_bytes=None):
+    """ Verify the netCDF products of a converted granule against its source file, in parallel across products
+    Args:
+        input_file: path of the source netCDF file
+        granule_dir: granule directory the products were written to
+        l4_naming: L4 naming table
+        suffixes: if given, only verify these products
+        workers: number of worker processes
+        max_slab_bytes: largest slab read at once from each file
+
+    Returns:
+        granule verification report, passed only if every product passed
+    """
+    granule = os.path.basename(os.path.normpath(granule_dir))
+    source_dataset = Dataset(input_file, 'r')
+    products, _ = resolve_products(source_dataset, l4_naming)
+    source_dataset.close()
+    if suffixes:
+        products = [product for product in products if product['suffix'] in suffixes]
+
+    jobs = [(input_file, os.path.join(granule_dir, f'{granule}_{product["suffix"]}.nc'), product, max_slab_bytes)
+            for product in products]
+    if workers > 1:
+        # Spawn rather than fork, so no HDF5 library state is shared with the workers
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            product_reports = list(pool.map(verify_product, *zip(*jobs)))
+    else:
+        product_reports = [verify_product(*job) for job in jobs]
+
+    return {'granule': granule,
+            'source': os.path.abspath(input_file),
+            'verified': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'variable_mapping': VARIABLE_MAPPING,
+            'passed': len(product_reports) > 0 and all(report['passed'] for report in product_reports),
+            'products': product_reports}
+
+
+def verification_passed(granule_dir, granule):
+    """ Check whether a granule has a passing verification report that covers its current netCDF products
+    Returns:
+        (passed, reason) tuple
+    """
+    path = report_path(granule_dir, granule)
+    if not os.path.exists(path):
+        return False, f'{path} does not exist'
+    with open(path) as f:
+        report = json.load(f)
+    if not report.get('passed'):
+        return False, f'{path} lists failed products'
+
+    verified = {product['file']: product for product in report['products']}
+    for nc_path in glob.glob(os.path.join(granule_dir, f'{granule}_*.nc')):
+        name = os.path.basename(nc_path)
+        # Aggregate companions are derived from the products and not compared against the source
+        if name.endswith('_AGG.nc'):
+            continue
+        if name not in verified:
+            return False, f'{name} is not covered by {path}'
+        if file_identity(nc_path) != {key: verified[name].get(key) for key in ('size', 'mtime')}:
+            return False, f'{name} changed since it was verified'
+    return True, ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify converted L4 products against their source file')
+    parser.add_argument('input_file', help='Source ESM netCDF file')
+    parser.add_argument('granule_dir', help='Granule directory written by netcdf_conversion_template.py')
+    parser.add_argument('--l4_naming_file', default='data/L4_varnames.csv')
+    parser.add_argument('--products', nargs='*', default=None, metavar='SUFFIX',
+                        help='Only verify these products')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes used to verify the products in parallel')
+    parser.add_argument('--slab_mb', type=float, default=DEFAULT_SLAB_MB,
+                        help='Compare each variable in slabs of at most this many MB')
+    parser.add_argument('--report', default=None,
+                        help='Path of the JSON report, <granule_dir>/<granule>.verification.json by default')
+    args = parser.parse_args()
+
+    l4_naming = pd.read_csv(args.l4_naming_file)
+    report = verify_granule(args.input_file, args.granule_dir, l4_naming, args.products, args.workers,
+                            int(args.slab_mb * 1024**2))
+    for product in report['products']:
+        print(f'{product["suffix"]}: {"passed" if product["passed"] else "FAILED"}')
+        for error in product['errors']:
+            print(f'    {error}')
+    path = args.report or report_path(args.granule_dir, report['granule'])
+    write_report(path, report)
+    print(f'Verification {"passed" if report["passed"] else "FAILED"}, report written to {path}')
+    sys.exit(0 if report['passed'] else 1)
+
+
+if __name__ == "__main__":
+    main()
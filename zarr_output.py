@@ -0,0 +1,290 @@
+"""
+Zarr output backend for the L4 conversion, behind the same interface as a netCDF4 Dataset
+"""
+
+import os
+import shutil
+
+import numpy as np
+import zarr
+from numcodecs import Blosc, VLenUTF8
+
+
+# Compression of stores written with an uncompressed profile, stores are always chunked and compressed
+DEFAULT_ZARR_COMPRESSION = {'compression': 'zstd', 'complevel': 5, 'shuffle': True}
+
+
+def attribute_value(value):
+    """ Attribute value as stored in the zarr attributes, which must be JSON serializable """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def default_chunks(dimensions, shape):
+    """ One full lat/lon map per chunk, one-dimensional variables in a single chunk """
+    if len(shape) == 1:
+        return list(shape)
+    return [size if name in ('lat', 'lon') else 1 for name, size in zip(dimensions, shape)]
+
+
+def replace_store(partial_path, path):
+    """ Move a finished store into place, replacing any previous one """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(partial_path, path)
+
+
+class ZarrDimension:
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class ZarrVariable:
+    """A zarr array with the parts of the netCDF4 Variable interface the conversion uses.
+
+    Attributes set on the variable go to the array attributes, together with the xarray _ARRAY_DIMENSIONS
+    convention.  Masked values are written as the fill value and masked again when read.
+    """
+
+    def __init__(self, name, array, dimensions, group):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'dimensions', tuple(dimensions))
+        object.__setattr__(self, '_array', array)
+        object.__setattr__(self, '_group', group)
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    @property
+    def ndim(self):
+        return self._array.ndim
+
+    @property
+    def size(self):
+        return self._array.size
+
+    def group(self):
+        return self._group
+
+    def __setattr__(self, name, value):
+        self._array.attrs[name] = attribute_value(value)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._array.attrs[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def ncattrs(self):
+        return [name for name in self._array.attrs.keys() if name != '_ARRAY_DIMENSIONS']
+
+    def getncattr(self, name):
+        return self._array.attrs[name]
+
+    def setncattr(self, name, value):
+        self._array.attrs[name] = attribute_value(value)
+
+    def setncatts(self, attrs):
+        self._array.attrs.update({name: attribute_value(value) for name, value in attrs.items()})
+
+    def __setitem__(self, key, value):
+        fill_value = self._array.fill_value
+        if np.ma.isMaskedArray(value) and fill_value is not None:
+            value = np.ma.filled(value, fill_value)
+        if self._array.dtype != object:
+            value = np.asarray(value, dtype=self._array.dtype)
+        self._array[key] = value
+
+    def __getitem__(self, key):
+        data = self._array[key]
+        if self._array.fill_value is not None and self._array.dtype.kind == 'f':
+            return np.ma.masked_equal(data, self._array.fill_value)
+        return data
+
+    def __array__(self, dtype=None):
+        return np.asarray(self._array[...], dtype=dtype)
+
+
+class ZarrDataset:
+    """A zarr group with the parts of the netCDF4 Dataset interface the conversion uses.
+
+    Global attributes, dimensions, variables and groups are created the same way as on a netCDF4 Dataset, so
+    add_variable and the observers write to either.  Dimensions are looked up in the enclosing groups as in netCDF4.
+    Closing the root group consolidates the store metadata, so readers open it with a single request.
+    """
+
+    def __init__(self, path, group=None, parent=None):
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, '_group', zarr.open_group(zarr.DirectoryStore(path), mode='w')
+                           if group is None else group)
+        object.__setattr__(self, '_parent', parent)
+        object.__setattr__(self, 'dimensions', {})
+        object.__setattr__(self, 'variables', {})
+        object.__setattr__(self, 'groups', {})
+
+    def __setattr__(self, name, value):
+        self._group.attrs[name] = attribute_value(value)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._group.attrs[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def ncattrs(self):
+        return list(self._group.attrs.keys())
+
+    def getncattr(self, name):
+        return self._group.attrs[name]
+
+    def setncattr(self, name, value):
+        self._group.attrs[name] = attribute_value(value)
+
+    def filepath(self):
+        return self.path
+
+    def _dimension(self, name):
+        if name in self.dimensions:
+            return self.dimensions[name]
+        if self._parent is None:
+            raise KeyError(f'Dimension {name} is not defined')
+        return self._parent._dimension(name)
+
+    def createDimension(self, name, size):
+        self.dimensions[name] = ZarrDimension(name, size)
+        return self.dimensions[name]
+
+    def createGroup(self, name):
+        self.groups[name] = ZarrDataset(self.path, self._group.create_group(name), self)
+        return self.groups[name]
+
+    def createVariable(self, name, datatype, dimensions=(), fill_value=None, compression=None, complevel=None,
+                       shuffle=True, chunksizes=None, **kwargs):
+        dimensions = tuple(dimensions)
+        shape = [len(self._dimension(dim)) for dim in dimensions]
+        if compression is None:
+            compression = DEFAULT_ZARR_COMPRESSION['compression']
+            complevel = DEFAULT_ZARR_COMPRESSION['complevel']
+            shuffle = DEFAULT_ZARR_COMPRESSION['shuffle']
+        compressor = Blosc(cname=compression, clevel=4 if complevel is None else complevel,
+                           shuffle=Blosc.SHUFFLE if shuffle else Blosc.NOSHUFFLE)
+        chunks = default_chunks(dimensions, shape) if chunksizes is None else list(chunksizes)
+        codec = {}
+        if datatype is str:
+            # Variable length UTF-8 strings, like netCDF4 vlen strings
+            datatype, fill_value, codec = object, None, {'object_codec': VLenUTF8()}
+
+        array = self._group.create_dataset(name, shape=shape, chunks=chunks if shape else True,
+                                           dtype=np.dtype(datatype), compressor=compressor, fill_value=fill_value,
+                                           **codec)
+        array.attrs['_ARRAY_DIMENSIONS'] = list(dimensions)
+        self.variables[name] = ZarrVariable(name, array, dimensions, self)
+        return self.variables[name]
+
+    def sync(self):
+        pass
+
+    def close(self):
+        if self._parent is None:
+            zarr.consolidate_metadata(self._group.store)
+
+
+class TeeDataset:
+    """Writes the same conversion to several datasets at once, e.g. a netCDF4 Dataset and a ZarrDataset.
+
+    Attributes, dimensions, variables and groups are created on every dataset, and writes go to all of them.
+    Reads are served by the first dataset.
+    """
+
+    def __init__(self, datasets):
+        object.__setattr__(self, '_datasets', list(datasets))
+
+    def __setattr__(self, name, value):
+        for dataset in self._datasets:
+            setattr(dataset, name, value)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._datasets[0], name)
+
+    def setncattr(self, name, value):
+        for dataset in self._datasets:
+            dataset.setncattr(name, value)
+
+    @property
+    def variables(self):
+        return {name: TeeVariable([dataset.variables[name] for dataset in self._datasets])
+                for name in self._datasets[0].variables}
+
+    @property
+    def groups(self):
+        return {name: TeeDataset([dataset.groups[name] for dataset in self._datasets])
+                for name in self._datasets[0].groups}
+
+    def createDimension(self, name, size):
+        return [dataset.createDimension(name, size) for dataset in self._datasets][0]
+
+    def createGroup(self, name):
+        return TeeDataset([dataset.createGroup(name) for dataset in self._datasets])
+
+    def createVariable(self, name, datatype, *args, **kwargs):
+        return TeeVariable([dataset.createVariable(name, datatype, *args, **kwargs) for dataset in self._datasets])
+
+    def sync(self):
+        for dataset in self._datasets:
+            dataset.sync()
+
+    def close(self):
+        for dataset in self._datasets:
+            dataset.close()
+
+
+class TeeVariable:
+    """ Variable of a TeeDataset, written to the variables of every dataset and read from the first """
+
+    def __init__(self, variables):
+        object.__setattr__(self, '_variables', list(variables))
+
+    def __setattr__(self, name, value):
+        for variable in self._variables:
+            setattr(variable, name, value)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._variables[0], name)
+
+    def group(self):
+        return TeeDataset([variable.group() for variable in self._variables])
+
+    def setncatts(self, attrs):
+        for variable in self._variables:
+            variable.setncatts(attrs)
+
+    def __setitem__(self, key, value):
+        for variable in self._variables:
+            variable[key] = value
+
+    def __getitem__(self, key):
+        return self._variables[0][key]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self._variables[0][...], dtype=dtype)